@@ -0,0 +1,39 @@
+# gunicorn -c gunicorn.conf.py
+#
+# The app is loaded once in the master (preload_app) and the workers are forked from it, so the reference data and
+# modules loaded by create_app are shared copy-on-write rather than loaded by every worker. The reference data is
+# reloaded by sending the master a HUP, also sent every REFERENCE_DATA_RELOAD_INTERVAL seconds: the master reloads it,
+# starts a new set of workers and gracefully stops the old ones. As the app is preloaded, code changes need a restart.
+import os
+import sys
+import time
+import signal
+import threading
+
+wsgi_app = "src.app:create_app()"
+preload_app = True
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("GUNICORN_WORKERS", 4))
+
+REFERENCE_DATA_RELOAD_INTERVAL = int(os.getenv("REFERENCE_DATA_RELOAD_INTERVAL", 86400)) # 0 only reloads on a HUP
+
+def when_ready(server):
+    def rotate():
+        while True:
+            time.sleep(REFERENCE_DATA_RELOAD_INTERVAL)
+            os.kill(server.pid, signal.SIGHUP)
+
+    if REFERENCE_DATA_RELOAD_INTERVAL:
+        threading.Thread(target=rotate, daemon=True).start()
+
+def on_reload(server):
+    from src.app import preload_reference_data
+
+    server.log.info("Reloading reference data before replacing the workers")
+    preload_reference_data(refresh=True)
+
+def post_fork(server, worker):
+    # connections opened by the master must not be shared, each worker opens its own
+    app_module = sys.modules.get("src.app")
+    if app_module is not None:
+        app_module.db.engine.dispose(close=False)
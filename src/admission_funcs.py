@@ -0,0 +1,68 @@
+import os
+import threading
+
+from collections import Counter
+
+ADMISSION_WAIT = float(os.getenv("ADMISSION_WAIT", 10)) # longest a queued request waits for a slot, in seconds
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", 30)) # Retry-After sent with a 429
+
+# concurrent requests and queued requests allowed per class, per worker process
+ADMISSION_LIMITS = {
+    "recompute": (int(os.getenv("ADMISSION_RECOMPUTE_LIMIT", 1)), int(os.getenv("ADMISSION_RECOMPUTE_QUEUE", 0))),
+    "llm": (int(os.getenv("ADMISSION_LLM_LIMIT", 4)), int(os.getenv("ADMISSION_LLM_QUEUE", 8))),
+    "reads": (int(os.getenv("ADMISSION_READS_LIMIT", 32)), int(os.getenv("ADMISSION_READS_QUEUE", 64))),
+}
+
+class AdmissionClass:
+    """
+    Concurrency limit for one class of request, with a bounded queue of requests waiting for a slot.
+    """
+    def __init__(self, name, limit, queue, wait=ADMISSION_WAIT):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.wait = wait
+        self.slots = threading.BoundedSemaphore(limit)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.waiting = 0
+        self.counts = Counter()
+
+    def acquire(self):
+        """
+        Takes a slot, queueing for up to wait seconds if the queue has room.
+
+        Returns:
+        bool: True if the request was admitted, False if it was shed because the queue was full or the wait timed out.
+        """
+        admitted = self.slots.acquire(blocking=False)
+        if not admitted:
+            with self.lock:
+                if self.waiting >= self.queue:
+                    self.counts["shed_queue_full"] += 1
+                    return False
+                self.waiting += 1
+            admitted = self.slots.acquire(timeout=self.wait)
+            with self.lock:
+                self.waiting -= 1
+                if not admitted:
+                    self.counts["shed_timeout"] += 1
+                    return False
+        with self.lock:
+            self.running += 1
+            self.counts["admitted"] += 1
+        return True
+
+    def release(self):
+        with self.lock:
+            self.running -= 1
+        self.slots.release()
+
+    def stats(self):
+        with self.lock:
+            return {"limit": self.limit, "queue": self.queue, "running": self.running, "waiting": self.waiting, **self.counts}
+
+admission_classes = {name: AdmissionClass(name, limit, queue) for name, (limit, queue) in ADMISSION_LIMITS.items()}
+
+def admission_stats():
+    return {name: admission.stats() for name, admission in admission_classes.items()}
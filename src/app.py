@@ -1,22 +1,40 @@
+import gc
 import os
 import datetime
+import importlib
 import json
 import logging
+import time
+import random
+import threading
 
+import click
 import pandas as pd
-import awswrangler as wr
 
-from flask import render_template, request, jsonify, Flask, redirect, url_for, make_response
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+
+from flask import g, render_template, request, jsonify, Flask, redirect, url_for, make_response, send_file, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_wtf import FlaskForm
 from logging.handlers import RotatingFileHandler
-from sqlalchemy import inspect, create_engine, func
+from werkzeug.exceptions import HTTPException
+from sqlalchemy import inspect, create_engine, func, MetaData, Table, Index, select
+from sqlalchemy.orm import configure_mappers
 from sqlalchemy.sql import text, and_, or_
 from wtforms import SubmitField, SelectField, SelectMultipleField, StringField, HiddenField
 from wtforms.validators import DataRequired, Email
 
-from src.openai_funcs import topic_summary, comparator_summary
+from src.openai_funcs import generate_table_summary, stream_topic_summary, stream_comparator_summary, summarise_topics, summarise_comparator, format_summary
 from src.supporter_funcs import *
+from src.sweep_funcs import sweep_candidates, run_sweep, SWEEP_WORKERS, SWEEP_TIME_BUDGET, SWEEP_PATIENCE
+from src.bundle_funcs import BUNDLE_DIR, bundle_path, has_bundle, read_bundle, write_bundle, import_bundle
+from src.admission_funcs import admission_classes, admission_stats, ADMISSION_RETRY_AFTER
+from src.profile_funcs import Sampler, profile_token, valid_token, folded, speedscope, save_profile, list_profiles, load_profile, PROFILE_SAMPLE_RATE
+from src.search_funcs import build_index, bm25_search, SEARCH_LIMIT
+from src.stub_funcs import record_stub, flush_stubs, read_queue, start_stub_flusher, STUB_FLUSH_INTERVAL
+from src.report_funcs import parse_comparators, new_report_id, report_path, write_progress, read_progress, prune_reports, run_comparators, write_report, REPORT_WORKERS, REPORT_JOBS
+from src.replay_funcs import parse_log, traffic_model, split_model, replay, replay_report
+from src.cache_funcs import CACHE_BACKEND, LRUCache, cached, locked, get_cached, store, is_cached, clear_caches, read_s3_parquet, top_datasets, load_hits, record_hit, request_started, request_finished, start_cache_warmer
 
 app = Flask(__name__)
 
@@ -50,9 +68,83 @@ def unhandled_exception(e):
 
 @app.before_request
 def log_request_info():
+    app.logger.info('Request: %s %s', request.method, request.full_path.rstrip("?")) # parsed by the replay command
     app.logger.info('Headers: %s', request.headers)
     app.logger.info('Body: %s', request.get_data())
 
+cache_warmer = []
+stub_flusher = []
+
+@app.before_request
+def track_request():
+    request_started()
+    if not cache_warmer and os.getenv("CACHE_WARM", "true").lower() == "true": # started from the first request so each forked worker gets its own thread
+        cache_warmer.append(start_cache_warmer(warm_dataset, logger=app.logger))
+    if not stub_flusher and STUB_FLUSH_INTERVAL:
+        stub_flusher.append(start_stub_flusher(logger=app.logger))
+
+RECOMPUTE_ROUTES = ["custom_cluster_size_dashboard", "custom_cluster_size_comparator_dashboard"]
+LLM_ROUTES = ["summary_stream", "dashboard", "comparator_dashboard"]
+
+def request_class():
+    """
+    Admission class of the current request. Recompute routes whose clusters are already cached or stored count as reads, and
+    dashboards only count as LLM requests when summaries are generated during the request rather than streamed.
+    """
+    if request.endpoint in (None, "static"):
+        return None
+    if request.endpoint in RECOMPUTE_ROUTES:
+        file_name, custom_size = request.view_args["file_name"], request.view_args["new_min_cluster_size"]
+        if custom_size.isdigit() and not is_cached("labels", (file_name, str(int(custom_size)))) and not has_custom_clusters(file_name, int(custom_size)):
+            return "recompute"
+    elif request.endpoint == "summary_stream" or (request.endpoint in LLM_ROUTES and not STREAM_SUMMARIES):
+        return "llm"
+    return "reads"
+
+@app.before_request
+def admit_request():
+    """
+    Limits the requests of each class running at once so a burst of recomputes or LLM calls can't hold every worker thread,
+    requests over the limit queue briefly and are then shed with a 429.
+    """
+    name = request_class()
+    if name is None:
+        return None
+    if not admission_classes[name].acquire():
+        app.logger.warning('Shed %s request %s', name, request.path)
+        retry_after = ADMISSION_RETRY_AFTER if name != "reads" else 1
+        return f"Server busy, please retry in {retry_after} seconds", 429, {"Retry-After": str(retry_after)}
+    g.admission_class = name
+
+@app.teardown_request
+def finish_request(error=None):
+    request_finished()
+    name = g.pop("admission_class", None)
+    if name:
+        admission_classes[name].release()
+
+def profile_requested():
+    """
+    Profiling is off unless the request carries a valid X-Profile header or profile query flag (see the profile-token
+    command), or is one of the PROFILE_SAMPLE_RATE share of requests picked at random.
+    """
+    token = request.headers.get("X-Profile") or request.args.get("profile")
+    return valid_token(token, request.path) or (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE)
+
+@app.before_request
+def start_profile():
+    if request.endpoint not in (None, "static") and profile_requested():
+        g.profiler = Sampler(threading.get_ident()).start()
+
+@app.teardown_request
+def finish_profile(error=None):
+    sampler = g.pop("profiler", None)
+    if sampler:
+        stacks = sampler.stop()
+        view_args = request.view_args or {}
+        profile_id = save_profile({"route": request.endpoint, "file_name": view_args.get("file_name"), "path": request.path, "started": sampler.started, "duration": sampler.duration}, stacks)
+        app.logger.info('Saved profile %s for %s (%.2fs)', profile_id, request.path, sampler.duration)
+
 class Params(db.Model):
     __tablename__ = "best_parameters"
     id = db.Column(db.String(100), primary_key=True)
@@ -62,6 +154,7 @@ class Params(db.Model):
     cluster_selection_epsilon = db.Column(db.Float)
     metric = db.Column(db.String(25))
     score = db.Column(db.Float)
+    algorithm = db.Column(db.String(25)) # optional HDBSCAN algorithm override, chosen from the dataset size when null
 
 def ResultsTableName(file_name):        
     class Results(db.Model):
@@ -137,52 +230,325 @@ def customAuthorsTablename(file_name):
         avg_cites_per_article = db.Column(db.Integer)
     return customAuthors
 
+FORM_DATA_SNAPSHOT = os.getenv("FORM_DATA_SNAPSHOT", os.path.join(basedir, "form_data.json"))
+FORM_DATA_TTL = int(os.getenv("FORM_DATA_TTL", 86400))
+
+form_data = {}
+form_data_lock = threading.Lock()
+
 def create_form_data():
-    with app.app_context():
-        df1 = wr.s3.read_csv("s3://rootbucket/topic_clustering/form_data/title_pub_subject.csv")
-        df2 = wr.s3.read_csv("s3://rootbucket/topic_clustering/form_data/countries.csv")
-
-        subjects = sorted(df1.subject_cat_desc.unique().tolist())
-        countries = df2.prid_country.unique().tolist()
-        countries.insert(0, '')
-        publishers = sorted(pd.DataFrame(df1.groupby("publisher_group").size()).reset_index().sort_values(0, ascending=False).head(15).publisher_group.tolist())
-        publishers = [x.title() for x in publishers]
-        publishers.insert(0, '')
-        initalised_comparitors = sorted(df1[df1.subject_cat_desc == subjects[0]].full_source_title.unique().tolist())
-        initalised_comparitors = [x.title() for x in initalised_comparitors]
-        initalised_comparitors.insert(0, '')
-        return subjects, countries, publishers, initalised_comparitors
+    """
+    Builds the form choices from the S3 form_data csv's.
+
+    Returns:
+    dict: subjects, countries, publishers, initalised_comparitors and the comparitors available for every subject.
+    """
+    import awswrangler as wr
+
+    df1 = wr.s3.read_csv("s3://rootbucket/topic_clustering/form_data/title_pub_subject.csv")
+    df2 = wr.s3.read_csv("s3://rootbucket/topic_clustering/form_data/countries.csv")
+
+    subjects = sorted(df1.subject_cat_desc.unique().tolist())
+    countries = df2.prid_country.unique().tolist()
+    countries.insert(0, '')
+    publishers = sorted(pd.DataFrame(df1.groupby("publisher_group").size()).reset_index().sort_values(0, ascending=False).head(15).publisher_group.tolist())
+    publishers = [x.title() for x in publishers]
+    publishers.insert(0, '')
+    initalised_comparitors = sorted(df1[df1.subject_cat_desc == subjects[0]].full_source_title.unique().tolist())
+    initalised_comparitors = [x.title() for x in initalised_comparitors]
+    initalised_comparitors.insert(0, '')
+    comparitors_by_subject = {subject: sorted(group.unique().tolist()) for subject, group in df1.groupby("subject_cat_desc").full_source_title}
+    return {
+        "subjects": subjects,
+        "countries": countries,
+        "publishers": publishers,
+        "initalised_comparitors": initalised_comparitors,
+        "comparitors_by_subject": comparitors_by_subject,
+    }
+
+def refresh_form_data():
+    """
+    Reloads the form data from S3 and rewrites the local snapshot, failures are logged and the current data is kept.
+    """
+    try:
+        data = create_form_data()
+    except Exception as e:
+        app.logger.error('Form data refresh failed: %s', e)
+        return form_data
+    data["loaded_at"] = datetime.datetime.now().timestamp()
+    try:
+        with open(FORM_DATA_SNAPSHOT, "w") as f:
+            json.dump(data, f)
+    except OSError as e:
+        app.logger.error('Unable to write form data snapshot: %s', e)
+    form_data.update(data)
+    return form_data
+
+class FormDataUnavailable(Exception):
+    """
+    Raised when the form data is needed but there is no snapshot and S3 can't be read, answered with a 503.
+    """
+
+def get_form_data():
+    """
+    Returns the form data without blocking on S3 where possible.
+
+    The in memory copy is used first, then the local snapshot (S3 is only hit on the very first boot without one, and
+    FormDataUnavailable is raised if that fails).
+    Stale data is served while a background thread refreshes it, unless it was preloaded by the gunicorn master, which
+    then refreshes it and replaces the workers (see preload_reference_data).
+    """
+    with form_data_lock:
+        if not form_data and os.path.exists(FORM_DATA_SNAPSHOT):
+            with open(FORM_DATA_SNAPSHOT) as f:
+                form_data.update(json.load(f))
+        if not form_data and not refresh_form_data():
+            raise FormDataUnavailable("No form data snapshot and the form data could not be read from S3")
+        if not reference_data_preloaded and datetime.datetime.now().timestamp() - form_data.get("loaded_at", 0) > FORM_DATA_TTL:
+            form_data["loaded_at"] = datetime.datetime.now().timestamp() # stops every request in the refresh window starting its own thread
+            threading.Thread(target=refresh_form_data, daemon=True).start()
+        return form_data
+
+@app.errorhandler(FormDataUnavailable)
+def form_data_unavailable(e):
+    app.logger.error('Form data unavailable: %s', e)
+    return "The form choices could not be loaded, please retry shortly", 503, {"Retry-After": "60"}
+
+country_lookup = {}
+
+def load_country_lookup():
+    """
+    Reads the prid_country to geojson country name lookup used by the choropleth from S3.
+    """
+    import awswrangler as wr
+
+    lookup = wr.s3.read_csv("s3://rootbucket/topic_clustering/test_folder/country_lookup.csv").drop_duplicates("country")
+    return dict(zip(lookup["country"], lookup["geojson"]))
+
+def get_country_lookup():
+    if not country_lookup:
+        country_lookup.update(load_country_lookup())
+    return country_lookup
+
+PRELOAD_MODULES = [module for module in os.getenv("PRELOAD_MODULES", "awswrangler,pyarrow.parquet,hdbscan,langchain.llms.openai,langchain.chains.summarize").split(",") if module]
+reference_data_preloaded = []
+
+def preload_reference_data(refresh=False):
+    """
+    Loads the read only data and modules every worker needs. Called in the gunicorn master (preload_app, see
+    gunicorn.conf.py) so it is loaded once and shared copy-on-write by the forked workers rather than once per worker.
+
+    Parameters:
+    refresh (bool): Reload the form data and country lookup from S3, done in the master before it replaces the workers.
+
+    Notes:
+    - PRELOAD_MODULES are the heavy modules the routes import lazily, any that are not installed are skipped.
+    - The ORM mappers are configured and the engine is created, but not connected, so no connection is shared by the workers.
+    - The loaded objects are frozen out of the garbage collector, otherwise the first collection in each worker writes
+      to every object's header and copies the shared pages.
+    """
+    for module in PRELOAD_MODULES:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            app.logger.warning('Not preloading %s: %s', module, e)
+    if refresh:
+        gc.unfreeze() # lets the replaced data be collected
+        refresh_form_data()
+    try:
+        get_form_data()
+    except FormDataUnavailable as e:
+        app.logger.error('Unable to preload the form data, workers will retry: %s', e)
+    try:
+        if refresh:
+            country_lookup.update(load_country_lookup())
+        get_country_lookup()
+    except Exception as e:
+        app.logger.error('Unable to preload the country lookup: %s', e)
+    configure_mappers()
+    db.engine
+    gc.collect()
+    gc.freeze()
+    if not reference_data_preloaded:
+        reference_data_preloaded.append(datetime.datetime.now().timestamp())
 
 class QuestionForm(FlaskForm):
-    subjects, countries, publishers, initalised_comparitors = create_form_data()
-    subject = SelectField("Select the subject category of interest", choices = subjects, validators=[DataRequired()])
+    subject = SelectField("Select the subject category of interest", choices = [], validators=[DataRequired()])
     pub_years = SelectMultipleField(
         "Select the article publication years of interest (individual years or JCR pairs)",
         choices=list(range(2018, datetime.datetime.now().year)),
         coerce=int,
         validators=[DataRequired()]
     )
-    country = SelectField("Select a country of interest or leave blank include all countries", choices = countries)
+    country = SelectField("Select a country of interest or leave blank include all countries", choices = [])
     region = SelectField(
         "Select a region of interest, or leave blank", choices=["","Africa & Middle East","Asia","Australasia","Central & South America","Europe","North America", "TA7"]
     )
     publisher = SelectField(
         "Select either a publisher of interest, or leave blank",
-        choices= publishers,
+        choices= [],
     )
     comparitor = SelectField(
         "Select a journal to compare against the selected subject category",
-        choices = [x.upper() for x in initalised_comparitors],
+        choices = [],
         coerce=str
     )
     submit = SubmitField("Submit")
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # choices are populated per instance so importing the app never touches S3
+        data = get_form_data()
+        self.subject.choices = data["subjects"]
+        self.country.choices = data["countries"]
+        self.publisher.choices = data["publishers"]
+        self.comparitor.choices = [x.upper() for x in data["initalised_comparitors"]]
+
 class EmailForm(FlaskForm):
     user_email = StringField("Enter your email here:", validators=[Email()])
     file_name = HiddenField()
     email_submit = SubmitField("Submit")
 
+def load_bundle(file_name):
+    """
+    Reads a dataset's local bundle, cached per worker. Summaries saved in the bundle are added to the summaries cache when it is first read.
+    """
+    def read():
+        bundle = read_bundle(bundle_path(file_name))
+        for summary in bundle["summaries"]:
+            key = summary_key(file_name, None, summary["comparator_type"], summary["comparator"])
+            if get_cached("summaries", key) is None:
+                store("summaries", key, summary["sentences"])
+        return bundle
+    return cached("bundles", (file_name,), read)
+
+def dataset_source(file_name):
+    """
+    Where a dataset is served from: a local bundle, its own tables in the database, or composed from per year shards.
+    """
+    if has_bundle(file_name):
+        return "bundle"
+    def find():
+        engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"], echo=True)
+        if not inspect(engine).has_table(file_name.replace(".parquet", ""), schema="clustering_data") and search_shards(file_name):
+            return "shards"
+        return "database"
+    return cached("sources", (file_name,), find)
+
+def has_dataset(file_name):
+    """
+    Whether a dataset can be served, from a bundle, its own clustering table or its year shards.
+    """
+    if dataset_source(file_name) != "database":
+        return True
+    engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"], echo=True)
+    return inspect(engine).has_table(file_name.replace(".parquet", ""), schema="clustering_data")
+
+def read_shards(folder, file_name, columns):
+    frames = [read_s3_parquet("rootbucket", f"topic_clustering/test_folder/shards/{folder}/{shard}", columns) for shard in shard_files(file_name)]
+    return pd.concat(frames, ignore_index=True)
+
+def read_assignments(file_name):
+    engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"], echo=True)
+    if not inspect(engine).has_table("assignments", schema="cluster_assignments"):
+        return pd.DataFrame(columns=["dataset", "doi", "cluster_label", "exemplar", "gpt_label"])
+    assignments = Table("assignments", MetaData(), schema="cluster_assignments", autoload_with=engine)
+    return pd.read_sql(select(assignments).where(assignments.c.dataset == file_name), engine)
+
+def assignments_index(table):
+    return Index("ix_assignments_dataset_doi", table.c.dataset, table.c.doi, unique=True)
+
+def write_assignments(file_name, cluster_labels):
+    """
+    Replaces the cluster assignments of a year combination in one transaction, so readers see either the old or the new
+    assignments and a failed write (which is raised) leaves the old ones in place. Each doi is assigned once per combination.
+    """
+    engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"], echo=True)
+    assignments = cluster_labels[["doi", "cluster_label", "exemplar", "gpt_label"]].assign(dataset=file_name)[["dataset", "doi", "cluster_label", "exemplar", "gpt_label"]]
+    with engine.begin() as connection:
+        if not inspect(connection).has_table("assignments", schema="cluster_assignments"):
+            assignments.head(0).to_sql("assignments", connection, schema="cluster_assignments", index=False)
+            assignments_index(Table("assignments", MetaData(), schema="cluster_assignments", autoload_with=connection)).create(connection)
+        table = Table("assignments", MetaData(), schema="cluster_assignments", autoload_with=connection)
+        connection.execute(table.delete().where(table.c.dataset == file_name))
+        assignments.to_sql("assignments", connection, schema="cluster_assignments", if_exists="append", index=False)
+
+def composed_params(file_name):
+    """
+    Parameters for a dataset composed from shards. A combination that has not been clustered before takes the best parameters
+    of its first shard that has them, with min_cluster_size scaled by the number of years, and they are saved to best_parameters.
+    """
+    row = db.session.query(Params).filter_by(id=file_name).first()
+    if row is None:
+        shard_rows = [db.session.query(Params).filter_by(id=shard).first() for shard in shard_files(file_name)]
+        shard_row = next((shard_row for shard_row in shard_rows if shard_row is not None), None)
+        if shard_row is None:
+            raise ValueError(f"No best parameters for {file_name} or any of its shards")
+        row = Params(
+            id=file_name,
+            min_cluster_size=shard_row.min_cluster_size * len(shard_rows),
+            min_samples=shard_row.min_samples,
+            cluster_selection_method=shard_row.cluster_selection_method,
+            cluster_selection_epsilon=shard_row.cluster_selection_epsilon,
+            metric=shard_row.metric,
+            score=None,
+            algorithm=shard_row.algorithm,
+        )
+        db.session.add(row)
+        db.session.commit()
+    return {c.key: getattr(row, c.key) for c in inspect(row).mapper.column_attrs}
+
+def compose_cluster_labels(file_name):
+    """
+    Builds the clustering data for a multi year dataset from the per year shards.
+
+    The articles of each year are stored once (shards/umaps/{subject}_{year}.parquet, projected with one UMAP model per
+    subject) and only the cluster assignments are kept per year combination, in the shared cluster_assignments.assignments
+    table. A combination that has never been seen is clustered and labelled here, nothing else is materialised for it.
+    This is single flight (see locked), callers that waited for another to cluster the combination read its assignments.
+    """
+    articles = read_shards("umaps", file_name, ARTICLE_COLUMNS).drop_duplicates("doi", ignore_index=True)
+    articles["prid_country"] = articles["prid_country"].apply(lambda x: str(x))
+    articles["prid_region"] = articles["prid_region"].apply(lambda x: str(x))
+    assignments = read_assignments(file_name)
+    if assignments.empty:
+        with locked("assignments", (file_name,)):
+            assignments = read_assignments(file_name)
+            if assignments.empty:
+                cluster_labels, x, y = get_cluster_labels(articles.copy(), composed_params(file_name))
+                topic_labels, calls_saved = relabel_clusters(cluster_labels, None)
+                cluster_labels = cluster_labels.merge(topic_labels, on="cluster_label", how="left")
+                cluster_labels["gpt_label"] = cluster_labels["gpt_label"].apply(
+                    lambda x: re.sub(r'[^\w\s]', '', x) if not pd.isna(x) else x
+                )
+                write_assignments(file_name, cluster_labels)
+                app.logger.info('Clustered new year combination %s from %s shards', file_name, len(shard_files(file_name)))
+                return cluster_labels
+    cluster_labels = articles.merge(assignments.drop(columns="dataset"), on="doi", how="inner")
+    cluster_labels["exemplar"] = cluster_labels["exemplar"].astype(bool)
+    return cluster_labels
+
+def load_authors_frame(file_name):
+    """
+    Grouped authors for a dataset served from a bundle or shards, shard authors are grouped against the composed clustering data.
+    """
+    if dataset_source(file_name) == "bundle":
+        return load_bundle(file_name)["authors"]
+    return cached("authors", (file_name,), lambda: group_authors(load_cluster_labels(file_name), read_shards("authors", file_name, AUTHOR_COLUMNS)))
+
+def load_summary_cube(file_name):
+    """
+    Summary cube for a dataset served from a bundle or shards, the cube of a composed dataset is built in memory.
+    """
+    if dataset_source(file_name) == "bundle":
+        return load_bundle(file_name)["summary_cube"]
+    return cached("cubes", (file_name,), lambda: build_summary_cube(load_cluster_labels(file_name), countries=get_form_data()["countries"]))
+
 def get_params(file_name):
+    if dataset_source(file_name) == "bundle":
+        return dict(load_bundle(file_name)["params"])
+    if dataset_source(file_name) == "shards":
+        return composed_params(file_name)
     with app.app_context():
         def object_as_dict(obj):
             return {
@@ -191,25 +557,190 @@ def get_params(file_name):
             }   
     return object_as_dict(db.session.query(Params).filter_by(id=file_name).first_or_404())
 
-def database_write(df, table, schema):
+def database_write(df, table, schema, index_columns=None, if_exists='fail'):
     engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"], echo=True)
     try:
-        df.to_sql(table, engine, schema = schema, if_exists = 'fail', index=False)
+        df.to_sql(table, engine, schema = schema, if_exists = if_exists, index=False)
+        if index_columns and if_exists != 'append':
+            written = Table(table, MetaData(), schema=schema, autoload_with=engine)
+            Index(f"ix_{table}", *[written.c[col] for col in index_columns]).create(engine)
         return True
     except:
         return False
 
-def init_db_and_get_labels_params(file_name, custom=False, custom_size=None):
+def write_tables(writes):
+    """
+    Writes several tables in one transaction, so readers never see some of them updated and the others not.
+
+    Parameters:
+    writes (list): (df, table, schema, if_exists, index_columns) tuples, written in order. if_exists is append to add the
+                   rows or replace to swap the table's rows for them. Existing tables keep their keys and indexes, missing
+                   ones are created with an index on index_columns (if any).
+
+    Notes:
+    Raises RuntimeError naming the table if a write fails, nothing is changed in that case.
+    """
     engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"], echo=True)
-    if custom == False:
-        params = get_params(file_name)
-        cluster_labels = pd.read_sql_table(file_name.replace(".parquet", ""), engine, schema="clustering_data")
-    elif custom == True:
-        params = get_params(file_name)
-        cluster_labels = pd.read_sql_table(f"[{custom_size}]"+file_name.replace(".parquet", ""), engine, schema="custom_clustering_data")
+    with engine.begin() as connection:
+        for df, table, schema, if_exists, index_columns in writes:
+            try:
+                if inspect(connection).has_table(table, schema=schema):
+                    if if_exists == 'replace':
+                        connection.execute(Table(table, MetaData(), schema=schema, autoload_with=connection).delete())
+                    df.to_sql(table, connection, schema=schema, if_exists='append', index=False)
+                else:
+                    df.to_sql(table, connection, schema=schema, index=False)
+                    if index_columns:
+                        written = Table(table, MetaData(), schema=schema, autoload_with=connection)
+                        Index(f"ix_{table}", *[written.c[col] for col in index_columns]).create(connection)
+            except Exception as e:
+                raise RuntimeError(f"Unable to write {schema}.{table}: {e}") from e
+
+def load_cluster_labels(file_name, custom=False, custom_size=None):
+    """
+    Reads the clustering data for a dataset, cached per worker. The frame is shared between requests so must not be modified in place.
+    """
+    def read():
+        if custom == False and dataset_source(file_name) == "bundle":
+            return load_bundle(file_name)["articles"]
+        if custom == False and dataset_source(file_name) == "shards":
+            return compose_cluster_labels(file_name)
+        engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"], echo=True)
+        if custom == False:
+            return pd.read_sql_table(file_name.replace(".parquet", ""), engine, schema="clustering_data")
+        return pd.read_sql_table(f"[{custom_size}]"+file_name.replace(".parquet", ""), engine, schema="custom_clustering_data")
+    return cached("labels", (file_name, str(custom_size) if custom else None), read)
+
+def init_db_and_get_labels_params(file_name, custom=False, custom_size=None):
+    params = get_params(file_name)
+    cluster_labels = load_cluster_labels(file_name, custom, custom_size)
     return cluster_labels, params
-    
 
+def summary_key(file_name, custom_size=None, comparator_type="subject", comparator=""):
+    return (file_name, str(custom_size) if custom_size else None, comparator_type, comparator)
+
+def log_summary_usage(name, summary):
+    sentences, usage = summary
+    app.logger.info('Summary of %s (%s): %s calls, %s prompt and %s completion tokens in %.2fs', name, usage["mode"], usage["calls"], usage["prompt_tokens"], usage["completion_tokens"], usage["seconds"])
+    return format_summary(sentences)
+
+def cached_topic_summary(file_name, cluster_labels, topic_table, custom_size=None):
+    if topic_table is None:
+        topic_table = generate_table_summary(cluster_labels)
+    return cached("summaries", summary_key(file_name, custom_size), lambda: log_summary_usage(file_name, summarise_topics(topic_table)))
+
+def cached_comparator_summary(file_name, comparator_type, comparator, topic_table, comparator_table, custom_size=None):
+    return cached("summaries", summary_key(file_name, custom_size, comparator_type, comparator), lambda: log_summary_usage(f"{file_name} against {comparator_type} {comparator}", summarise_comparator(topic_table, comparator_table)))
+
+def warm_dataset(file_name, comparator_type=None, comparator=None):
+    """
+    Populates the label frame, aggregate and summary caches for a dataset, used by the cache warmer.
+    """
+    with app.app_context():
+        cluster_labels = load_cluster_labels(file_name)
+        if comparator_type:
+            topic_table, comparator_table = get_summary_tables(file_name, cluster_labels, comparator_type, comparator)
+            cached_comparator_summary(file_name, comparator_type, comparator, topic_table, comparator_table)
+        else:
+            topic_table, _ = get_summary_tables(file_name, cluster_labels)
+        cached_topic_summary(file_name, cluster_labels, topic_table)
+        load_search_index(file_name)
+
+
+def write_summary_cube(cluster_labels, table, schema, if_exists='fail'):
+    """
+    Builds the summary cube for a dataset and writes it alongside the clustering data, indexed by comparator.
+    """
+    cube = build_summary_cube(cluster_labels, countries=get_form_data()["countries"])
+    database_write(cube, table, schema, index_columns=["comparator_type", "comparator"], if_exists=if_exists)
+    return cube
+
+def comparator_predicate(columns, comparator_type, comparator):
+    """
+    SQL version of filter_comparator's (substring) matching rules, for the columns of a clustering data table.
+    """
+    if comparator_type == "journal":
+        return columns.full_source_title.contains(comparator, autoescape=True)
+    elif comparator_type == "publisher":
+        return columns.publisher_group == comparator.upper()
+    elif comparator_type == "region" and comparator == "TA7":
+        return or_(*[columns.prid_country.contains(country, autoescape=True) for country in TA7])
+    elif comparator_type == "region":
+        return columns.prid_region.contains(comparator, autoescape=True)
+    elif comparator_type == "country":
+        return columns.prid_country.contains(comparator, autoescape=True)
+    return None
+
+def sql_table_summary(file_name, comparator_type="subject", comparator="", custom=False, custom_size=None):
+    """
+    Builds the generate_table_summary output for a dataset (and optionally a comparator) in the database.
+
+    Only the article counts and citation totals by gpt_label and year_published are returned by the query, in the layout of
+    the summary cube, so the table is never loaded and summary_from_cube does the pivot and growth on the grouped rows.
+    """
+    engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"], echo=True)
+    table = (f"[{custom_size}]" if custom else "") + file_name.replace(".parquet", "")
+    articles = Table(table, MetaData(), schema="custom_clustering_data" if custom else "clustering_data", autoload_with=engine)
+    query = select(
+        articles.c.gpt_label,
+        articles.c.year_published,
+        func.count().label("count"),
+        func.sum(articles.c.citations).label("citations_sum"),
+        func.count(articles.c.citations).label("citations_count"),
+    ).group_by(articles.c.gpt_label, articles.c.year_published)
+    predicate = comparator_predicate(articles.c, comparator_type, comparator)
+    if predicate is not None:
+        query = query.where(predicate)
+    return summary_from_cube(pd.read_sql(query, engine))
+
+def get_summary_tables(file_name, cluster_labels, comparator_type="subject", comparator="", custom=False, custom_size=None):
+    return cached("aggregates", (file_name, str(custom_size) if custom else None, comparator_type, comparator),
+                  lambda: read_summary_tables(file_name, cluster_labels, comparator_type, comparator, custom, custom_size))
+
+def read_summary_tables(file_name, cluster_labels, comparator_type="subject", comparator="", custom=False, custom_size=None):
+    """
+    Returns the subject and comparator summary tables (as generate_table_summary would produce) for a dashboard.
+
+    The rows for the subject and the comparator are looked up in the dataset's summary cube, datasets written before the
+    cube existed have it built from cluster_labels and stored on first use. Datasets served from a bundle or shards use
+    load_summary_cube. Comparators that are not in the cube (e.g. a partial journal name) are summarised in the database
+    by sql_table_summary, or from cluster_labels for bundles and shards.
+
+    cluster_labels may be None, it is then only loaded if the cube has to be built or the dataset is not in the database.
+    """
+    table = (f"[{custom_size}]" if custom else "") + file_name.replace(".parquet", "")
+    schema = "custom_summary_cube" if custom else "summary_cube"
+    key = cube_key(comparator_type, comparator)
+
+    engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"], echo=True)
+    if not custom and dataset_source(file_name) != "database":
+        cube = load_summary_cube(file_name)
+    elif inspect(engine).has_table(table, schema=schema):
+        cube_table = Table(table, MetaData(), schema=schema, autoload_with=engine)
+        query = select(cube_table).where(or_(
+            cube_table.c.comparator_type == "subject",
+            and_(cube_table.c.comparator_type == comparator_type, cube_table.c.comparator == key),
+        ))
+        cube = pd.read_sql(query, engine)
+    else:
+        if cluster_labels is None:
+            cluster_labels = load_cluster_labels(file_name, custom, custom_size)
+        cube = write_summary_cube(cluster_labels, table, schema)
+
+    topic_table = summary_from_cube(cube[cube["comparator_type"] == "subject"])
+    if comparator_type == "subject":
+        return topic_table, None
+
+    comparator_rows = cube[(cube["comparator_type"] == comparator_type) & (cube["comparator"] == key)]
+    if len(comparator_rows) > 0:
+        comparator_table = summary_from_cube(comparator_rows)
+    elif custom or dataset_source(file_name) == "database":
+        comparator_table = sql_table_summary(file_name, comparator_type, comparator, custom, custom_size)
+    else:
+        if cluster_labels is None:
+            cluster_labels = load_cluster_labels(file_name, custom, custom_size)
+        comparator_table = generate_table_summary(filter_comparator(cluster_labels, comparator_type, comparator))
+    return topic_table, comparator_table
 
 def get_tables(file_name, custom=False):
     if custom == False:
@@ -237,7 +768,7 @@ def home():
 
         file_name = gen_file_name(subject, pub_years)
         app.logger.info('File name created')
-        search = search_s3(file_name)
+        search = search_s3(file_name) or search_shards(file_name)
         app.logger.info('Search complete')
 
         if search == True:
@@ -269,16 +800,16 @@ def email_submit():
     file_name = request.form.get("file_name")
     user_email = request.form.get("user_email")
     
-    write_stub_s3(file_name, user_email)
+    record_stub(file_name, user_email)
     
     return jsonify({"message": "Data processed successfully."})
 
 @app.route("/check_s3/<file_name>", methods=["GET"])
 def check_s3(file_name):
     try:
-        search = search_s3(file_name)
+        search = search_s3(file_name) or search_shards(file_name)
         if search == False:
-            write_stub_s3(file_name, "None")
+            record_stub(file_name, "None")
         return jsonify({"exists": search}), 200
     except:
         print(f"Error: {e}")
@@ -290,8 +821,7 @@ def get_comparitors(subject):
     Route used to get the comparitors for the selected subject category - fetched by the main page to enable dynamic form choices
     """
     with app.app_context():
-        df = pd.read_csv("s3://rootbucket/topic_clustering/form_data/title_pub_subject.csv")
-        comparitors = sorted(df[df.subject_cat_desc == subject].full_source_title.unique().tolist())
+        comparitors = list(get_form_data()["comparitors_by_subject"].get(subject, []))
         comparitors.insert(0, '')
         
         comparitorList = []
@@ -312,129 +842,272 @@ def get_comparitors(subject):
 
         return jsonify({"comparitors":comparitorList}), 200
 
-@app.route('/dashboard/<file_name>')
-def dashboard(file_name):
-    cluster_labels, params = init_db_and_get_labels_params(file_name)
-    summary = topic_summary(cluster_labels)
-    exemplarsTable, authorsTable = get_tables(file_name)
-    exemplars = db.session.query(exemplarsTable).filter_by(exemplar=True).order_by(text("cluster_label")).all()
-    authors = db.session.query(authorsTable).order_by(text("gpt_label, avg_cites_per_article desc")).all()
-    return render_template("results.html", file_name=file_name, params=params, exemplars=exemplars, summary=summary, authors=authors, clusters=sorted([str(x) for x in cluster_labels.gpt_label.unique().tolist()]))
-        
-@app.route('/comparator_dashboard/<file_name>/<comparator_type>/<comparator>')
-def comparator_dashboard(file_name, comparator_type, comparator):
+DASHBOARD_THREADS = int(os.getenv("DASHBOARD_THREADS", 8))
+DASHBOARD_QUERY_TIMEOUT = int(os.getenv("DASHBOARD_QUERY_TIMEOUT", 60))
+DASHBOARD_SUMMARY_TIMEOUT = int(os.getenv("DASHBOARD_SUMMARY_TIMEOUT", 90))
+STREAM_SUMMARIES = os.getenv("STREAM_SUMMARIES", "true").lower() == "true"
+SUMMARY_UNAVAILABLE = ["The GPT summary is taking longer than expected, please refresh the page to try again."]
+
+dashboard_executor = ThreadPoolExecutor(max_workers=DASHBOARD_THREADS)
+
+def run_stages(stages):
+    """
+    Runs independent dashboard stages at the same time.
+
+    Parameters:
+    stages (dict): Stage name to a tuple of (function, timeout in seconds, fallback). The fallback is returned if the stage
+                   times out, a fallback of None means the timeout is raised.
+
+    Returns:
+    dict: Stage name to the stage result.
+
+    Notes:
+    - Each stage runs in its own app context, and so its own database session, on the shared dashboard thread pool.
+    - Stage timings are logged so slow stages can be picked out of application.log.
+    """
+    def run(name, stage):
+        start = time.time()
+        with app.app_context():
+            try:
+                return stage()
+            finally:
+                app.logger.info('Dashboard stage %s took %.2fs', name, time.time() - start)
+
+    started = time.time()
+    futures = {name: dashboard_executor.submit(run, name, stage) for name, (stage, timeout, fallback) in stages.items()}
+    results = {}
+    for name, (stage, timeout, fallback) in stages.items():
+        try:
+            results[name] = futures[name].result(timeout=max(started + timeout - time.time(), 0))
+        except FuturesTimeoutError:
+            app.logger.error('Dashboard stage %s timed out after %ss', name, timeout)
+            if fallback is None:
+                raise
+            results[name] = fallback
+    return results
+
+def authors_query(authorsTable, comparator_type=None, comparator=None):
+    query = db.session.query(authorsTable)
     if comparator_type == "journal":
-        return journal_logic(file_name, comparator, comparator_type)
+        query = query.filter(authorsTable.full_source_title_list.contains("'"+str(comparator)+"'"))
     elif comparator_type == "publisher":
-        return publisher_logic(file_name, comparator, comparator_type)
+        query = query.filter(authorsTable.publisher_group_list.contains("'"+str(comparator.upper())+"'"))
+    elif comparator_type == "region" and comparator == "TA7":
+        query = query.filter(or_(*[authorsTable.prid_country.contains(country) for country in TA7]))
     elif comparator_type == "region":
-        return region_logic(file_name, comparator, comparator_type)
+        query = query.filter_by(prid_region=comparator)
     elif comparator_type == "country":
-        return country_logic(file_name, comparator, comparator_type)
-    else:
-        return "Invalid comparator type", 400
-
-def journal_logic(file_name, journal, comparator_type):
-    cluster_labels, params = init_db_and_get_labels_params(file_name)
-    summary = topic_summary(cluster_labels)
-    exemplarsTable, authorsTable = get_tables(file_name)
+        query = query.filter_by(prid_country=comparator)
+    return query.order_by(text("gpt_label, avg_cites_per_article desc")).all()
 
-    cluster_labels_journal = cluster_labels[cluster_labels["full_source_title"].apply(lambda x: journal in x)]
-    comp_summary = comparator_summary(cluster_labels, cluster_labels_journal)
+def render_dashboard(file_name, comparator_type=None, comparator=None, custom=False, custom_size=None, params=None):
+    """
+    Builds and renders the dashboard for a dataset, optionally against a comparator.
 
-    exemplars = db.session.query(exemplarsTable).filter(and_(exemplarsTable.full_source_title == journal, exemplarsTable.exemplar == True)).order_by(text("cluster_label")).all()
-    authors = db.session.query(authorsTable).filter(authorsTable.full_source_title_list.contains("'"+str(journal)+"'")).order_by(text("gpt_label, avg_cites_per_article desc")).all()
-    return render_template("results_comparator.html", file_name=file_name, params=params, exemplars=exemplars, summary=summary, authors=authors, clusters=sorted([str(x) for x in cluster_labels.gpt_label.unique().tolist()]), comparator = journal, comp_summary = comp_summary, comparator_type = comparator_type)
+    The clustering data and summary tables are loaded first (usually from cache) and the exemplars are taken from the same
+    frame, after which the GPT summaries and the author query don't depend on each other and are run concurrently with run_stages.
+    """
+    cluster_labels, base_params = init_db_and_get_labels_params(file_name, custom=custom, custom_size=custom_size)
+    params = params or base_params
+    topic_table, comparator_table = get_summary_tables(file_name, cluster_labels, comparator_type or "subject", comparator or "", custom=custom, custom_size=custom_size)
+    exemplars = get_exemplars(cluster_labels, comparator_type, comparator)
+    if not custom and dataset_source(file_name) != "database":
+        authors = lambda: filter_authors(load_authors_frame(file_name), comparator_type, comparator)
+    else:
+        exemplarsTable, authorsTable = get_tables(f"[{custom_size}]"+file_name if custom else file_name, custom=custom)
+        authors = lambda: authors_query(authorsTable, comparator_type, comparator)
+
+    stages = {
+        "authors": (authors, DASHBOARD_QUERY_TIMEOUT, None),
+    }
+    # summaries that aren't cached yet are streamed to the page by summary_stream rather than holding up the render
+    summary = get_cached("summaries", summary_key(file_name, custom_size))
+    if summary is None and not STREAM_SUMMARIES:
+        stages["summary"] = (lambda: cached_topic_summary(file_name, cluster_labels, topic_table, custom_size=custom_size), DASHBOARD_SUMMARY_TIMEOUT, SUMMARY_UNAVAILABLE)
+    comp_summary = get_cached("summaries", summary_key(file_name, custom_size, comparator_type, comparator)) if comparator_type else None
+    if comparator_type and comp_summary is None and not STREAM_SUMMARIES:
+        stages["comp_summary"] = (lambda: cached_comparator_summary(file_name, comparator_type, comparator, topic_table, comparator_table, custom_size=custom_size), DASHBOARD_SUMMARY_TIMEOUT, SUMMARY_UNAVAILABLE)
+    results = run_stages(stages)
+    summary = results.get("summary", summary)
+    comp_summary = results.get("comp_summary", comp_summary)
+
+    clusters = sorted([str(x) for x in cluster_labels.gpt_label.unique().tolist()])
+    if comparator_type:
+        return render_template("results_comparator.html", file_name=file_name, params=params, exemplars=exemplars, summary=summary, authors=results["authors"], clusters=clusters, comparator = comparator, comp_summary = comp_summary, comparator_type = comparator_type, custom = custom, new_min_cluster_size = custom_size)
+    return render_template("results.html", file_name=file_name, params=params, exemplars=exemplars, summary=summary, authors=results["authors"], clusters=clusters, custom = custom, new_min_cluster_size = custom_size)
 
-def publisher_logic(file_name, publisher, comparator_type):
-    cluster_labels, params = init_db_and_get_labels_params(file_name)
-    summary = topic_summary(cluster_labels)
-    exemplarsTable, authorsTable = get_tables(file_name)
+def sse_event(data, event=None):
+    return (f"event: {event}\n" if event else "") + f"data: {json.dumps(data)}\n\n"
 
-    cluster_labels_publisher = cluster_labels[cluster_labels["publisher_group"]==publisher.upper()]
-    comp_summary = comparator_summary(cluster_labels, cluster_labels_publisher)
+@app.route('/summary_stream/<summary_type>/<file_name>/<comparator_type>/<comparator>/<custom>/<custom_size>', methods=['GET'])
+def summary_stream(summary_type, file_name, comparator_type=None, comparator=None, custom=False, custom_size=None):
+    """
+    Server-Sent Events stream of a dashboard's GPT summary, summary_type is either topic or comparator.
 
-    exemplars = db.session.query(exemplarsTable).filter(and_(exemplarsTable.publisher_group == publisher.upper(), exemplarsTable.exemplar == True)).order_by(text("cluster_label")).all()
-    authors = db.session.query(authorsTable).filter(authorsTable.publisher_group_list.contains("'"+str(publisher.upper())+"'")).order_by(text("gpt_label, avg_cites_per_article desc")).all()
-    return render_template("results_comparator.html", file_name=file_name, params=params, exemplars=exemplars, summary=summary, authors=authors, clusters=sorted([str(x) for x in cluster_labels.gpt_label.unique().tolist()]), comparator = publisher, comp_summary = comp_summary, comparator_type = comparator_type)
+    Each sentence is sent as a message as soon as the model has produced it, followed by a done event. Cached summaries
+    are sent straight away, and a streamed summary is cached once complete.
+    """
+    custom_bool = custom.lower() == 'true'
+    custom_size = custom_size if custom_bool else None
+    if summary_type == "comparator":
+        key = summary_key(file_name, custom_size, comparator_type, comparator)
+    else:
+        key = summary_key(file_name, custom_size)
+
+    def generate():
+        sentences = get_cached("summaries", key)
+        if sentences is None:
+            if summary_type == "comparator":
+                topic_table, comparator_table = get_summary_tables(file_name, None, comparator_type, comparator, custom=custom_bool, custom_size=custom_size)
+                stream = stream_comparator_summary(topic_table, comparator_table)
+            else:
+                topic_table, _ = get_summary_tables(file_name, None, custom=custom_bool, custom_size=custom_size)
+                stream = stream_topic_summary(topic_table)
+            sentences = []
+            try:
+                for sentence in stream:
+                    sentences.append(sentence)
+                    yield sse_event(sentence)
+            except Exception as e:
+                app.logger.error('Summary stream failed for %s: %s', file_name, e)
+                yield sse_event(SUMMARY_UNAVAILABLE[0])
+                yield sse_event("", event="done")
+                return
+            store("summaries", key, sentences)
+        else:
+            for sentence in sentences:
+                yield sse_event(sentence)
+        yield sse_event("", event="done")
 
-def region_logic(file_name, region, comparator_type):
-    cluster_labels, params = init_db_and_get_labels_params(file_name)
-    summary = topic_summary(cluster_labels)
-    exemplarsTable, authorsTable = get_tables(file_name)
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no" # stops nginx holding the events back
+    return response
 
-    ta7 = ["United Kingdom","Germany","Australia","New Zealand","Canada","France","Italy","Spain"]
-    if region != "TA7":
-            cluster_labels_region = cluster_labels[cluster_labels["prid_region"].apply(lambda x: region in x)]
-    elif region == "TA7":
-        cluster_labels_region = cluster_labels[cluster_labels["prid_country"].apply(lambda x: any(country in x for country in ta7))]
-    comp_summary = comparator_summary(cluster_labels, cluster_labels_region)
-
-    if region != "TA7":
-            exemplars = db.session.query(exemplarsTable).filter(exemplarsTable.prid_region.contains(str(region))).filter_by(exemplar=True).order_by(text("cluster_label")).all()
-            authors = db.session.query(authorsTable).filter_by(prid_region=region).order_by(text("gpt_label, avg_cites_per_article desc")).all()
-    elif region == "TA7":
-        exemplars = db.session.query(exemplarsTable).filter(exemplarsTable.exemplar == True).filter(or_(*[exemplarsTable.prid_country.contains(country) for country in ta7])).order_by(text("cluster_label")).all()
-        authors = db.session.query(authorsTable).filter(or_(*[authorsTable.prid_country.contains(country) for country in ta7])).order_by(text("gpt_label, avg_cites_per_article desc")).all()
-    return render_template("results_comparator.html", file_name=file_name, params=params, exemplars=exemplars, summary=summary, authors=authors, clusters=sorted([str(x) for x in cluster_labels.gpt_label.unique().tolist()]), comparator = region, comp_summary = comp_summary, comparator_type = comparator_type)
-
-def country_logic(file_name, country, comparator_type):
-    cluster_labels, params = init_db_and_get_labels_params(file_name)
-    summary = topic_summary(cluster_labels)
-    exemplarsTable, authorsTable = get_tables(file_name)
-
-    cluster_labels_country = cluster_labels[cluster_labels["prid_country"].apply(lambda x: country in x)]
-    comp_summary = comparator_summary(cluster_labels, cluster_labels_country)
-
-    exemplars = db.session.query(exemplarsTable).filter(exemplarsTable.prid_country.contains(str(country))).filter_by(exemplar=True).order_by(text("cluster_label")).all()
-    authors = db.session.query(authorsTable).filter_by(prid_country=country).order_by(text("gpt_label, avg_cites_per_article desc")).all()
-    return render_template("results_comparator.html", file_name=file_name, params=params, exemplars=exemplars, summary=summary, authors=authors, clusters=sorted([str(x) for x in cluster_labels.gpt_label.unique().tolist()]), comparator = country, comp_summary = comp_summary, comparator_type = comparator_type)
+@app.route('/dashboard/<file_name>')
+def dashboard(file_name):
+    record_hit(file_name)
+    return render_dashboard(file_name)
+        
+@app.route('/comparator_dashboard/<file_name>/<comparator_type>/<comparator>')
+def comparator_dashboard(file_name, comparator_type, comparator):
+    if comparator_type not in ["journal", "publisher", "region", "country"]:
+        return "Invalid comparator type", 400
+    record_hit(file_name, comparator_type, comparator)
+    return render_dashboard(file_name, comparator_type, comparator)
 
 @app.route('/get_data/<file_name>/<comparator_type>/<comparator>/<custom>/<custom_size>', methods=['GET'])
 def get_data(file_name, comparator_type=None, comparator=None, custom=False, custom_size=None):
     """
-    Used to support tooltip for the d3 visualisations on the dashboard page
+    Used to support the d3 visualisations on the dashboard page, only the SCATTER_COLUMNS are sent. The text shown in
+    the scatter tooltip is fetched from /article_details when a point is hovered.
     """
     custom_bool = custom.lower() == 'true'
 
-    engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"], echo=True)
-    table_prefix = "" if not custom_bool else f"[{custom_size}]"
-    cluster_labels = pd.read_sql_table(f"{table_prefix}{file_name.replace('.parquet', '')}", 
-                                       engine, 
-                                       schema="custom_clustering_data" if custom_bool else "clustering_data")
-    
+    cluster_labels = load_cluster_labels(file_name, custom_bool, custom_size).copy()
     cluster_labels["gpt_label"] = cluster_labels["gpt_label"].fillna("Unclustered")
 
     # If comparator_type and comparator are provided, use them for filtering
     if comparator_type and comparator:
-        if comparator_type == "region":
-            ta7 = ["United Kingdom", "Germany", "Australia", "New Zealand", "Canada", "France", "Italy", "Spain"]
-            if comparator != "TA7":
-                cluster_labels = cluster_labels[cluster_labels["prid_region"].apply(lambda x: comparator in x)]
-            else:
-                cluster_labels = cluster_labels[cluster_labels["prid_country"].apply(lambda x: any(country in x for country in ta7))]
+        cluster_labels = filter_comparator(cluster_labels, comparator_type, comparator, exact_journal=True)
 
-        elif comparator_type == "journal":
-            cluster_labels = cluster_labels[cluster_labels["full_source_title"] == comparator]
+    labelsJSON = cluster_labels[SCATTER_COLUMNS].to_json(orient="records")
+    return jsonify(json.loads(labelsJSON)), 200
 
-        elif comparator_type == "publisher":
-            cluster_labels = cluster_labels[cluster_labels["publisher_group"] == comparator.upper()]
+ARTICLE_DETAIL_MAX_DOIS = int(os.getenv("ARTICLE_DETAIL_MAX_DOIS", 200))
+article_detail_cache = LRUCache(int(os.getenv("ARTICLE_DETAIL_CACHE_SIZE", 20000)))
 
-        elif comparator_type == "country":
-            cluster_labels = cluster_labels[cluster_labels["prid_country"].apply(lambda x: comparator in x)]
+def article_details(file_name, dois, custom=False, custom_size=None):
+    """
+    Returns the ARTICLE_DETAIL_COLUMNS of articles in a dataset, as dicts in the order of dois. DOIs that are not in
+    the dataset are left out.
 
-    labelsJSON = cluster_labels.to_json(orient="records")
-    return jsonify(json.loads(labelsJSON)), 200
+    Details are kept in a per worker LRU. Misses for a database dataset are looked up by the clustering table's primary
+    key, so the table is not loaded, datasets served from a bundle or shards use their (cached) clustering data.
+    """
+    size_key = str(custom_size) if custom else None
+    found = {key[2]: value for key, value in article_detail_cache.get_many([(file_name, size_key, doi) for doi in dois]).items()}
+    missing = [doi for doi in dict.fromkeys(dois) if doi not in found]
+    if missing:
+        if not custom and dataset_source(file_name) != "database":
+            articles = load_cluster_labels(file_name)
+            rows = json.loads(articles.loc[articles["doi"].isin(missing), ARTICLE_DETAIL_COLUMNS].to_json(orient="records"))
+        else:
+            model = customResultsTableName(f"[{custom_size}]" + file_name) if custom else ResultsTableName(file_name)
+            query = db.session.query(*[getattr(model, column) for column in ARTICLE_DETAIL_COLUMNS]).filter(model.doi.in_(missing))
+            rows = [dict(row._mapping) for row in query.all()]
+        looked_up = {row["doi"]: row for row in rows}
+        article_detail_cache.set_many({(file_name, size_key, doi): row for doi, row in looked_up.items()})
+        found.update(looked_up)
+    return [found[doi] for doi in dois if doi in found]
+
+@app.route('/article_details/<file_name>/<custom>/<custom_size>', methods=['GET'])
+def get_article_details(file_name, custom=False, custom_size=None):
+    """
+    Title, source, country and region of one or more articles (repeat the doi query parameter), for the scatter tooltip.
+    DOIs that are not in the dataset are left out, 404 if none of them are.
+    """
+    dois = request.args.getlist("doi")
+    if not dois:
+        return jsonify({"error": "At least one doi is required"}), 400
+    if len(dois) > ARTICLE_DETAIL_MAX_DOIS:
+        return jsonify({"error": f"At most {ARTICLE_DETAIL_MAX_DOIS} dois can be looked up at once"}), 400
+    custom_bool = custom.lower() == 'true'
+    details = article_details(file_name, dois, custom_bool, custom_size if custom_bool else None)
+    if not details:
+        return jsonify({"error": "None of the dois are in this dataset"}), 404
+    return jsonify(details), 200
+
+def load_search_index(file_name, custom=False, custom_size=None):
+    """
+    BM25 index over a dataset's article titles, built from its clustering data on first use and cached alongside it.
+    """
+    def build():
+        articles = load_cluster_labels(file_name, custom, custom_size)
+        return {"dois": articles["doi"].to_numpy(), **build_index(articles["article_title"])}
+    return cached("search", (file_name, str(custom_size) if custom else None), build)
+
+@app.route('/search/<file_name>/<comparator_type>/<comparator>/<custom>/<custom_size>', methods=['GET'])
+def search_titles(file_name, comparator_type=None, comparator=None, custom=False, custom_size=None):
+    """
+    Searches a dataset's article titles for the q query parameter, ranked by BM25. Returns the DOI, coordinates, label
+    and score of up to limit (default and most SEARCH_LIMIT, at least 1) matches within the comparator, for the scatter to
+    highlight.
+    """
+    start = time.perf_counter()
+    query = request.args.get("q", "").strip()
+    if not query:
+        return jsonify({"error": "A search query (q) is required"}), 400
+    try:
+        limit = int(request.args.get("limit", SEARCH_LIMIT))
+    except ValueError:
+        return jsonify({"error": "The result limit (limit) must be a whole number"}), 400
+    limit = min(max(limit, 1), SEARCH_LIMIT)
+    custom_bool = custom.lower() == 'true'
+    custom_size = custom_size if custom_bool else None
+
+    cluster_labels = load_cluster_labels(file_name, custom_bool, custom_size)
+    index = load_search_index(file_name, custom_bool, custom_size)
+    allowed = None
+    if comparator_type in ["journal", "publisher", "region", "country"] and comparator:
+        allowed = pd.Series(index["dois"]).isin(filter_comparator(cluster_labels, comparator_type, comparator, exact_journal=True)["doi"]).to_numpy()
+    positions, scores, total = bm25_search(index, query, allowed, limit)
+
+    # matches are joined to the clustering data by DOI, the order of the index's articles does not have to match the frame's
+    hits = pd.DataFrame({"doi": index["dois"][positions], "score": scores.astype(float).round(4)})
+    hits = hits.merge(cluster_labels[["doi", "coord_x", "coord_y", "gpt_label"]], on="doi", how="inner")
+    hits["gpt_label"] = hits["gpt_label"].fillna("Unclustered")
+    return jsonify({
+        "query": query,
+        "total": total,
+        "took_ms": round((time.perf_counter() - start) * 1000, 2),
+        "results": json.loads(hits[["doi", "coord_x", "coord_y", "gpt_label", "score"]].to_json(orient="records")),
+    }), 200
 
 @app.route('/download_all/<file_name>/<custom>/<custom_size>', methods=['GET'])
 def download_all(file_name, custom=False, custom_size=None):
     custom_bool = custom.lower() == 'true'
-    table_prefix = "" if not custom_bool else f"[{custom_size}]"
-    engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"], echo=True)
-    cluster_labels = pd.read_sql_table(f"{table_prefix}{file_name.replace('.parquet', '')}", 
-                                       engine, 
-                                       schema="custom_clustering_data" if custom_bool else "clustering_data")
-    
+    cluster_labels = load_cluster_labels(file_name, custom_bool, custom_size).copy()
     cluster_labels["gpt_label"] = cluster_labels["gpt_label"].fillna("Unclustered")
 
     csv_data = cluster_labels.to_csv(index=False)
@@ -445,34 +1118,10 @@ def download_all(file_name, custom=False, custom_size=None):
 
 @app.route('/download_exemplars/<file_name>/<comparator_type>/<comparator>/<custom>/<custom_size>', methods=['GET'])
 def download_exemplars(file_name, comparator_type=None, comparator=None, custom=False, custom_size=None):
-    ta7 = ["United Kingdom", "Germany", "Australia", "New Zealand", "Canada", "France", "Italy", "Spain"]
-    engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"], echo=True)
-    
     custom_bool = custom.lower() == 'true'
-    table_prefix = "" if not custom_bool else f"[{custom_size}]"
-    
-    if not custom_bool:
-        exemplarsTable = pd.read_sql_table(file_name.replace(".parquet", ""), engine, schema="clustering_data")
-    else:
-        exemplarsTable = pd.read_sql_table(table_prefix+file_name.replace(".parquet", ""), engine, schema="custom_clustering_data")
-    
-    if comparator_type:
-        if comparator_type == "region":
-            if comparator != "TA7":
-                exemplarsTable = exemplarsTable[exemplarsTable["prid_region"].apply(lambda x: comparator in x)]
-            else:
-                exemplarsTable = exemplarsTable[exemplarsTable["prid_country"].apply(lambda x: any(country in x for country in ta7))]
-
-        elif comparator_type == "journal":
-            exemplarsTable = exemplarsTable[exemplarsTable["full_source_title"] == comparator]
-
-        elif comparator_type == "publisher":
-            exemplarsTable = exemplarsTable[exemplarsTable["publisher_group"] == comparator.upper()]
-
-        elif comparator_type == "country":
-            exemplarsTable = exemplarsTable[exemplarsTable["prid_country"].apply(lambda x: comparator in x)]
+    cluster_labels = load_cluster_labels(file_name, custom_bool, custom_size)
 
-    exemplarsTable = exemplarsTable[["doi", "article_title", "full_source_title", "citations", "year_published", "art_oa_status", "publisher_group", "gpt_label"]][exemplarsTable.exemplar == True]
+    exemplarsTable = filter_comparator(cluster_labels[cluster_labels["exemplar"] == True], comparator_type, comparator, exact_journal=True)[EXEMPLAR_COLUMNS]
 
     csv_data = exemplarsTable.to_csv(index=False)
     response = make_response(csv_data)
@@ -491,7 +1140,9 @@ def download_authors(file_name, comparator_type=None, comparator=None, custom=Fa
     custom_bool = custom.lower() == 'true'
     table_prefix = "" if not custom_bool else f"[{custom_size}]"
 
-    if not custom_bool:
+    if not custom_bool and dataset_source(file_name) != "database":
+        authorsTable = load_authors_frame(file_name)
+    elif not custom_bool:
         authorsTable = pd.read_sql_table(file_name.replace(".parquet", ""), engine, schema="authors")
     else:
         authorsTable = pd.read_sql_table(table_prefix+file_name.replace(".parquet", ""), engine, schema="custom_authors")
@@ -526,19 +1177,23 @@ def download_authors(file_name, comparator_type=None, comparator=None, custom=Fa
 
 @app.route('/choroplethData/<file_name>/<comparator_type>/<comparator>/<custom>/<custom_size>', methods=['GET'])
 def choroplethData(file_name, comparator_type=None, comparator=None, custom=False, custom_size=None):
-    country_lookup = wr.s3.read_csv("s3://rootbucket/topic_clustering/test_folder/country_lookup.csv")
+    country_lookup = get_country_lookup()
     ta7 = ["United Kingdom","Germany","Australia","New Zealand","Canada","France","Italy","Spain"]
 
     custom_bool = custom.lower() == 'true'
 
     table_prefix = "" if not custom_bool else f"[{custom_size}]"
     
-    if not custom_bool:
+    if not custom_bool and dataset_source(file_name) != "database":
+        Author = None
+    elif not custom_bool:
         Author = AuthorsTablename(file_name)
     else:
         Author = customAuthorsTablename(table_prefix+file_name)
 
-    if comparator_type == "region":
+    if Author is None:
+        result = choropleth_counts(load_authors_frame(file_name), comparator_type, comparator)
+    elif comparator_type == "region":
         if comparator != "TA7":
             result = db.session.query(
                 Author.gpt_label,
@@ -582,10 +1237,7 @@ def choroplethData(file_name, comparator_type=None, comparator=None, custom=Fals
         if gpt_label not in output_dict:
             output_dict[gpt_label] = []
 
-        if prid_country in country_lookup['country'].tolist():
-            geojson = country_lookup.loc[country_lookup['country'] == prid_country, 'geojson'].values[0]
-        else:
-            geojson = prid_country
+        geojson = country_lookup.get(prid_country, prid_country)
 
         output_dict[gpt_label].append({
             "country": geojson,
@@ -594,106 +1246,707 @@ def choroplethData(file_name, comparator_type=None, comparator=None, custom=Fals
 
     return jsonify(output_dict), 200
 
+def read_umaps(file_name, columns=ARTICLE_COLUMNS):
+    """
+    Reads a dataset's UMAP projected articles from S3 through the local parquet cache, only the columns the clustering
+    tables hold are read by default.
+    """
+    return read_s3_parquet("rootbucket", f"topic_clustering/test_folder/umaps/{file_name}", columns)
+
+def read_authors(file_name, columns=AUTHOR_COLUMNS):
+    """
+    Reads a dataset's article authors from S3 through the local parquet cache, only the columns group_authors uses are read by default.
+    """
+    return read_s3_parquet("rootbucket", f"topic_clustering/test_folder/authors/{file_name}", columns)
+
+def custom_params(file_name, new_min_cluster_size):
+    """
+    Scales the best parameters for a dataset to a new minimum cluster size, min_samples is reduced in proportion.
+    """
+    params = get_params(file_name)
+    change = ((params["min_cluster_size"]-int(new_min_cluster_size))/params["min_cluster_size"])*100
+    new_min_samples = params["min_samples"] * change/100
+    params["min_cluster_size"] = int(new_min_cluster_size)
+    params["min_samples"] = round(new_min_samples) if round(new_min_samples) > 1 else 1
+    return params
+
+def recompute_custom_clusters(file_name, new_min_cluster_size, params):
+    """
+    Reclusters a dataset with custom parameters, labels the new clusters and writes the clustering, authors and summary cube tables.
+    Clusters that closely match one in the base run (by DOI overlap) keep its label, only new or changed clusters are sent to GPT.
+    The articles and authors of a dataset composed from shards are read from its year shards.
+    """
+    if dataset_source(file_name) == "shards":
+        articles = read_shards("umaps", file_name, ARTICLE_COLUMNS).drop_duplicates("doi", ignore_index=True)
+        authors = read_shards("authors", file_name, AUTHOR_COLUMNS)
+    else:
+        articles = read_umaps(file_name)
+        authors = read_authors(file_name)
+    cluster_labels, x, y = get_cluster_labels(articles, params)
+    try:
+        base = load_cluster_labels(file_name)
+    except Exception as e:
+        app.logger.error('Unable to load base clusters for %s, every cluster will be relabelled: %s', file_name, e)
+        base = None
+    topic_labels, calls_saved = relabel_clusters(cluster_labels, base)
+    app.logger.info('Relabelled %s clusters for %s at size %s, %s GPT calls saved', len(topic_labels), file_name, new_min_cluster_size, calls_saved)
+    cluster_labels = cluster_labels.merge(topic_labels, on="cluster_label", how="left")
+    cluster_labels["gpt_label"] = cluster_labels["gpt_label"].apply(
+        lambda x: re.sub(r'[^\w\s]', '', x) if not pd.isna(x) else x
+    )
+    cluster_labels["prid_country"] = cluster_labels["prid_country"].apply(lambda x: str(x))
+    cluster_labels["prid_region"] = cluster_labels["prid_region"].apply(lambda x: str(x))
+    table = f"[{new_min_cluster_size}]"+file_name.replace(".parquet", "")
+    # one transaction, so has_custom_clusters never sees the clustering data without its authors and cube
+    write_tables([
+        (cluster_labels, table, "custom_clustering_data", 'replace', None),
+        (group_authors(cluster_labels, authors), table, "custom_authors", 'replace', None),
+        (build_summary_cube(cluster_labels, countries=get_form_data()["countries"]), table, "custom_summary_cube", 'replace', ["comparator_type", "comparator"]),
+    ])
+    return cluster_labels
+
+INCREMENTAL_REFIT_THRESHOLD = float(os.getenv("INCREMENTAL_REFIT_THRESHOLD", 0.2)) # share of new articles left unclustered that triggers a full refit
+
+def drop_custom_tables(file_name):
+    """
+    Drops a dataset's custom cluster size tables, they are recomputed from the current clustering data when next viewed.
+
+    Returns:
+    int: Number of tables dropped.
+    """
+    engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"], echo=True)
+    table = file_name.replace(".parquet", "")
+    dropped = 0
+    for schema in ["custom_clustering_data", "custom_authors", "custom_summary_cube"]:
+        for name in inspect(engine).get_table_names(schema=schema):
+            if name.startswith("[") and name.endswith("]" + table):
+                Table(name, MetaData(), schema=schema, autoload_with=engine).drop(engine)
+                dropped += 1
+    return dropped
+
+def append_articles(file_name, new_file):
+    """
+    Adds newly published articles to an existing dataset without reclustering it.
+
+    The new articles (umaps/{new_file}, projected with the dataset's UMAP model) are assigned to the dataset's clusters with
+    approximate_predict and take the existing cluster_label and gpt_label of their cluster. If more than
+    INCREMENTAL_REFIT_THRESHOLD of them are outliers the clusters no longer describe the data, so the combined articles are
+    reclustered and relabelled (reusing the labels of clusters that survive) instead.
+
+    Returns:
+    tuple: (1) the number of articles added and (2) whether a full refit was needed.
+
+    Notes:
+    - The stored clusters come from the offline pipeline, so the clusterer's cluster numbers need not match them. Its
+      clusters are matched to the stored ones by the DOIs they assign (match_clusters), and ValueError is raised if a
+      cluster that new articles were assigned to has no clear match.
+    - The clustering data, authors and summary cube are written in one transaction (write_tables), so the tables keep their
+      keys and a failed write (RuntimeError) leaves all three as they were. A refit clusterer is saved once they are written.
+    - The dataset's custom cluster size tables are dropped as they no longer cover every article.
+    - Caches are cleared in this process and in the shared disk and redis backends, workers using the local backend keep
+      serving the old data for up to CACHE_TTL unless they are restarted.
+    """
+    params = get_params(file_name)
+    table = file_name.replace(".parquet", "")
+    base = load_cluster_labels(file_name).copy()
+    articles = read_umaps(new_file)
+    articles = articles[~articles["doi"].isin(base["doi"])].reset_index(drop=True)
+    authors = pd.concat([read_authors(file_name), read_authors(new_file)], ignore_index=True)
+    if articles.empty:
+        return 0, False
+    articles["prid_country"] = articles["prid_country"].apply(lambda x: str(x))
+    articles["prid_region"] = articles["prid_region"].apply(lambda x: str(x))
+
+    clusterer = load_clusterer(file_name)
+    if clusterer is None:
+        clusterer = fit_clusterer(base, params)
+        save_clusterer(file_name, clusterer)
+    articles, outlier_rate = assign_clusters(clusterer, articles)
+    refit = outlier_rate > INCREMENTAL_REFIT_THRESHOLD
+
+    if refit:
+        combined = pd.concat([base.drop(columns=["cluster_label", "exemplar", "gpt_label"]), articles.drop(columns=["cluster_label", "exemplar"])], ignore_index=True)
+        clusterer = fit_clusterer(combined, params)
+        cluster_labels, x, y = get_cluster_labels(combined, params, clusterer)
+        topic_labels, calls_saved = relabel_clusters(cluster_labels, base)
+        cluster_labels = cluster_labels.merge(topic_labels, on="cluster_label", how="left")
+        cluster_labels["gpt_label"] = cluster_labels["gpt_label"].apply(
+            lambda x: re.sub(r'[^\w\s]', '', x) if not pd.isna(x) else x
+        )
+        writes = [(cluster_labels, table, "clustering_data", 'replace', None)]
+        app.logger.info('%s of %s new articles for %s were outliers, reclustered with %s GPT calls saved', (articles["cluster_label"] == -1).sum(), len(articles), file_name, calls_saved)
+    else:
+        # the clusterer's cluster numbers are matched to the stored clusters through the base articles it assigns to them
+        predicted, _ = assign_clusters(clusterer, base[["doi", "coord_x", "coord_y"]].copy())
+        stored_clusters = match_clusters(base, predicted, column="cluster_label")
+        unmatched = sorted(set(articles["cluster_label"].unique().tolist()) - set(stored_clusters) - {-1})
+        if unmatched:
+            raise ValueError(f"Clusters {unmatched} of the clusterer for {file_name} don't clearly match its stored clusters, "
+                             f"so the new articles can't be given their labels. Delete the saved clusterer to refit it.")
+        labels = base.drop_duplicates("cluster_label").set_index("cluster_label")["gpt_label"]
+        articles["cluster_label"] = articles["cluster_label"].map({**stored_clusters, -1: -1}).astype(base["cluster_label"].dtype)
+        articles["gpt_label"] = articles["cluster_label"].map(labels)
+        articles = articles[base.columns]
+        writes = [(articles, table, "clustering_data", 'append', None)]
+        cluster_labels = pd.concat([base, articles], ignore_index=True)
+        app.logger.info('Assigned %s new articles to %s, %.1f%% outliers', len(articles), file_name, outlier_rate * 100)
+
+    write_tables(writes + [
+        (group_authors(cluster_labels, authors), table, "authors", 'replace', None),
+        (build_summary_cube(cluster_labels, countries=get_form_data()["countries"]), table, "summary_cube", 'replace', ["comparator_type", "comparator"]),
+    ])
+    if refit:
+        save_clusterer(file_name, clusterer)
+    dropped = drop_custom_tables(file_name)
+    if dropped:
+        app.logger.info('Dropped %s custom cluster size tables of %s', dropped, file_name)
+    clear_caches()
+    return len(articles), refit
+
+@app.cli.command("append")
+@click.argument("file_name")
+@click.argument("new_file")
+def append_command(file_name, new_file):
+    """
+    Adds the articles in umaps/NEW_FILE to the dataset FILE_NAME, reclustering only if too many of them are outliers.
+    """
+    try:
+        added, refit = append_articles(file_name, new_file)
+    except (ValueError, RuntimeError) as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Added {added} articles to {file_name}" + (", the dataset was reclustered" if refit else ""))
+    if added and CACHE_BACKEND == "local":
+        click.echo("Running workers cache datasets in process (CACHE_BACKEND=local), reload them (kill -HUP the gunicorn master) to serve the new articles before CACHE_TTL")
+
+def has_custom_clusters(file_name, custom_size):
+    engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"], echo=True)
+    return inspect(engine).has_table(f"[{custom_size}]"+file_name.replace(".parquet", ""), schema="custom_clustering_data")
+
+def ensure_custom_clusters(file_name, new_min_cluster_size, params):
+    if not is_cached("labels", (file_name, str(new_min_cluster_size))) and not has_custom_clusters(file_name, new_min_cluster_size):
+        recompute_custom_clusters(file_name, new_min_cluster_size, params)
+
 @app.route('/custom_cluster_size/<file_name>/<new_min_cluster_size>', methods=['GET'])
 def custom_cluster_size_dashboard(file_name, new_min_cluster_size):
-    with app.app_context():
-        params = get_params(file_name)
-        change = ((params["min_cluster_size"]-int(new_min_cluster_size))/params["min_cluster_size"])*100
-        new_min_samples = params["min_samples"] * change/100
-        params["min_cluster_size"] = int(new_min_cluster_size)
-        params["min_samples"] = round(new_min_samples) if round(new_min_samples) > 1 else 1
+    new_min_cluster_size = int(new_min_cluster_size)
+    params = custom_params(file_name, new_min_cluster_size)
+    ensure_custom_clusters(file_name, new_min_cluster_size, params)
+    return render_dashboard(file_name, custom=True, custom_size=new_min_cluster_size, params=params)
+
+@app.route('/custom_cluster_size_comparator/<file_name>/<new_min_cluster_size>/<comparator_type>/<comparator>', methods=['GET'])
+def custom_cluster_size_comparator_dashboard(file_name, new_min_cluster_size, comparator_type, comparator):
+    if comparator_type not in ["journal", "publisher", "region", "country"]:
+        return "Invalid comparator type", 400
+    new_min_cluster_size = int(new_min_cluster_size)
+    params = custom_params(file_name, new_min_cluster_size)
+    ensure_custom_clusters(file_name, new_min_cluster_size, params)
+    return render_dashboard(file_name, comparator_type, comparator, custom=True, custom_size=new_min_cluster_size, params=params)
+
+@app.cli.command("sweep")
+@click.argument("file_name")
+@click.option("--samples", type=int, default=None, help="Random search over this many candidates, the full grid is searched if not set.")
+@click.option("--grid", default=None, help="JSON object of parameter values to search, overriding the default grid.")
+@click.option("--seed", type=int, default=0)
+@click.option("--workers", type=int, default=SWEEP_WORKERS)
+@click.option("--time-budget", type=int, default=SWEEP_TIME_BUDGET, help="Seconds the sweep may run for, candidates still running then are abandoned.")
+@click.option("--patience", type=int, default=SWEEP_PATIENCE, help="Candidates without an improvement before stopping, 0 disables early stopping.")
+def sweep_command(file_name, samples, grid, seed, workers, time_budget, patience):
+    """
+    Searches HDBSCAN parameters for a umaps parquet and saves the best to best_parameters.
+    """
+    articles = read_umaps(file_name, columns=["coord_x", "coord_y"])
+    candidates = sweep_candidates(json.loads(grid) if grid else None, samples, seed)
+    best, results = run_sweep(articles, candidates, workers, time_budget, patience, logger=app.logger)
+    if best is None:
+        raise click.ClickException(f"None of the {len(results)} candidates evaluated found clusters")
+    upgrade_params_table()
+    db.session.merge(Params(
+        id=file_name,
+        min_cluster_size=int(best["min_cluster_size"]),
+        min_samples=int(best["min_samples"]),
+        cluster_selection_method=best["cluster_selection_method"],
+        cluster_selection_epsilon=float(best["cluster_selection_epsilon"]),
+        metric=best["metric"],
+        score=float(best["score"]),
+        algorithm=best["algorithm"],
+    ))
+    db.session.commit()
+    click.echo(f"Evaluated {len(results)} of {len(candidates)} candidates, best score {best['score']:.4f} "
+               f"(DBCV {best['dbcv']:.4f}, {best['pct_clustered']:.1%} clustered, {best['number_clusters']} clusters)")
+
+@app.cli.command("summary-modes")
+@click.argument("file_name")
+@click.option("--comparator-type", default=None, help="Summarise against a comparator (journal, publisher, country or region) rather than the subject.")
+@click.option("--comparator", default="")
+def summary_modes_command(file_name, comparator_type, comparator):
+    """
+    Summarises a dataset once in each mode (stuff and map_reduce) and prints the calls, tokens and time each took.
+    Nothing is cached, so every run makes new model calls.
+    """
+    if comparator_type:
+        topic_table, comparator_table = get_summary_tables(file_name, None, comparator_type, comparator)
+    else:
+        topic_table, _ = get_summary_tables(file_name, None)
+    for mode in ["stuff", "map_reduce"]:
+        if comparator_type:
+            sentences, usage = summarise_comparator(topic_table, comparator_table, mode=mode)
+        else:
+            sentences, usage = summarise_topics(topic_table, mode=mode)
+        click.echo(f"{mode} (ran as {usage['mode']}): {usage['calls']} calls, {usage['prompt_tokens']} prompt and "
+                   f"{usage['completion_tokens']} completion tokens, {usage['seconds']:.2f}s, {len(format_summary(sentences))} sentences")
 
-        exemplarsTable, authorsTable = get_tables(f"[{new_min_cluster_size}]"+file_name, custom=True)
+@app.cli.command("flush-stubs")
+def flush_stubs_command():
+    """
+    Sends the requests for datasets that have not been clustered yet from the local journal to S3 now, rather than
+    waiting for a worker's next flush.
+    """
+    click.echo(f"Flushed {flush_stubs()} stub requests")
 
+@app.cli.command("stub-queue")
+def stub_queue_command():
+    """
+    Prints the queue of requested datasets for the offline pipeline, ordered by demand.
+    """
+    for entry in read_queue():
+        click.echo(f"{entry['file_name']}: {entry['requests']} requests, {len(entry['users'])} users, "
+                   f"last requested {datetime.datetime.fromtimestamp(entry['last_requested']):%Y-%m-%d %H:%M}")
+
+def upgrade_params_table():
+    """
+    Adds the algorithm column to a best_parameters table that predates it, every query of Params selects it. Run when
+    the app is created and by the commands that save parameters, as well as by upgrade-db.
+
+    Returns:
+    bool: Whether the column was added.
+    """
+    engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"], echo=True)
+    try:
+        if not inspect(engine).has_table(Params.__tablename__):
+            return False
+        if "algorithm" in [column["name"] for column in inspect(engine).get_columns(Params.__tablename__)]:
+            return False
+        with engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {Params.__tablename__} ADD COLUMN algorithm VARCHAR(25)"))
+        app.logger.info('Added algorithm to %s', Params.__tablename__)
+        return True
+    finally:
+        engine.dispose() # the master must not hand its connections to the forked workers
+
+@app.cli.command("upgrade-db")
+def upgrade_db_command():
+    """
+    Adds columns and indexes the app expects to existing tables: the algorithm override of best_parameters and the unique
+    (dataset, doi) index of cluster_assignments.assignments, duplicate assignments are dropped before it is created.
+    """
+    engine = db.engine
+    if upgrade_params_table():
+        click.echo(f"Added algorithm to {Params.__tablename__}")
+    else:
+        click.echo(f"{Params.__tablename__} is up to date")
+
+    if not inspect(engine).has_table("assignments", schema="cluster_assignments"):
+        return
+    if any(index["unique"] for index in inspect(engine).get_indexes("assignments", schema="cluster_assignments")):
+        click.echo("cluster_assignments.assignments is up to date")
+        return
+    with engine.begin() as connection:
+        assignments = pd.read_sql_table("assignments", connection, schema="cluster_assignments")
+        table = Table("assignments", MetaData(), schema="cluster_assignments", autoload_with=connection)
+        duplicates = assignments.duplicated(["dataset", "doi"], keep="last")
+        if duplicates.any():
+            connection.execute(table.delete())
+            assignments[~duplicates].to_sql("assignments", connection, schema="cluster_assignments", if_exists="append", index=False)
+        assignments_index(table).create(connection)
+    click.echo(f"Added a unique (dataset, doi) index to cluster_assignments.assignments, {duplicates.sum()} duplicate assignments dropped")
+
+def dataset_summaries(file_name):
+    """
+    Returns the cached GPT summaries for a dataset, the subject summary and those of every comparator that has been viewed.
+    The views are read from CACHE_HITS_FILE, as the command runs outside the workers that counted them.
+    """
+    load_hits()
+    comparators = [("subject", "")] + [(comparator_type, comparator) for name, comparator_type, comparator in top_datasets(None) if name == file_name and comparator_type]
+    summaries = []
+    for comparator_type, comparator in comparators:
+        sentences = get_cached("summaries", summary_key(file_name, None, comparator_type, comparator))
+        if sentences is not None:
+            summaries.append({"comparator_type": comparator_type, "comparator": comparator, "sentences": sentences})
+    return summaries
+
+@app.cli.command("export-bundle")
+@click.argument("file_name")
+@click.option("--directory", default=BUNDLE_DIR, help="Directory the bundle is written to.")
+@click.option("--without-summaries", is_flag=True, help="Write the bundle even if no cached summaries are found.")
+def export_bundle_command(file_name, directory, without_summaries):
+    """
+    Writes the clustering data, authors, parameters, labels, summary cube and cached summaries of a dataset to a single bundle.
+
+    Summaries are read from the disk or redis cache the workers share, the local backend keeps them inside each worker
+    so the command stops rather than writing a bundle without them, unless --without-summaries is given.
+    """
+    summaries = dataset_summaries(file_name)
+    if not summaries and not without_summaries:
+        reason = "CACHE_BACKEND=local keeps them in each worker" if CACHE_BACKEND == "local" else f"none are in the {CACHE_BACKEND} cache"
+        raise click.ClickException(f"No summaries of {file_name} can be exported ({reason}), pass --without-summaries to export it without them")
+    engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"], echo=True)
+    table = file_name.replace(".parquet", "")
+    articles = load_cluster_labels(file_name)
+    if inspect(engine).has_table(table, schema="summary_cube"):
+        cube = pd.read_sql_table(table, engine, schema="summary_cube")
+    else:
+        cube = build_summary_cube(articles, countries=get_form_data()["countries"])
+    frames = {
+        "articles": articles,
+        "authors": pd.read_sql_table(table, engine, schema="authors"),
+        "labels": articles[["cluster_label", "gpt_label"]].drop_duplicates().sort_values("cluster_label"),
+        "summary_cube": cube,
+    }
+    path = bundle_path(file_name, directory)
+    manifest = write_bundle(path, file_name, frames, get_params(file_name), summaries)
+    click.echo(f"Wrote {path} ({sum(entry['bytes'] for entry in manifest['files'].values())} bytes)")
+
+@app.cli.command("import-bundle")
+@click.argument("path")
+@click.option("--database", is_flag=True, help="Also write the bundle's tables and parameters to the database.")
+def import_bundle_command(path, database):
+    """
+    Verifies a bundle's checksums and copies it into BUNDLE_DIR, dashboards for the dataset are then served from the bundle.
+    """
+    try:
+        manifest = import_bundle(path)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    file_name = manifest["file_name"]
+    if database:
+        bundle = read_bundle(bundle_path(file_name), verify=False)
+        table = file_name.replace(".parquet", "")
         try:
-            cluster_labels, params = init_db_and_get_labels_params(file_name, custom=True, custom_size=new_min_cluster_size)
-            summary = topic_summary(cluster_labels)
-            exemplars = db.session.query(exemplarsTable).filter_by(exemplar=True).order_by(text("cluster_label")).all()
-            authors = db.session.query(authorsTable).order_by(text("gpt_label, avg_cites_per_article desc")).all()
-            return render_template("results.html", file_name=file_name, params=params, exemplars=exemplars, summary=summary, authors=authors, clusters=sorted([str(x) for x in cluster_labels.gpt_label.unique().tolist()]), custom = True, new_min_cluster_size = new_min_cluster_size)
-        except:
-            articles = wr.s3.read_parquet(f"s3://rootbucket/topic_clustering/test_folder/umaps/{file_name}")
-            authors = wr.s3.read_parquet(f"s3://rootbucket/topic_clustering/test_folder/authors/{file_name}")
-            cluster_labels, x, y = get_cluster_labels(articles, params)
-            topic_labels = create_gpt_label_dataframe(cluster_labels[cluster_labels["exemplar"]==True])
-            cluster_labels = cluster_labels.merge(topic_labels, on="cluster_label", how="left")
-            cluster_labels["gpt_label"] = cluster_labels["gpt_label"].apply(
-                lambda x: re.sub(r'[^\w\s]', '', x) if not pd.isna(x) else x
-            )
-            cluster_labels["prid_country"] = cluster_labels["prid_country"].apply(lambda x: str(x))
-            cluster_labels["prid_region"] = cluster_labels["prid_region"].apply(lambda x: str(x))
-            group_authors_table = group_authors(cluster_labels, authors)
-            database_write(cluster_labels, f"[{new_min_cluster_size}]"+file_name.replace(".parquet", ""), "custom_clustering_data")
-            database_write(group_authors_table, f"[{new_min_cluster_size}]"+file_name.replace(".parquet", ""), "custom_authors")
-            summary = topic_summary(cluster_labels)
-            exemplars = db.session.query(exemplarsTable).filter_by(exemplar=True).order_by(text("cluster_label")).all()
-            authors = db.session.query(authorsTable).order_by(text("gpt_label, avg_cites_per_article desc")).all()
-            return render_template("results.html", file_name=file_name, params=params, exemplars=exemplars, summary=summary, authors=authors, clusters=sorted([str(x) for x in cluster_labels.gpt_label.unique().tolist()]), custom = True, new_min_cluster_size=int(new_min_cluster_size))
+            write_tables([
+                (bundle["articles"], table, "clustering_data", 'replace', None),
+                (bundle["authors"], table, "authors", 'replace', None),
+                (bundle["summary_cube"], table, "summary_cube", 'replace', ["comparator_type", "comparator"]),
+            ])
+        except RuntimeError as e:
+            clear_caches()
+            raise click.ClickException(f"{e}, {file_name} is served from the imported bundle but the database is unchanged")
+        upgrade_params_table()
+        db.session.merge(Params(**bundle["params"]))
+        db.session.commit()
+    clear_caches()
+    click.echo(f"Imported {file_name}")
+
+def load_report_authors(file_name, custom=False, custom_size=None):
+    """
+    Grouped authors of a dataset as a frame, read once for a report and filtered for each comparator with filter_authors.
+    """
+    if not custom and dataset_source(file_name) != "database":
+        return load_authors_frame(file_name)
+    engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"], echo=True)
+    if not custom:
+        return pd.read_sql_table(file_name.replace(".parquet", ""), engine, schema="authors")
+    return pd.read_sql_table(f"[{custom_size}]"+file_name.replace(".parquet", ""), engine, schema="custom_authors")
 
-@app.route('/custom_cluster_size_comparator/<file_name>/<new_min_cluster_size>/<comparator_type>/<comparator>', methods=['GET'])
-def custom_cluster_size_comparator_dashboard(file_name, new_min_cluster_size, comparator_type, comparator):
-    with app.app_context():
-        params = get_params(file_name)
-        new_min_cluster_size = int(new_min_cluster_size)
-        change = ((params["min_cluster_size"]-new_min_cluster_size)/params["min_cluster_size"])*100
-        new_min_samples = params["min_samples"] * change/100
-        params["min_cluster_size"] = int(new_min_cluster_size)
-        params["min_samples"] = round(new_min_samples) if round(new_min_samples) > 1 else 1
-
-        exemplarsTable, authorsTable = get_tables(f"[{new_min_cluster_size}]"+file_name, custom=True)
-        for attempt in range(2):
+def build_report(file_name, comparators, custom=False, custom_size=None, report_id=None, progress=None, workers=REPORT_WORKERS):
+    """
+    Exports the subject and a list of comparators of a dataset to one report archive, with the GPT summary, topic table,
+    exemplars and authors of each, as the dashboards and downloads would show them.
+
+    Parameters:
+    file_name (str): The dataset.
+    comparators (list): (comparator_type, comparator) tuples, as returned by parse_comparators.
+    custom (bool): Report on the custom cluster size custom_size rather than the best parameters.
+    report_id (str): Name of the archive in REPORT_DIR, a new one is made if not given.
+    progress (callable): Called with the number of comparators done, the total and the entry after each comparator.
+    workers (int): Comparators worked on at once.
+
+    Returns:
+    tuple: (1) the archive's path and (2) its manifest.
+
+    Notes:
+    - The clustering data, authors and subject topic table are loaded once and shared by the threads of run_comparators,
+      each comparator only filters them.
+    - Summaries are read and written through the summaries cache, so comparators that have been viewed cost no model calls
+      and dashboards opened after the report get its summaries.
+    - A comparator whose summary fails is still exported, its error is listed in comparators.csv.
+    """
+    custom_size = custom_size if custom else None
+    cluster_labels, params = init_db_and_get_labels_params(file_name, custom=custom, custom_size=custom_size)
+    authors = load_report_authors(file_name, custom, custom_size)
+    topic_table, _ = get_summary_tables(file_name, cluster_labels, custom=custom, custom_size=custom_size)
+    exemplars = cluster_labels[cluster_labels["exemplar"] == True]
+
+    def work(comparator_type, comparator):
+        with app.app_context():
+            if comparator_type == "subject":
+                table = topic_table
+                summarise = lambda: cached_topic_summary(file_name, cluster_labels, topic_table, custom_size=custom_size)
+            else:
+                _, table = get_summary_tables(file_name, cluster_labels, comparator_type, comparator, custom=custom, custom_size=custom_size)
+                summarise = lambda: cached_comparator_summary(file_name, comparator_type, comparator, topic_table, table, custom_size=custom_size)
+            entry = {
+                "comparator_type": comparator_type,
+                "comparator": comparator,
+                "topic_table": table,
+                "exemplars": filter_comparator(exemplars, comparator_type, comparator, exact_journal=True)[EXEMPLAR_COLUMNS],
+                "authors": pd.DataFrame(filter_authors(authors, comparator_type, comparator), columns=authors.columns).drop(columns=["index", "full_source_title_list", "publisher_group_list"], errors="ignore"),
+            }
             try:
-                cluster_labels, params = init_db_and_get_labels_params(file_name, custom=True, custom_size=new_min_cluster_size)
-                summary = topic_summary(cluster_labels)
-                if comparator_type in ["region", "journal", "country", "publisher"]:
-                    if comparator_type == "region":
-                        ta7 = ["United Kingdom","Germany","Australia","New Zealand","Canada","France","Italy","Spain"]
-                        if comparator != "TA7":
-                                cluster_labels_region = cluster_labels[cluster_labels["prid_region"].apply(lambda x: comparator in x)]
-                        elif comparator == "TA7":
-                            cluster_labels_region = cluster_labels[cluster_labels["prid_country"].apply(lambda x: any(country in x for country in ta7))]
-                        comp_summary = comparator_summary(cluster_labels, cluster_labels_region)
-
-                        if comparator != "TA7":
-                                exemplars = db.session.query(exemplarsTable).filter(exemplarsTable.prid_region.contains(str(comparator))).filter_by(exemplar=True).order_by(text("cluster_label")).all()
-                                authors = db.session.query(authorsTable).filter_by(prid_region=comparator).order_by(text("gpt_label, avg_cites_per_article desc")).all()
-                        elif comparator == "TA7":
-                            exemplars = db.session.query(exemplarsTable).filter(exemplarsTable.exemplar == True).filter(or_(*[exemplarsTable.prid_country.contains(country) for country in ta7])).order_by(text("cluster_label")).all()
-                            authors = db.session.query(authorsTable).filter(or_(*[authorsTable.prid_country.contains(country) for country in ta7])).order_by(text("gpt_label, avg_cites_per_article desc")).all()
-                        return render_template("results_comparator.html", file_name=file_name, params=params, exemplars=exemplars, summary=summary, authors=authors, clusters=sorted([str(x) for x in cluster_labels.gpt_label.unique().tolist()]), comparator = comparator, comp_summary = comp_summary, comparator_type = comparator_type, custom = True)
-                    elif comparator_type == "journal":
-                        cluster_labels_journal = cluster_labels[cluster_labels["full_source_title"].apply(lambda x: comparator in x)]
-                        comp_summary = comparator_summary(cluster_labels, cluster_labels_journal)
-                        exemplars = db.session.query(exemplarsTable).filter(and_(exemplarsTable.full_source_title == comparator, exemplarsTable.exemplar == True)).order_by(text("cluster_label")).all()
-                        authors = db.session.query(authorsTable).filter(authorsTable.full_source_title_list.contains("'"+str(comparator)+"'")).order_by(text("gpt_label, avg_cites_per_article desc")).all()
-                        return render_template("results_comparator.html", file_name=file_name, params=params, exemplars=exemplars, summary=summary, authors=authors, clusters=sorted([str(x) for x in cluster_labels.gpt_label.unique().tolist()]), comparator = comparator, comp_summary = comp_summary, comparator_type = comparator_type, custom = True)
-                    elif comparator_type == "country":
-                        cluster_labels_country = cluster_labels[cluster_labels["prid_country"].apply(lambda x: comparator in x)]
-                        comp_summary = comparator_summary(cluster_labels, cluster_labels_country)
-                        exemplars = db.session.query(exemplarsTable).filter(exemplarsTable.prid_country.contains(str(comparator))).filter_by(exemplar=True).order_by(text("cluster_label")).all()
-                        authors = db.session.query(authorsTable).filter_by(prid_country=comparator).order_by(text("gpt_label, avg_cites_per_article desc")).all()
-                        return render_template("results_comparator.html", file_name=file_name, params=params, exemplars=exemplars, summary=summary, authors=authors, clusters=sorted([str(x) for x in cluster_labels.gpt_label.unique().tolist()]), comparator = comparator, comp_summary = comp_summary, comparator_type = comparator_type, custom = True)
-                    elif comparator_type == "publisher":
-                        cluster_labels_publisher = cluster_labels[cluster_labels["publisher_group"]==comparator.upper()]
-                        comp_summary = comparator_summary(cluster_labels, cluster_labels_publisher)
-                        exemplars = db.session.query(exemplarsTable).filter(and_(exemplarsTable.publisher_group == comparator.upper(), exemplarsTable.exemplar == True)).order_by(text("cluster_label")).all()
-                        authors = db.session.query(authorsTable).filter(authorsTable.publisher_group_list.contains("'"+str(comparator.upper())+"'")).order_by(text("gpt_label, avg_cites_per_article desc")).all()
-                        return render_template("results_comparator.html", file_name=file_name, params=params, exemplars=exemplars, summary=summary, authors=authors, clusters=sorted([str(x) for x in cluster_labels.gpt_label.unique().tolist()]), comparator = comparator, comp_summary = comp_summary, comparator_type = comparator_type, custom = True)
-                    
-            except:
-                articles = wr.s3.read_parquet(f"s3://rootbucket/topic_clustering/test_folder/umaps/{file_name}")
-                authors = wr.s3.read_parquet(f"s3://rootbucket/topic_clustering/test_folder/authors/{file_name}")
-                cluster_labels, x, y = get_cluster_labels(articles, params)
-                topic_labels = create_gpt_label_dataframe(cluster_labels[cluster_labels["exemplar"]==True])
-                cluster_labels = cluster_labels.merge(topic_labels, on="cluster_label", how="left")
-                cluster_labels["gpt_label"] = cluster_labels["gpt_label"].apply(
-                    lambda x: re.sub(r'[^\w\s]', '', x) if not pd.isna(x) else x
-                )
-                cluster_labels["prid_country"] = cluster_labels["prid_country"].apply(lambda x: str(x))
-                cluster_labels["prid_region"] = cluster_labels["prid_region"].apply(lambda x: str(x))
-                group_authors_table = group_authors(cluster_labels, authors)
-                database_write(cluster_labels, f"[{new_min_cluster_size}]"+file_name.replace(".parquet", ""), "custom_clustering_data")
-                database_write(group_authors_table, f"[{new_min_cluster_size}]"+file_name.replace(".parquet", ""), "custom_authors")
+                entry["summary"] = summarise()
+            except Exception as e:
+                app.logger.error('Report summary of %s against %s %s failed: %s', file_name, comparator_type, comparator, e)
+                entry["error"] = f"Summary failed: {e}"
+            return entry
+
+    def report_progress(done, total, entry):
+        app.logger.info('Report of %s: %s of %s comparators done (%s %s)', file_name, done, total, entry["comparator_type"], entry["comparator"])
+        if progress:
+            progress(done, total, entry)
+
+    start = time.time()
+    entries = run_comparators([("subject", "")] + list(comparators), work, workers, report_progress)
+    path = report_path(report_id or new_report_id(file_name))
+    manifest = write_report(path, file_name, params, entries)
+    prune_reports()
+    app.logger.info('Wrote report %s of %s with %s comparators in %.2fs', path, file_name, len(entries), time.time() - start)
+    return path, manifest
+
+@app.cli.command("report")
+@click.argument("file_name")
+@click.argument("comparators", nargs=-1)
+@click.option("--comparators-file", type=click.File(), default=None, help="File with one comparator_type:comparator per line, added to the arguments.")
+@click.option("--custom-size", type=int, default=None, help="Report on this custom min_cluster_size rather than the best parameters.")
+@click.option("--workers", type=int, default=REPORT_WORKERS)
+def report_command(file_name, comparators, comparators_file, custom_size, workers):
+    """
+    Exports the summaries, topic tables, exemplars and authors of a dataset's subject and comparators, given as
+    comparator_type:comparator (e.g. country:Germany), to one zip archive in REPORT_DIR.
+    """
+    values = list(comparators) + ([line for line in comparators_file.read().splitlines() if line.strip()] if comparators_file else [])
+    try:
+        comparators = parse_comparators(values)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    def progress(done, total, entry):
+        click.echo(f"[{done}/{total}] {entry['comparator_type']} {entry['comparator']}".rstrip() + (f" ({entry['error']})" if entry.get("error") else ""))
+
+    path, manifest = build_report(file_name, comparators, custom=custom_size is not None, custom_size=custom_size, progress=progress, workers=workers)
+    click.echo(f"Wrote {path} ({manifest['comparators']} comparators, {manifest['errors']} with errors)")
+
+report_jobs = threading.BoundedSemaphore(REPORT_JOBS)
+
+@app.route('/report/<file_name>', methods=['POST'])
+def start_report(file_name):
+    """
+    Starts a report of a dataset against a list of comparators in the background, see build_report. The JSON body has
+    comparators (a list of comparator_type:comparator) and optionally custom_size.
+
+    Returns 202 with the report's id and the URLs to poll its progress and download the archive once it is done, 404
+    for an unknown dataset or custom size and 429 while another report is being built.
+    """
+    body = request.get_json(silent=True) or {}
+    try:
+        comparators = parse_comparators(body.get("comparators") or [])
+        custom_size = int(body["custom_size"]) if body.get("custom_size") is not None else None
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": str(e)}), 400
+    if not comparators:
+        return jsonify({"error": "At least one comparator is required"}), 400
+    if not has_dataset(file_name):
+        return jsonify({"error": f"{file_name} is not a dataset"}), 404
+    if custom_size is not None and not has_custom_clusters(file_name, custom_size):
+        return jsonify({"error": f"{file_name} has not been clustered at size {custom_size}, open its dashboard first"}), 404
+    if not report_jobs.acquire(blocking=False):
+        return jsonify({"error": "A report is already being built, please retry later"}), 429, {"Retry-After": str(ADMISSION_RETRY_AFTER)}
+
+    report_id = new_report_id(file_name)
+    progress = {"report_id": report_id, "file_name": file_name, "status": "running", "done": 0, "total": len(comparators) + 1, "errors": 0, "started_at": time.time()}
+    write_progress(report_id, progress)
+
+    def update(done, total, entry):
+        progress.update(done=done, total=total, errors=progress["errors"] + bool(entry.get("error")))
+        write_progress(report_id, progress)
+
+    def run():
+        try:
+            with app.app_context():
+                build_report(file_name, comparators, custom=custom_size is not None, custom_size=custom_size, report_id=report_id, progress=update)
+            progress.update(status="done")
+        except Exception as e:
+            app.logger.error('Report %s failed: %s', report_id, e)
+            progress.update(status="failed", error=str(e))
+        finally:
+            progress["finished_at"] = time.time()
+            write_progress(report_id, progress)
+            report_jobs.release()
+
+    threading.Thread(target=run, daemon=True).start()
+    return jsonify({
+        "report_id": report_id,
+        "status_url": url_for("report_status", report_id=report_id),
+        "download_url": url_for("download_report", report_id=report_id),
+    }), 202
+
+@app.route('/report/<report_id>', methods=['GET'])
+def report_status(report_id):
+    """
+    Progress of a report: its status (running, done or failed), comparators done out of the total and how many had errors.
+    """
+    progress = read_progress(report_id)
+    if progress is None:
+        return jsonify({"error": "Report not found"}), 404
+    return jsonify(progress), 200
+
+@app.route('/report/<report_id>/download', methods=['GET'])
+def download_report(report_id):
+    progress = read_progress(report_id)
+    if progress is None:
+        return jsonify({"error": "Report not found"}), 404
+    if progress["status"] != "done":
+        return jsonify(progress), 409
+    return send_file(os.path.abspath(report_path(report_id)), mimetype="application/zip", as_attachment=True, download_name=f"{report_id}.zip")
+
+def match_route(path):
+    try:
+        endpoint, args = app.url_map.bind("localhost").match(path.split("?")[0])
+        return endpoint
+    except HTTPException:
+        return None
+
+def replay_services(path):
+    """
+    The services serving a path in process would call that replay has no stand-in for: S3, OpenAI and the database.
+
+    Notes:
+    - Datasets with a local bundle are served without the database, and their bundled summaries without OpenAI.
+    - Summaries are only generated (with OpenAI) if they are not already cached.
+    - Custom cluster sizes are read from the database, and recomputed from the umaps on S3 with new labels if missing.
+    """
+    try:
+        endpoint, args = app.url_map.bind("localhost").match(path.split("?")[0])
+    except HTTPException:
+        return set()
+    if endpoint == "check_s3":
+        return {"S3"}
+    file_name = args.get("file_name")
+    if not file_name:
+        return set()
+    custom_size = args.get("new_min_cluster_size") or (args.get("custom_size") if args.get("custom", "false").lower() == "true" else None)
+    services = set()
+    if custom_size is not None:
+        services.add("database")
+        if endpoint.startswith("custom_cluster_size") and not has_custom_clusters(file_name, custom_size):
+            services.update({"S3", "OpenAI"})
+    elif has_bundle(file_name):
+        load_bundle(file_name) # adds the bundled summaries to the cache
+    else:
+        services.add("database")
+    if endpoint == "summary_stream":
+        comparator = args["summary_type"] == "comparator"
+        keys = [summary_key(file_name, custom_size, args["comparator_type"], args["comparator"]) if comparator else summary_key(file_name, custom_size)]
+    elif endpoint.endswith("dashboard") and not STREAM_SUMMARIES:
+        keys = [summary_key(file_name, custom_size)] + ([summary_key(file_name, custom_size, args["comparator_type"], args["comparator"])] if "comparator_type" in args else [])
+    else:
+        keys = []
+    if any(get_cached("summaries", key) is None for key in keys):
+        services.add("OpenAI")
+    return services
+
+@app.cli.command("replay")
+@click.argument("log_file", default="application.log")
+@click.option("--url", default=None, help="Base URL of a running app (e.g. gunicorn), requests are made in process if not set.")
+@click.option("--total", type=int, default=1000, help="Number of requests to make.")
+@click.option("--concurrency", type=int, default=8)
+@click.option("--seed", type=int, default=0)
+@click.option("--offline", is_flag=True, help="Also leave out requests that would use the database, so only bundles are served.")
+def replay_command(log_file, url, total, concurrency, seed, offline):
+    """
+    Replays the traffic recorded in application.log and reports throughput, latency percentiles and error rates per route.
+
+    In process replays leave out the requests that would call S3 or OpenAI (see replay_services), as there are no stand-ins
+    for them, and list them. Point BUNDLE_DIR at local bundles with their summaries and pass --offline to load test
+    without the database too. Replays of a running app (--url) make every request.
+    """
+    with open(log_file) as f:
+        model = traffic_model(parse_log(f), match_route)
+    if not url:
+        unavailable = {"S3", "OpenAI", "database"} if offline else {"S3", "OpenAI"}
+        model, refused = split_model(model, lambda path: ", ".join(sorted(replay_services(path) & unavailable)) or None)
+        if not refused.empty:
+            click.echo(f"Leaving out {refused['count'].sum()} requests to {len(refused)} paths with no stand-in:")
+            click.echo(refused.groupby(["route", "reason"])["count"].sum().to_string())
+    if model.empty:
+        raise click.ClickException(f"No replayable requests found in {log_file}")
+    click.echo(model.groupby("route")["count"].sum().sort_values(ascending=False).to_string())
+
+    if url:
+        import urllib.request
+        import urllib.error
+
+        def send(path):
+            try:
+                with urllib.request.urlopen(url.rstrip("/") + path, timeout=300) as response:
+                    response.read()
+                    return response.status
+            except urllib.error.HTTPError as e:
+                return e.code
+    else:
+        clients = threading.local()
+
+        def send(path):
+            if not hasattr(clients, "client"):
+                clients.client = app.test_client()
+            return clients.client.get(path).status_code
+
+    results, elapsed = replay(model, send, total, concurrency, seed)
+    click.echo(replay_report(results, elapsed).round(3).to_string())
+
+@app.route('/admission_stats')
+def get_admission_stats():
+    return jsonify(admission_stats())
+
+def profiles_authorised():
+    return valid_token(request.headers.get("X-Profile") or request.args.get("profile"), "/profiles")
+
+@app.route('/profiles')
+def get_profiles():
+    """
+    Lists the most recent request profiles, newest first. Requires the profile token for /profiles.
+    """
+    if not profiles_authorised():
+        return "Forbidden", 403
+    return jsonify(list_profiles())
+
+@app.route('/profiles/<profile_id>/<profile_format>')
+def download_profile(profile_id, profile_format):
+    """
+    Downloads a profile as collapsed stacks for flamegraph.pl (flamegraph) or as a speedscope file (speedscope).
+    """
+    if not profiles_authorised():
+        return "Forbidden", 403
+    profile = load_profile(profile_id)
+    if profile is None or profile_format not in ["flamegraph", "speedscope"]:
+        return "Profile not found", 404
+    if profile_format == "flamegraph":
+        response = make_response(folded(profile["stacks"]))
+        response.headers['Content-Disposition'] = f'attachment; filename={profile_id}.folded'
+        response.headers['Content-Type'] = 'text/plain'
+    else:
+        response = make_response(json.dumps(speedscope(profile["stacks"], f"{profile['route']} {profile['path']}")))
+        response.headers['Content-Disposition'] = f'attachment; filename={profile_id}.speedscope.json'
+        response.headers['Content-Type'] = 'application/json'
+    return response
+
+@app.cli.command("profile-token")
+@click.argument("path")
+def profile_token_command(path):
+    """
+    Prints the X-Profile header value that enables profiling for a request path (use /profiles to list and download profiles).
+    """
+    if not os.getenv("PROFILE_SECRET"):
+        raise click.ClickException("PROFILE_SECRET is not set")
+    click.echo(profile_token(path))
 
 @app.route('/favicon.ico')
 def favicon():
@@ -705,5 +1958,19 @@ def unhandled_exception(e):
     app.logger.error('Unhandled Exception: %s', e)
     return "Internal server error", 500
 
+def create_app(preload=True):
+    """
+    Returns the app for a WSGI server, e.g. gunicorn "src.app:create_app()". The reference data is loaded first, so a
+    server that preloads the app loads it once in its master process. A best_parameters table without the algorithm
+    column is upgraded first, otherwise every query of it fails.
+    """
+    try:
+        upgrade_params_table()
+    except Exception as e:
+        app.logger.error('Unable to check %s for the algorithm column, run flask upgrade-db: %s', Params.__tablename__, e)
+    if preload and not reference_data_preloaded:
+        preload_reference_data()
+    return app
+
 if __name__ == "__main__":
     app.run(debug=True) 
\ No newline at end of file
@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+
+import pandas as pd
+
+BUNDLE_DIR = os.getenv("BUNDLE_DIR", "bundles")
+BUNDLE_VERSION = 1
+BUNDLE_FRAMES = ["articles", "authors", "labels", "summary_cube"]
+
+def bundle_path(file_name, directory=BUNDLE_DIR):
+    return os.path.join(directory, file_name.replace(".parquet", ""))
+
+def has_bundle(file_name, directory=BUNDLE_DIR):
+    return os.path.exists(os.path.join(bundle_path(file_name, directory), "manifest.json"))
+
+def file_checksum(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def write_bundle(path, file_name, frames, params, summaries):
+    """
+    Writes a dataset bundle, everything a dashboard needs in one directory.
+
+    Parameters:
+    path (str): Directory to write, replaced if it exists.
+    file_name (str): Dataset the bundle holds.
+    frames (dict): DataFrames for articles (clustering data), authors (grouped authors), labels (cluster_label to gpt_label) and summary_cube.
+    params (dict): The dataset's best_parameters row.
+    summaries (list): Cached GPT summaries as dicts of comparator_type, comparator and sentences.
+
+    Returns:
+    dict: The manifest.
+
+    Notes:
+    - Frames are written as parquet, summaries as JSON and the manifest last, so a bundle without a manifest is incomplete.
+    - The manifest records a sha256 checksum and row count for every file, checked by read_bundle.
+    """
+    temp = f"{path}.{os.getpid()}.tmp"
+    shutil.rmtree(temp, ignore_errors=True)
+    os.makedirs(temp)
+    files = {}
+    for name in BUNDLE_FRAMES:
+        frames[name].to_parquet(os.path.join(temp, f"{name}.parquet"), index=False)
+        files[f"{name}.parquet"] = {"rows": len(frames[name])}
+    with open(os.path.join(temp, "summaries.json"), "w") as f:
+        json.dump(summaries, f)
+    files["summaries.json"] = {"rows": len(summaries)}
+    for name, entry in files.items():
+        entry["sha256"] = file_checksum(os.path.join(temp, name))
+        entry["bytes"] = os.path.getsize(os.path.join(temp, name))
+
+    manifest = {"version": BUNDLE_VERSION, "file_name": file_name, "created_at": time.time(), "params": params, "files": files}
+    with open(os.path.join(temp, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2, default=str)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temp, path)
+    return manifest
+
+def read_manifest(path):
+    try:
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ValueError(f"{path} has no readable manifest: {e}")
+    if manifest.get("version") != BUNDLE_VERSION:
+        raise ValueError(f"{path} is bundle version {manifest.get('version')}, expected {BUNDLE_VERSION}")
+    # the manifest names the directory the bundle is imported to and the files checked, so neither may leave it
+    file_name = manifest.get("file_name")
+    if not isinstance(file_name, str) or file_name.replace(".parquet", "") in ["", "."] or ".." in file_name or any(sep in file_name for sep in ["/", "\\", os.sep]):
+        raise ValueError(f"{path} names an invalid dataset {file_name!r}")
+    unexpected = set(manifest["files"]) - {f"{name}.parquet" for name in BUNDLE_FRAMES} - {"summaries.json"}
+    if unexpected:
+        raise ValueError(f"{path} lists unexpected files {sorted(unexpected)}")
+    return manifest
+
+def verify_bundle(path):
+    """
+    Checks every file in a bundle against its manifest checksum, raises ValueError on a mismatch.
+    """
+    manifest = read_manifest(path)
+    for name, entry in manifest["files"].items():
+        file_path = os.path.join(path, name)
+        if not os.path.exists(file_path) or file_checksum(file_path) != entry["sha256"]:
+            raise ValueError(f"{file_path} is missing or does not match its checksum")
+    return manifest
+
+def read_bundle(path, verify=True):
+    """
+    Loads a bundle written by write_bundle.
+
+    Returns:
+    dict: The manifest's file_name and params, a DataFrame for each of BUNDLE_FRAMES and the list of summaries.
+    """
+    manifest = verify_bundle(path) if verify else read_manifest(path)
+    bundle = {"file_name": manifest["file_name"], "params": manifest["params"]}
+    for name in BUNDLE_FRAMES:
+        bundle[name] = pd.read_parquet(os.path.join(path, f"{name}.parquet"))
+    with open(os.path.join(path, "summaries.json")) as f:
+        bundle["summaries"] = json.load(f)
+    return bundle
+
+def import_bundle(source, directory=BUNDLE_DIR):
+    """
+    Verifies a bundle and copies it into the bundle directory the app serves from.
+
+    Returns:
+    dict: The manifest.
+    """
+    manifest = verify_bundle(source)
+    path = bundle_path(manifest["file_name"], directory)
+    if os.path.abspath(source) != os.path.abspath(path):
+        os.makedirs(directory, exist_ok=True)
+        temp = f"{path}.{os.getpid()}.tmp"
+        shutil.rmtree(temp, ignore_errors=True)
+        shutil.copytree(source, temp)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(temp, path)
+    return manifest
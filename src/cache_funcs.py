@@ -0,0 +1,527 @@
+import os
+import json
+import time
+import uuid
+import pickle
+import struct
+import hashlib
+import threading
+
+import pandas as pd
+
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+CACHE_TTL = int(os.getenv("CACHE_TTL", 6 * 3600))
+CACHE_HITS_FILE = os.getenv("CACHE_HITS_FILE", "cache_hits.json")
+CACHE_WARM_TOP_N = int(os.getenv("CACHE_WARM_TOP_N", 10))
+CACHE_WARM_WORKERS = int(os.getenv("CACHE_WARM_WORKERS", 1))
+CACHE_WARM_INTERVAL = int(os.getenv("CACHE_WARM_INTERVAL", 0)) # seconds between warming runs, 0 only warms at worker start
+CACHE_WARM_MAX_IN_FLIGHT = int(os.getenv("CACHE_WARM_MAX_IN_FLIGHT", 0)) # live requests tolerated while warming
+CACHE_WARM_MAX_WAIT = int(os.getenv("CACHE_WARM_MAX_WAIT", 60))
+CACHE_HITS_SAVE_INTERVAL = int(os.getenv("CACHE_HITS_SAVE_INTERVAL", 300))
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "local") # local, disk or redis
+CACHE_DIR = os.getenv("CACHE_DIR", "cache")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_CLUSTER = os.getenv("REDIS_CLUSTER", "false").lower() == "true"
+CACHE_LOCK_TIMEOUT = int(os.getenv("CACHE_LOCK_TIMEOUT", 600)) # longest a single computation may hold the lock
+LOCAL_CACHE_MAX_ENTRIES = int(os.getenv("LOCAL_CACHE_MAX_ENTRIES", 256)) # values each worker keeps with the local backend
+
+PARQUET_CACHE_DIR = os.getenv("PARQUET_CACHE_DIR", "parquet_cache") # kept apart from CACHE_DIR, clearing the caches doesn't redownload the parquet files
+PARQUET_CACHE_MAX_BYTES = int(os.getenv("PARQUET_CACHE_MAX_BYTES", 5 * 1024 ** 3))
+
+def serialise(value):
+    """
+    Serialises a cache value, DataFrames are written as Arrow IPC streams where pyarrow is available and everything else is pickled with protocol 5.
+    """
+    if isinstance(value, pd.DataFrame):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            pa = None
+        if pa is not None:
+            try:
+                table = pa.Table.from_pandas(value)
+                sink = pa.BufferOutputStream()
+                with pa.ipc.new_stream(sink, table.schema) as writer:
+                    writer.write_table(table)
+                return b"A" + sink.getvalue().to_pybytes()
+            except (pa.ArrowException, TypeError, ValueError):
+                pass # e.g. object columns holding mixed types, these are pickled instead
+    return b"P" + pickle.dumps(value, protocol=5)
+
+def deserialise(data):
+    if data[:1] == b"A":
+        import pyarrow as pa
+
+        return pa.ipc.open_stream(data[1:]).read_all().to_pandas()
+    return pickle.loads(data[1:])
+
+class LocalCache:
+    """
+    In process cache, values are stored as is so nothing is shared between workers.
+    Holds at most max_entries values, expired values are dropped on every set and then the least recently used ones.
+    """
+    def __init__(self, max_entries=LOCAL_CACHE_MAX_ENTRIES):
+        self.values = OrderedDict()
+        self.max_entries = max_entries
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self.values[key]
+                return None
+            self.values.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self.lock:
+            self.values[key] = (now + ttl, value)
+            self.values.move_to_end(key)
+            for expired in [name for name, (expires, _) in self.values.items() if expires < now]:
+                del self.values[expired]
+            while len(self.values) > self.max_entries:
+                self.values.popitem(last=False)
+
+    @contextmanager
+    def locked(self, key):
+        # a key's lock is counted by the callers holding or waiting for it and dropped with the last one
+        with self.lock:
+            key_lock, users = self.locks.get(key, (None, 0))
+            key_lock = key_lock or threading.Lock()
+            self.locks[key] = (key_lock, users + 1)
+        try:
+            with key_lock:
+                yield
+        finally:
+            with self.lock:
+                users = self.locks[key][1] - 1
+                if users:
+                    self.locks[key] = (key_lock, users)
+                else:
+                    del self.locks[key]
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+class LRUCache:
+    """
+    Small in process cache holding at most size entries, the least recently used entry is dropped first.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.values:
+                    self.values.move_to_end(key)
+                    found[key] = self.values[key]
+        return found
+
+    def set_many(self, items):
+        with self.lock:
+            for key, value in items.items():
+                self.values[key] = value
+                self.values.move_to_end(key)
+            while len(self.values) > self.size:
+                self.values.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+class DiskCache(LocalCache):
+    """
+    Cache shared by every worker on a host (or over a shared volume), one file per key with the expiry time in the first 8 bytes.
+    Locks are flock'd files, so they are released if the worker holding them dies.
+    """
+    def __init__(self, directory=CACHE_DIR):
+        super().__init__()
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self.path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if struct.unpack("d", data[:8])[0] < time.time():
+            return None
+        return deserialise(data[8:])
+
+    def set(self, key, value, ttl):
+        path = self.path(key)
+        temp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+        with open(temp, "wb") as f:
+            f.write(struct.pack("d", time.time() + ttl) + serialise(value))
+        os.replace(temp, path) # readers never see a partial file
+
+    @contextmanager
+    def locked(self, key):
+        import fcntl
+
+        with super().locked(key):
+            with open(self.path(key) + ".lock", "wb") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(".lock") and os.path.isfile(path):
+                os.remove(path)
+
+class RedisCache:
+    """
+    Cache shared across hosts through Redis (or a Redis cluster via redis-py-cluster).
+    Locks are SET NX keys with an expiry, so a crashed worker can only hold one for CACHE_LOCK_TIMEOUT seconds.
+    """
+    # deletes a lock only if it still holds our token, checked and deleted atomically so a lock that expired and was
+    # taken by another worker in between is left alone
+    UNLOCK_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+
+    def __init__(self, client=None, prefix="topic_clustering:"):
+        self.client = client if client is not None else self.connect()
+        self.prefix = prefix
+
+    @staticmethod
+    def connect():
+        if REDIS_CLUSTER:
+            from rediscluster import RedisCluster
+
+            return RedisCluster.from_url(REDIS_URL)
+        import redis
+
+        return redis.Redis.from_url(REDIS_URL)
+
+    def get(self, key):
+        data = self.client.get(self.prefix + key)
+        return None if data is None else deserialise(data)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, serialise(value), ex=int(ttl))
+
+    @contextmanager
+    def locked(self, key):
+        lock_key = f"{self.prefix}lock:{key}"
+        token = uuid.uuid4().hex
+        while not self.client.set(lock_key, token, nx=True, ex=CACHE_LOCK_TIMEOUT):
+            time.sleep(0.1)
+        try:
+            yield
+        finally:
+            self.client.eval(self.UNLOCK_SCRIPT, 1, lock_key, token)
+
+    def clear(self):
+        # the locks of computations still running are kept
+        lock_prefix = self.prefix + "lock:"
+        for key in self.client.scan_iter(match=self.prefix + "*"):
+            if not (key.decode() if isinstance(key, bytes) else key).startswith(lock_prefix):
+                self.client.delete(key)
+
+def create_backend(name=CACHE_BACKEND):
+    if name == "disk":
+        return DiskCache()
+    elif name == "redis":
+        return RedisCache()
+    return LocalCache()
+
+backend = [create_backend()]
+
+def set_backend(cache_backend):
+    """
+    Swaps the cache backend, e.g. for a RedisCache built around a test client.
+    """
+    backend[0] = cache_backend
+
+def cache_key(cache, key):
+    return json.dumps([cache, *key], default=str)
+
+def cached(cache, key, func, ttl=CACHE_TTL):
+    """
+    Returns the cached value for a key, computing and storing it with func on a miss.
+
+    Parameters:
+    cache (str): Name of the cache, one of labels, summaries or aggregates.
+    key (tuple): Cache key, normally the file_name followed by the comparator.
+    func (callable): Called with no arguments to compute the value on a miss.
+    ttl (int): Seconds before a cached value is recomputed.
+
+    Returns:
+    The cached or freshly computed value, cached frames may be shared so callers must not modify them in place.
+
+    Notes:
+    Misses are single flight, only one caller (across workers for the disk and redis backends) runs func for a key
+    while the others wait and then read its result.
+    """
+    key = cache_key(cache, key)
+    value = backend[0].get(key)
+    if value is not None:
+        return value
+    with backend[0].locked(key):
+        value = backend[0].get(key)
+        if value is None:
+            value = func()
+            backend[0].set(key, value, ttl)
+    return value
+
+def locked(cache, key):
+    """
+    Takes the lock cached uses for a key, for work that must only run once at a time but whose result isn't cached, e.g.
+    writing a table that other callers would otherwise write as well. Shared by every worker for the disk and redis backends.
+    """
+    return backend[0].locked(cache_key(cache, key))
+
+def get_cached(cache, key):
+    """
+    Returns the cached value for a key, or None on a miss, without computing anything.
+    """
+    return backend[0].get(cache_key(cache, key))
+
+def store(cache, key, value, ttl=CACHE_TTL):
+    backend[0].set(cache_key(cache, key), value, ttl)
+
+def is_cached(cache, key):
+    return get_cached(cache, key) is not None
+
+def clear_caches():
+    backend[0].clear()
+
+parquet_cache_lock = threading.Lock()
+
+def evict_parquet_cache(keep=None, directory=PARQUET_CACHE_DIR, max_bytes=PARQUET_CACHE_MAX_BYTES):
+    """
+    Deletes the least recently used files until the parquet cache is within max_bytes, keep is never deleted.
+    """
+    files = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith(".parquet") and path != keep:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue # evicted by another worker
+            files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in files) + (os.path.getsize(keep) if keep else 0)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+def read_s3_parquet(bucket, key, columns=None, directory=PARQUET_CACHE_DIR):
+    """
+    Reads a parquet object from S3 through a local read-through cache.
+
+    Parameters:
+    bucket (str): S3 bucket.
+    key (str): S3 key of the parquet file.
+    columns (list): Optional columns to read, the others are never decoded.
+    directory (str): Cache directory, shared by every worker on the host.
+
+    Returns:
+    DataFrame: The parquet file's contents.
+
+    Notes:
+    - Files are cached by key and ETag, so an overwritten object is downloaded again, the ETag costs one HEAD request.
+    - Cached files are memory mapped by pyarrow, repeat reads are bounded by local disk rather than the network.
+    - The least recently read files are evicted once the cache is over PARQUET_CACHE_MAX_BYTES.
+    """
+    import boto3
+    import pyarrow.parquet as pq
+
+    session = boto3.Session(aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"), aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"))
+    client = session.client('s3')
+    etag = client.head_object(Bucket=bucket, Key=key)["ETag"].strip('"')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, hashlib.sha1(f"{bucket}/{key}:{etag}".encode()).hexdigest() + ".parquet")
+
+    while True:
+        try:
+            os.utime(path) # the modified time orders the LRU
+        except FileNotFoundError:
+            temp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+            client.download_file(bucket, key, temp)
+            os.replace(temp, path)
+            with parquet_cache_lock:
+                evict_parquet_cache(keep=path, directory=directory)
+        try:
+            return pq.read_table(path, columns=columns, memory_map=True).to_pandas()
+        except FileNotFoundError:
+            continue # evicted by another worker before it was opened
+
+hits = Counter()
+unsaved_hits = Counter()
+hits_lock = threading.Lock()
+
+in_flight = [0]
+in_flight_lock = threading.Lock()
+
+def record_hit(file_name, comparator_type=None, comparator=None):
+    """
+    Counts a dashboard view of a dataset and comparator, used to decide what the warmer loads.
+    """
+    key = json.dumps([file_name, comparator_type, comparator])
+    with hits_lock:
+        hits[key] += 1
+        unsaved_hits[key] += 1
+
+def load_hits():
+    """
+    Merges the hit counts saved by previous runs (and other workers) into the in memory counter.
+    """
+    if not os.path.exists(CACHE_HITS_FILE):
+        return hits
+    try:
+        with open(CACHE_HITS_FILE) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return hits
+    with hits_lock:
+        for key, count in saved.items():
+            hits[key] = max(hits[key], count)
+    return hits
+
+def save_hits():
+    """
+    Adds this worker's new hits to the hit file, other workers' counts in the file are kept.
+
+    Workers update the file one at a time under an flock'd lock file, and it is replaced rather than rewritten in
+    place so a reader never sees it half written. Hits that could not be saved are kept for the next save.
+    """
+    import fcntl
+
+    with hits_lock:
+        new_hits = unsaved_hits.copy()
+        unsaved_hits.clear()
+    try:
+        with open(CACHE_HITS_FILE + ".lock", "wb") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                saved = Counter()
+                if os.path.exists(CACHE_HITS_FILE):
+                    try:
+                        with open(CACHE_HITS_FILE) as f:
+                            saved.update(json.load(f))
+                    except ValueError:
+                        pass # only a file written before saves were atomic can be partial
+                saved.update(new_hits)
+                temp = f"{CACHE_HITS_FILE}.{os.getpid()}.{threading.get_ident()}"
+                with open(temp, "w") as f:
+                    json.dump(dict(saved), f)
+                os.replace(temp, CACHE_HITS_FILE)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+    except OSError:
+        with hits_lock:
+            unsaved_hits.update(new_hits)
+        raise
+    with hits_lock:
+        for key, count in saved.items():
+            hits[key] = max(hits[key], count)
+
+def top_datasets(n=CACHE_WARM_TOP_N):
+    """
+    Returns the n most viewed (file_name, comparator_type, comparator) combinations.
+    """
+    with hits_lock:
+        return [tuple(json.loads(key)) for key, count in hits.most_common(n)]
+
+def request_started():
+    with in_flight_lock:
+        in_flight[0] += 1
+
+def request_finished():
+    with in_flight_lock:
+        in_flight[0] = max(in_flight[0] - 1, 0)
+
+def wait_for_quiet(max_in_flight=CACHE_WARM_MAX_IN_FLIGHT, max_wait=CACHE_WARM_MAX_WAIT):
+    """
+    Blocks until no more than max_in_flight live requests are running, returns False if that did not happen within max_wait seconds.
+    """
+    deadline = time.time() + max_wait
+    while in_flight[0] > max_in_flight:
+        if time.time() > deadline:
+            return False
+        time.sleep(0.5)
+    return True
+
+def warm_caches(warm_func, n=CACHE_WARM_TOP_N, workers=CACHE_WARM_WORKERS, logger=None):
+    """
+    Loads the caches for the most popular datasets.
+
+    Parameters:
+    warm_func (callable): Called with (file_name, comparator_type, comparator) to populate the caches for one dataset.
+    n (int): Number of datasets to warm.
+    workers (int): Datasets warmed at the same time.
+    logger (Logger): Optional logger for failures.
+
+    Returns:
+    int: Number of datasets warmed.
+
+    Notes:
+    - Each dataset waits until live traffic is below CACHE_WARM_MAX_IN_FLIGHT and is skipped if it stays busy, so the
+      warmer never competes with users.
+    - Failures are logged and do not stop the remaining datasets.
+    """
+    def warm(dataset):
+        if not wait_for_quiet():
+            return False
+        try:
+            warm_func(*dataset)
+            return True
+        except Exception as e:
+            if logger:
+                logger.error('Cache warming failed for %s: %s', dataset, e)
+            return False
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(warm, top_datasets(n)))
+
+def start_cache_warmer(warm_func, interval=CACHE_WARM_INTERVAL, logger=None):
+    """
+    Starts a daemon thread that warms the caches straight away and then every interval seconds (if interval is set).
+    The thread also saves this worker's hit counts every CACHE_HITS_SAVE_INTERVAL seconds.
+    """
+    def run():
+        last_warm = None
+        while True:
+            load_hits()
+            if last_warm is None or (interval and time.time() - last_warm >= interval):
+                warmed = warm_caches(warm_func, logger=logger)
+                last_warm = time.time()
+                if logger:
+                    logger.info('Cache warmer loaded %s datasets', warmed)
+            try:
+                save_hits()
+            except OSError as e:
+                if logger:
+                    logger.error('Unable to save cache hits: %s', e)
+            time.sleep(min(interval, CACHE_HITS_SAVE_INTERVAL) if interval else CACHE_HITS_SAVE_INTERVAL)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
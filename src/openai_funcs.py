@@ -1,18 +1,88 @@
 # %%
 import os 
 import re
+import time
 import openai
 import backoff
 
 import pandas as pd
 
+from concurrent.futures import ThreadPoolExecutor
 from openai.error import RateLimitError
-from langchain.prompts import PromptTemplate
-from langchain.llms import OpenAI
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.docstore.document import Document
-from langchain.llms.openai import OpenAI
-from langchain.chains.summarize import load_summarize_chain
+
+SUMMARY_MODEL = os.getenv("OPENAI_SUMMARY_MODEL", "text-davinci-003")
+SUMMARY_MAX_TOKENS = 256
+SUMMARY_MODE = os.getenv("OPENAI_SUMMARY_MODE", "auto") # auto, stuff or map_reduce
+SUMMARY_CONTEXT_TOKENS = int(os.getenv("OPENAI_SUMMARY_CONTEXT_TOKENS", 4097)) # context window of SUMMARY_MODEL
+SUMMARY_STUFF_TOKENS = int(os.getenv("OPENAI_SUMMARY_STUFF_TOKENS", 2000)) # in auto mode, larger prompts are map reduced
+SUMMARY_CHUNK_TOKENS = int(os.getenv("OPENAI_SUMMARY_CHUNK_TOKENS", 1000)) # table rows sent to each map call
+SUMMARY_MAP_WORKERS = int(os.getenv("OPENAI_SUMMARY_MAP_WORKERS", 4))
+CHARS_PER_TOKEN = 3 # the tables are mostly numbers, which take more tokens than English text
+
+TOPIC_SUMMARY_TEMPLATE = """
+    The following is a summary of a clustered dataset providing the topic names, growth 
+    if publications were provided for more than one year otherwise this will be absent 
+    (indicating the change in publication output, positive figures mean the discipline was growing) 
+    and average citations received per article published. Provide a summary of the table, 
+    indicating which topics are the most important (defined by categories displaying the 
+    most significant positive publication growth and high avg cites per article) and which 
+    display lower value (those with low or negative growth and avg citations). Use numbers 
+    and percentages in your summary. Please do not describe the names of the cluster labels.
+        {text}
+    """
+
+COMPARATOR_SUMMARY_TEMPLATE = """The following is a summary of a clustered dataset providing the topic names, growth (indicating the change in publication output, positive figures mean the discipline was growing) and average citations received per article published. Second is the same data but for either a single title published within the subject category or publications from a single country or region. Both datasets are separated by a "//". Please compare the two tables, indicating how the comparator compares to the overall subject category, furthermore suggest what topics the comparator should target to publish more papers and gain more citations. Use numbers and percentages in your summary and provide as much detail as possible in your response.
+        {text}
+    """
+
+TOPIC_MAP_TEMPLATE = """
+    The following rows are part of a summary of a clustered dataset providing the topic names, growth 
+    if publications were provided for more than one year otherwise this will be absent 
+    (indicating the change in publication output, positive figures mean the discipline was growing) 
+    and average citations received per article published. List which of these topics are the most important 
+    (defined by categories displaying the most significant positive publication growth and high avg cites per article) 
+    and which display lower value (those with low or negative growth and avg citations), with their numbers.
+        {text}
+    """
+
+TOPIC_REDUCE_TEMPLATE = """
+    The following are notes on parts of a clustered dataset, listing the most important topics (defined by 
+    categories displaying the most significant positive publication growth and high avg cites per article) 
+    and those of lower value (low or negative growth and avg citations). Provide a summary of the whole dataset, 
+    indicating which topics are the most important and which display lower value. Use numbers 
+    and percentages in your summary. Please do not describe the names of the cluster labels.
+        {text}
+    """
+
+COMPARATOR_MAP_TEMPLATE = """The following is part of a summary of a clustered dataset providing the topic names, growth (indicating the change in publication output, positive figures mean the discipline was growing) and average citations received per article published. Second is the same data but for either a single title published within the subject category or publications from a single country or region. Both datasets are separated by a "//". Please list how the comparator compares to the overall subject category for these topics, and which of them the comparator should target to publish more papers and gain more citations, with their numbers.
+        {text}
+    """
+
+COMPARATOR_REDUCE_TEMPLATE = """The following are notes comparing parts of a clustered dataset with either a single title published within the subject category or publications from a single country or region, by growth (indicating the change in publication output) and average citations received per article published. Please combine them into one comparison, indicating how the comparator compares to the overall subject category, furthermore suggest what topics the comparator should target to publish more papers and gain more citations. Use numbers and percentages in your summary and provide as much detail as possible in your response.
+        {text}
+    """
+
+# Sentences end at a full stop, unless it is a decimal point or the end of the text
+SENTENCE_END = r'(?<!\d)\.(?!\d|$)'
+
+def split_sentences(output):
+    """
+    Split a model response into sentences without breaking on decimal points.
+    
+    Parameters:
+    - output (str): The raw text returned by the model.
+    
+    Returns:
+    - list: The stripped sentences.
+    """
+    _list = re.split(SENTENCE_END, output.replace("\n", ""))
+    return [i.strip() for i in _list]
+
+def format_summary(sentences):
+    """
+    Ensure each sentence of a summary ends with a period, as displayed on the dashboards.
+    """
+    return [i + "." for i in sentences if i and i[-1] != "."]
 
 def generate_table_summary(df):
     """
@@ -72,7 +142,13 @@ def get_df_string(df):
     - str: A string representation of the DataFrame, formatted for GPT prompts.
     """
     
-    df_string = ""  # Initialize an empty string to store the results
+    return "".join(row + "\n" for row in df_rows(df))
+
+def df_rows(df):
+    """
+    The rows of get_df_string, one string per row of the DataFrame without the trailing newline.
+    """
+    rows = []
 
     # Iterate through each row of the DataFrame
     for index, row in df.iterrows():
@@ -87,10 +163,147 @@ def get_df_string(df):
         # Append the average citations for the current row
         text += f'Average citations: {round(row["avg_citations"], 2)}'
         
-        # Add the constructed row text to the final string with a newline
-        df_string += text + "\n"
+        rows.append(text)
+
+    return rows
+
+def estimate_tokens(text):
+    """
+    Estimates the number of tokens in a prompt from its length, rounding up so prompts are not underestimated.
+    """
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+def summary_mode(prompt, mode=SUMMARY_MODE):
+    """
+    Chooses how a summary prompt is sent to the model.
+    
+    Parameters:
+    - prompt (str): The complete single call (stuff) prompt.
+    - mode (str): auto, stuff or map_reduce.
+    
+    Returns:
+    - str: stuff or map_reduce.
+    
+    Notes:
+    - In auto mode prompts estimated above SUMMARY_STUFF_TOKENS are map reduced, as one long prompt is slow and 
+      the map calls run concurrently.
+    - A prompt that would not leave room for the completion in the context window is always map reduced.
+    """
+    tokens = estimate_tokens(prompt)
+    if tokens + SUMMARY_MAX_TOKENS > SUMMARY_CONTEXT_TOKENS:
+        return "map_reduce"
+    if mode == "auto":
+        return "stuff" if tokens <= SUMMARY_STUFF_TOKENS else "map_reduce"
+    return mode
+
+def pack(items, max_tokens, size=estimate_tokens):
+    """
+    Groups items in order so each group is estimated at no more than max_tokens, an item larger than that is a group on its own.
+    """
+    groups, group, tokens = [], [], 0
+    for item in items:
+        item_tokens = size(item)
+        if group and tokens + item_tokens > max_tokens:
+            groups.append(group)
+            group, tokens = [], 0
+        group.append(item)
+        tokens += item_tokens
+    if group:
+        groups.append(group)
+    return groups
+
+def new_usage(mode):
+    return {"mode": mode, "calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0}
+
+def add_usage(usage, response_usage):
+    usage["calls"] += 1
+    usage["prompt_tokens"] += response_usage.get("prompt_tokens", 0)
+    usage["completion_tokens"] += response_usage.get("completion_tokens", 0)
+
+@backoff.on_exception(backoff.expo, RateLimitError, max_time=60)
+def complete(prompt):
+    """
+    Sends one prompt to the summary model, with the same settings as the langchain chains.
+    
+    Returns:
+    - tuple: The completion text and the token usage reported by the API.
+    """
+    response = openai.Completion.create(
+        model=SUMMARY_MODEL,
+        prompt=prompt,
+        temperature=0.1,
+        max_tokens=SUMMARY_MAX_TOKENS,
+        api_key=os.getenv("OPENAI_TOPIC_CLUSTERING"),
+    )
+    return response["choices"][0]["text"], response.get("usage", {})
+
+def complete_all(prompts, usage):
+    """
+    Sends prompts to the model concurrently, SUMMARY_MAP_WORKERS at a time, and adds their token usage to usage.
+    
+    Returns:
+    - list: The completion texts in the order of the prompts.
+    """
+    with ThreadPoolExecutor(max_workers=SUMMARY_MAP_WORKERS) as executor:
+        results = list(executor.map(complete, prompts))
+    for text, response_usage in results:
+        add_usage(usage, response_usage)
+    return [text.strip() for text, response_usage in results]
+
+def reduce_prompt(map_template, reduce_template, chunks, usage):
+    """
+    Runs the map step of a map reduce summary and returns the prompt for the final reduce call.
+    
+    Parameters:
+    - map_template, reduce_template (str): Prompt templates with a {text} placeholder.
+    - chunks (list of str): The parts of the table, each sent to its own map call.
+    - usage (dict): Token usage, updated with the map calls.
+    
+    Notes:
+    - If the partial summaries are too long for one reduce call they are reduced in groups first, until they fit.
+    """
+    partials = complete_all([map_template.format(text=chunk) for chunk in chunks], usage)
+    while len(partials) > 1 and estimate_tokens(reduce_template.format(text="\n".join(partials))) > SUMMARY_STUFF_TOKENS:
+        groups = pack(partials, SUMMARY_CHUNK_TOKENS)
+        if len(groups) == len(partials):
+            break
+        partials = complete_all([reduce_template.format(text="\n".join(group)) for group in groups], usage)
+    return reduce_template.format(text="\n".join(partials))
+
+def topic_chunks(table):
+    """
+    Splits a summary table into get_df_string chunks of at most SUMMARY_CHUNK_TOKENS for the map calls.
+    """
+    return ["".join(row + "\n" for row in rows) for rows in pack(df_rows(table), SUMMARY_CHUNK_TOKENS)]
+
+def comparator_chunks(topic_table, comparator_table):
+    """
+    Splits the subject and comparator summary tables into chunks for the map calls, in the "//" separated form 
+    comparator_analysis uses. The rows of a topic in both tables are always in the same chunk, so each map call 
+    can compare them.
+    """
+    topic_rows = dict(zip(topic_table["gpt_label"], df_rows(topic_table)))
+    comparator_rows = dict(zip(comparator_table["gpt_label"], df_rows(comparator_table)))
+    labels = list(dict.fromkeys(list(topic_rows) + list(comparator_rows)))
+    size = lambda label: estimate_tokens(topic_rows.get(label, "") + comparator_rows.get(label, ""))
+    return [
+        "".join(topic_rows[label] + "\n" for label in group if label in topic_rows) + "//" +
+        "".join(comparator_rows[label] + "\n" for label in group if label in comparator_rows)
+        for group in pack(labels, SUMMARY_CHUNK_TOKENS, size)
+    ]
 
-    return df_string
+def stuff_usage(run, usage):
+    """
+    Runs a langchain stuff chain, adding the token usage langchain reports to usage.
+    """
+    from langchain.callbacks import get_openai_callback
+
+    with get_openai_callback() as callback:
+        output = run()
+    usage["calls"] += callback.successful_requests
+    usage["prompt_tokens"] += callback.prompt_tokens
+    usage["completion_tokens"] += callback.completion_tokens
+    return output
 
 def get_topic_summary(df_string):
     """
@@ -112,21 +325,18 @@ def get_topic_summary(df_string):
       summary and what details to focus on.
     """
     
+    # langchain is slow to import, so it is only loaded once a summary is actually requested
+    from langchain.prompts import PromptTemplate
+    from langchain.llms.openai import OpenAI
+    from langchain.text_splitter import CharacterTextSplitter
+    from langchain.docstore.document import Document
+    from langchain.chains.summarize import load_summarize_chain
+
     # Initialize the OpenAI model with specific parameters
-    llm = OpenAI(temperature=0.1, openai_api_key=os.getenv("OPENAI_TOPIC_CLUSTERING"))
+    llm = OpenAI(model_name=SUMMARY_MODEL, max_tokens=SUMMARY_MAX_TOKENS, temperature=0.1, openai_api_key=os.getenv("OPENAI_TOPIC_CLUSTERING"))
     
     # Template used to instruct the OpenAI model about the nature of the data and what kind of summary is expected
-    label_template = """
-    The following is a summary of a clustered dataset providing the topic names, growth 
-    if publications were provided for more than one year otherwise this will be absent 
-    (indicating the change in publication output, positive figures mean the discipline was growing) 
-    and average citations received per article published. Provide a summary of the table, 
-    indicating which topics are the most important (defined by categories displaying the 
-    most significant positive publication growth and high avg cites per article) and which 
-    display lower value (those with low or negative growth and avg citations). Use numbers 
-    and percentages in your summary. Please do not describe the names of the cluster labels.
-        {text}
-    """
+    label_template = TOPIC_SUMMARY_TEMPLATE
     
     # Split the input string into manageable chunks for the OpenAI model
     text_splitter = CharacterTextSplitter()
@@ -145,12 +355,11 @@ def get_topic_summary(df_string):
     output = chain.run(docs)
     
     # Split the output into individual sentences, while avoiding breaking on decimal points
-    _list = re.split(r'(?<!\d)\.(?!\d|$)', output.replace("\n", ""))
-    _list = [i.strip() for i in _list]
+    _list = split_sentences(output)
     
     return _list
 
-def topic_summary(df):
+def topic_summary(df, table=None):
     """
     Generate a summarized description of a DataFrame representing topic clusters.
     
@@ -167,25 +376,50 @@ def topic_summary(df):
     Parameters:
     - df (pandas.DataFrame): An input DataFrame, expected to have certain structure and columns 
                              as consumed by the 'generate_table_summary' function.
+    - table (pandas.DataFrame, optional): An already summarized table (e.g. from the summary cube), 
+                                          when given step 1 is skipped.
     
     Returns:
     - list: A list of sentences forming the summary.
     """
     
     # Step 1: Summarize the input DataFrame
-    table = generate_table_summary(df)
-    
-    # Step 2: Convert the summarized table into a string
-    df_string = get_df_string(table)
+    if table is None:
+        table = generate_table_summary(df)
     
-    # Step 3: Obtain a human-friendly summary from OpenAI's model
-    summary = get_topic_summary(df_string)
+    # Steps 2 and 3: Obtain a human-friendly summary from OpenAI's model
+    summary, usage = summarise_topics(table)
     
     # Step 4: Format the summary by ensuring each sentence ends with a period
-    summary = [i + "." for i in summary if i[-1] != "."]
+    summary = format_summary(summary)
     
     return summary
 
+def summarise_topics(table, mode=SUMMARY_MODE):
+    """
+    Summarises a table from generate_table_summary, in one call (stuff) for small tables or by summarising 
+    chunks of the table concurrently and combining the partial summaries in a final call (map_reduce).
+    
+    Parameters:
+    - table (pandas.DataFrame): The summarized table.
+    - mode (str): auto, stuff or map_reduce, see summary_mode.
+    
+    Returns:
+    - tuple: The sentences of the summary and a dict of the mode used, number of calls, prompt and completion 
+             tokens and seconds taken.
+    """
+    start = time.perf_counter()
+    df_string = get_df_string(table)
+    usage = new_usage(summary_mode(TOPIC_SUMMARY_TEMPLATE.format(text=df_string), mode))
+    if usage["mode"] == "stuff":
+        summary = stuff_usage(lambda: get_topic_summary(df_string), usage)
+    else:
+        text, response_usage = complete(reduce_prompt(TOPIC_MAP_TEMPLATE, TOPIC_REDUCE_TEMPLATE, topic_chunks(table), usage))
+        add_usage(usage, response_usage)
+        summary = split_sentences(text)
+    usage["seconds"] = time.perf_counter() - start
+    return summary, usage
+
 def generate_comp_table_summary(df, comparator):
     """
     Generate a summarized table of topic clusters based on a specific comparator column value.
@@ -252,16 +486,21 @@ def comparator_analysis(topic_string, comparator_string):
     - It uses specific template prompts and configurations for the OpenAI model.
     """
     
+    # imported locally, see get_topic_summary
+    from langchain.prompts import PromptTemplate
+    from langchain.llms.openai import OpenAI
+    from langchain.text_splitter import CharacterTextSplitter
+    from langchain.docstore.document import Document
+    from langchain.chains.summarize import load_summarize_chain
+
     # Combine the topic and comparator strings with a separator
     search_string = topic_string + "//" + comparator_string
     
     # Initialize OpenAI's model with specific parameters
-    llm = OpenAI(temperature=0.1, openai_api_key=os.getenv("OPENAI_TOPIC_CLUSTERING"))
+    llm = OpenAI(model_name=SUMMARY_MODEL, max_tokens=SUMMARY_MAX_TOKENS, temperature=0.1, openai_api_key=os.getenv("OPENAI_TOPIC_CLUSTERING"))
     
     # Define the prompt template to instruct the model on how to process and compare the datasets
-    label_template = """The following is a summary of a clustered dataset providing the topic names, growth (indicating the change in publication output, positive figures mean the discipline was growing) and average citations received per article published. Second is the same data but for either a single title published within the subject category or publications from a single country or region. Both datasets are separated by a "//". Please compare the two tables, indicating how the comparator compares to the overall subject category, furthermore suggest what topics the comparator should target to publish more papers and gain more citations. Use numbers and percentages in your summary and provide as much detail as possible in your response.
-        {text}
-    """
+    label_template = COMPARATOR_SUMMARY_TEMPLATE
     
     # Split the combined string into smaller chunks, if needed
     text_splitter = CharacterTextSplitter()
@@ -278,12 +517,11 @@ def comparator_analysis(topic_string, comparator_string):
     output = chain.run(docs)
     
     # Split the output into individual sentences, while avoiding splitting on decimal points
-    _list = re.split(r'(?<!\d)\.(?!\d|$)', output.replace("\n", ""))
-    _list = [i.strip() for i in _list]
+    _list = split_sentences(output)
     
     return _list
 
-def comparator_summary(topic_df, comparator_df):
+def comparator_summary(topic_df, comparator_df, topic_table=None, comparator_table=None):
     """
     Generates a comparative summary between a general topic dataset and a comparator dataset.
     
@@ -295,6 +533,8 @@ def comparator_summary(topic_df, comparator_df):
     Parameters:
     - topic_df (pandas.DataFrame): DataFrame representing the general topic dataset.
     - comparator_df (pandas.DataFrame): DataFrame representing the comparator dataset.
+    - topic_table, comparator_table (pandas.DataFrame, optional): Already summarized tables for either dataset, 
+                                                                  used in place of generate_table_summary.
     
     Returns:
     - list: A list of sentences forming the comparative analysis between the topic and comparator datasets.
@@ -304,21 +544,40 @@ def comparator_summary(topic_df, comparator_df):
     """
     
     # Generate summarized tables for the topic and comparator datasets
-    topic_table = generate_table_summary(topic_df)
-    comparator_table = generate_table_summary(comparator_df)
-    
-    # Convert the summarized tables to formatted strings
-    topic_df_string = get_df_string(topic_table)
-    comparator_df_string = get_df_string(comparator_table)
+    if topic_table is None:
+        topic_table = generate_table_summary(topic_df)
+    if comparator_table is None:
+        comparator_table = generate_table_summary(comparator_df)
     
     # Produce a comparative analysis using the OpenAI model
-    summary = comparator_analysis(topic_df_string, comparator_df_string)
+    summary, usage = summarise_comparator(topic_table, comparator_table)
     
     # Ensure each statement in the analysis ends with a period
-    summary = [i + "." for i in summary if i[-1] != "."]
+    summary = format_summary(summary)
     
     return summary
 
+def summarise_comparator(topic_table, comparator_table, mode=SUMMARY_MODE):
+    """
+    Comparator equivalent of summarise_topics, taking the summarized tables for the topic and comparator.
+    
+    Returns:
+    - tuple: The sentences of the comparative analysis and a dict of the mode used, number of calls, prompt and 
+             completion tokens and seconds taken.
+    """
+    start = time.perf_counter()
+    topic_df_string = get_df_string(topic_table)
+    comparator_df_string = get_df_string(comparator_table)
+    usage = new_usage(summary_mode(COMPARATOR_SUMMARY_TEMPLATE.format(text=topic_df_string + "//" + comparator_df_string), mode))
+    if usage["mode"] == "stuff":
+        summary = stuff_usage(lambda: comparator_analysis(topic_df_string, comparator_df_string), usage)
+    else:
+        text, response_usage = complete(reduce_prompt(COMPARATOR_MAP_TEMPLATE, COMPARATOR_REDUCE_TEMPLATE, comparator_chunks(topic_table, comparator_table), usage))
+        add_usage(usage, response_usage)
+        summary = split_sentences(text)
+    usage["seconds"] = time.perf_counter() - start
+    return summary, usage
+
 @backoff.on_exception(backoff.expo, RateLimitError, max_time=60)
 def generate_label(article_titles):
     """
@@ -358,4 +617,81 @@ def generate_label(article_titles):
     label = completion.choices[0].message.content.replace("\n", "")
     
     # Clean the label by removing any non-alphabetical characters and return
-    return re.sub(r'[^a-zA-Z ]', '', label)
\ No newline at end of file
+    return re.sub(r'[^a-zA-Z ]', '', label)
+
+
+def stream_completion(prompt):
+    """
+    Stream the text of a completion from the OpenAI model as it is generated.
+    
+    Parameters:
+    - prompt (str): The full prompt to send.
+    
+    Yields:
+    - str: Pieces of the completion text, in order.
+    
+    Notes:
+    - Uses the same model, temperature and token limit as the langchain chains, so streamed and 
+      non-streamed summaries are interchangeable.
+    """
+    response = openai.Completion.create(
+        model=SUMMARY_MODEL,
+        prompt=prompt,
+        temperature=0.1,
+        max_tokens=SUMMARY_MAX_TOKENS,
+        stream=True,
+        api_key=os.getenv("OPENAI_TOPIC_CLUSTERING"),
+    )
+    for chunk in response:
+        yield chunk["choices"][0]["text"]
+
+def stream_sentences(chunks):
+    """
+    Turn a stream of text pieces into formatted summary sentences as soon as each one is complete.
+    
+    Parameters:
+    - chunks (iterable of str): Text pieces, e.g. from stream_completion().
+    
+    Yields:
+    - str: Sentences exactly as format_summary(split_sentences(full_text)) would return them.
+    
+    Notes:
+    - A full stop at the end of the buffer is held back until the next piece arrives, as it could 
+      still turn out to be a decimal point.
+    """
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk.replace("\n", "")
+        sentences = re.split(SENTENCE_END, buffer)
+        buffer = sentences.pop()
+        for sentence in format_summary([i.strip() for i in sentences]):
+            yield sentence
+    for sentence in format_summary(split_sentences(buffer)):
+        yield sentence
+
+def stream_topic_summary(table):
+    """
+    Streamed equivalent of topic_summary(), taking the summarized table from generate_table_summary().
+    
+    Yields:
+    - str: The sentences of the summary.
+    
+    Notes:
+    - For a map reduced summary the map calls are made first and only the final reduce call is streamed.
+    """
+    prompt = TOPIC_SUMMARY_TEMPLATE.format(text=get_df_string(table))
+    if summary_mode(prompt) == "map_reduce":
+        prompt = reduce_prompt(TOPIC_MAP_TEMPLATE, TOPIC_REDUCE_TEMPLATE, topic_chunks(table), new_usage("map_reduce"))
+    yield from stream_sentences(stream_completion(prompt))
+
+def stream_comparator_summary(topic_table, comparator_table):
+    """
+    Streamed equivalent of comparator_summary(), taking the summarized tables for the topic and comparator.
+    
+    Yields:
+    - str: The sentences of the comparative analysis.
+    """
+    prompt = COMPARATOR_SUMMARY_TEMPLATE.format(text=get_df_string(topic_table) + "//" + get_df_string(comparator_table))
+    if summary_mode(prompt) == "map_reduce":
+        prompt = reduce_prompt(COMPARATOR_MAP_TEMPLATE, COMPARATOR_REDUCE_TEMPLATE, comparator_chunks(topic_table, comparator_table), new_usage("map_reduce"))
+    yield from stream_sentences(stream_completion(prompt))
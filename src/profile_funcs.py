@@ -0,0 +1,127 @@
+import os
+import re
+import sys
+import json
+import hmac
+import time
+import hashlib
+import threading
+
+from collections import Counter
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_SECRET = os.getenv("PROFILE_SECRET", "") # signs per request profiling flags, unset disables them
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0)) # share of all requests profiled, e.g. 0.01
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.005)) # seconds between stack samples
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", 200))
+
+def profile_token(path, secret=PROFILE_SECRET):
+    """
+    Returns the flag that enables profiling for a request path, sent as the X-Profile header or profile query parameter.
+    """
+    return hmac.new(secret.encode(), path.encode(), hashlib.sha256).hexdigest()
+
+def valid_token(token, path, secret=PROFILE_SECRET):
+    return bool(secret and token) and hmac.compare_digest(token, profile_token(path, secret))
+
+class Sampler:
+    """
+    Samples the call stack of one thread from a background thread every interval seconds, so the profiled code runs
+    without tracing hooks and the overhead is one stack walk per sample.
+    """
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.running = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while self.running.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def start(self):
+        self.started = time.time()
+        self.running.set()
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running.clear()
+        self.thread.join()
+        self.duration = time.time() - self.started
+        return self.stacks
+
+def folded(stacks):
+    """
+    Collapsed stack format read by flamegraph.pl, inferno and speedscope: the frames of each stack joined by semicolons and its sample count.
+    """
+    return "".join(f"{';'.join(stack)} {count}\n" for stack, count in stacks.items())
+
+def speedscope(stacks, name, interval=PROFILE_INTERVAL):
+    """
+    Converts sampled stacks to a speedscope sampled profile.
+    """
+    frames = {}
+    samples = []
+    weights = []
+    for stack, count in stacks.items():
+        samples.append([frames.setdefault(frame, len(frames)) for frame in stack])
+        weights.append(count * interval)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "shared": {"frames": [{"name": frame} for frame in frames]},
+        "profiles": [{"type": "sampled", "name": name, "unit": "seconds", "startValue": 0, "endValue": sum(weights), "samples": samples, "weights": weights}],
+        "name": name,
+        "exporter": "topic_clustering",
+    }
+
+def save_profile(meta, stacks, directory=PROFILE_DIR, keep=PROFILE_KEEP):
+    """
+    Stores a profile keyed by time, route and file_name, and deletes the oldest once more than keep are stored.
+
+    Returns:
+    str: The profile's id.
+    """
+    os.makedirs(directory, exist_ok=True)
+    profile_id = re.sub(r"[^\w.-]", "_", f"{int(meta['started'] * 1000)}-{meta['route']}-{meta.get('file_name') or 'none'}")
+    with open(os.path.join(directory, profile_id + ".json"), "w") as f:
+        json.dump({**meta, "id": profile_id, "samples": sum(stacks.values()), "stacks": [[list(stack), count] for stack, count in stacks.items()]}, f)
+    for old in list_profiles(directory)[keep:]:
+        os.remove(os.path.join(directory, old["id"] + ".json"))
+    return profile_id
+
+def list_profiles(directory=PROFILE_DIR):
+    """
+    Returns the metadata of the stored profiles, newest first.
+    """
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(directory), reverse=True):
+        if name.endswith(".json"):
+            with open(os.path.join(directory, name)) as f:
+                profile = json.load(f)
+            profile.pop("stacks")
+            profiles.append(profile)
+    return profiles
+
+def load_profile(profile_id, directory=PROFILE_DIR):
+    """
+    Returns a stored profile's metadata and stacks, or None if there is no such profile.
+    """
+    path = os.path.join(directory, os.path.basename(profile_id) + ".json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        profile = json.load(f)
+    profile["stacks"] = Counter({tuple(stack): count for stack, count in profile["stacks"]})
+    return profile
@@ -0,0 +1,125 @@
+import re
+import time
+import random
+import threading
+
+import numpy as np
+import pandas as pd
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+REQUEST_LINE = re.compile(r"Request: (GET|POST|PUT|DELETE|PATCH) (\S+)")
+
+def parse_log(lines):
+    """
+    Extracts the requests recorded by log_request_info from application.log lines.
+
+    Returns:
+    list: (method, path) tuples in the order they were logged.
+    """
+    requests = []
+    for line in lines:
+        match = REQUEST_LINE.search(line)
+        if match:
+            requests.append((match.group(1), match.group(2)))
+    return requests
+
+def traffic_model(requests, match_route):
+    """
+    Builds a traffic model from logged requests.
+
+    Parameters:
+    requests (list): (method, path) tuples, as returned by parse_log.
+    match_route (callable): Returns the route name for a path, or None for paths the app does not serve.
+
+    Returns:
+    DataFrame: One row per distinct path with its route and share of traffic, so the file_name and comparator mix of
+    each route is kept. Only GET requests are modelled as request bodies are not logged in a replayable form.
+    """
+    counts = Counter(path for method, path in requests if method == "GET")
+    model = pd.DataFrame({"path": list(counts), "count": list(counts.values())})
+    if model.empty:
+        return model.assign(route=pd.Series(dtype=object), share=pd.Series(dtype=float))
+    model["route"] = model["path"].map(match_route)
+    model = model[model["route"].notna()].copy()
+    model["share"] = model["count"] / model["count"].sum()
+    return model.sort_values("count", ascending=False, kind="stable").reset_index(drop=True)
+
+def split_model(model, refuse):
+    """
+    Removes the paths that can't be replayed from a traffic model.
+
+    Parameters:
+    model (DataFrame): Traffic model from traffic_model.
+    refuse (callable): Returns why a path can't be replayed (e.g. the services it would call), or None if it can.
+
+    Returns:
+    tuple: (1) the model of the remaining paths with their shares rescaled and (2) the refused paths with their route,
+    count and reason.
+    """
+    reasons = model["path"].map(refuse) if not model.empty else pd.Series(dtype=object)
+    refused = model.loc[reasons.notna(), ["path", "route", "count"]].assign(reason=reasons[reasons.notna()]).reset_index(drop=True)
+    model = model[reasons.isna()].reset_index(drop=True)
+    model["share"] = model["count"] / model["count"].sum() if not model.empty else model["count"]
+    return model, refused
+
+def replay(model, send, total=1000, concurrency=8, seed=0):
+    """
+    Replays a traffic model, requests are drawn from the model's paths in proportion to their share.
+
+    Parameters:
+    model (DataFrame): Traffic model from traffic_model.
+    send (callable): Makes one request for a path and returns its status code, exceptions count as errors.
+    total (int): Number of requests to make.
+    concurrency (int): Requests in flight at the same time.
+    seed (int): Seed for the request mix.
+
+    Returns:
+    tuple: (1) a DataFrame of route, status and latency (seconds) per request and (2) the elapsed wall time.
+    """
+    rows = random.Random(seed).choices(range(len(model)), weights=model["share"].tolist(), k=total)
+    paths = model["path"].tolist()
+    routes = model["route"].tolist()
+    results = []
+    lock = threading.Lock()
+
+    def run(row):
+        start = time.perf_counter()
+        try:
+            status = send(paths[row])
+        except Exception:
+            status = None
+        latency = time.perf_counter() - start
+        with lock:
+            results.append((routes[row], status, latency))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run, rows))
+    return pd.DataFrame(results, columns=["route", "status", "latency"]), time.perf_counter() - start
+
+def replay_report(results, elapsed):
+    """
+    Summarises replay results per route.
+
+    Returns:
+    DataFrame: Requests, throughput (requests per second), error rate (no response or a 5xx status) and p50, p95 and p99
+    latency in milliseconds for each route, with an overall row last.
+    """
+    def summarise(group):
+        latency = group["latency"].to_numpy() * 1000
+        errors = group["status"].isna() | (group["status"].fillna(0) >= 500)
+        return pd.Series({
+            "requests": len(group),
+            "throughput": len(group) / elapsed if elapsed else np.nan,
+            "error_rate": errors.mean(),
+            "p50_ms": np.percentile(latency, 50),
+            "p95_ms": np.percentile(latency, 95),
+            "p99_ms": np.percentile(latency, 99),
+        })
+
+    report = pd.DataFrame({route: summarise(group) for route, group in results.groupby("route")}).T
+    report.loc["all"] = summarise(results)
+    report["requests"] = report["requests"].astype(int)
+    return report
@@ -0,0 +1,171 @@
+import os
+import re
+import json
+import time
+import uuid
+import zipfile
+
+import pandas as pd
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+REPORT_DIR = os.getenv("REPORT_DIR", "reports")
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", 4)) # comparators worked on at once by a report
+REPORT_MAX_COMPARATORS = int(os.getenv("REPORT_MAX_COMPARATORS", 200))
+REPORT_KEEP = int(os.getenv("REPORT_KEEP", 50))
+REPORT_JOBS = int(os.getenv("REPORT_JOBS", 1)) # reports built at once by each worker process
+COMPARATOR_TYPES = ["journal", "publisher", "region", "country"]
+
+def parse_comparators(values):
+    """
+    Parses comparators given as comparator_type:comparator, e.g. country:Germany or journal:Nature.
+
+    Returns:
+    list: Distinct (comparator_type, comparator) tuples in the order given, raises ValueError for a malformed or unknown one.
+    """
+    comparators = []
+    for value in values:
+        comparator_type, _, comparator = value.strip().partition(":")
+        if comparator_type not in COMPARATOR_TYPES or not comparator.strip():
+            raise ValueError(f"{value!r} is not a comparator, expected one of {', '.join(COMPARATOR_TYPES)} followed by :name")
+        comparators.append((comparator_type, comparator.strip()))
+    comparators = list(dict.fromkeys(comparators))
+    if len(comparators) > REPORT_MAX_COMPARATORS:
+        raise ValueError(f"At most {REPORT_MAX_COMPARATORS} comparators can be exported in one report")
+    return comparators
+
+def new_report_id(file_name):
+    return f"{int(time.time())}-{file_name.replace('.parquet', '')}-{uuid.uuid4().hex[:8]}"
+
+def report_path(report_id, directory=REPORT_DIR):
+    return os.path.join(directory, os.path.basename(report_id) + ".zip")
+
+def progress_path(report_id, directory=REPORT_DIR):
+    return os.path.join(directory, os.path.basename(report_id) + ".json")
+
+def write_progress(report_id, progress, directory=REPORT_DIR):
+    """
+    Saves a report's progress next to its archive, so any worker on the host can answer a status request.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = progress_path(report_id, directory)
+    temp = f"{path}.{os.getpid()}.tmp"
+    with open(temp, "w") as f:
+        json.dump(progress, f)
+    os.replace(temp, path)
+
+def read_progress(report_id, directory=REPORT_DIR):
+    """
+    Returns a report's progress, or None if there is no such report.
+    """
+    try:
+        with open(progress_path(report_id, directory)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def prune_reports(directory=REPORT_DIR, keep=REPORT_KEEP):
+    """
+    Deletes the archives and progress of all but the keep most recent reports.
+    """
+    if not os.path.isdir(directory):
+        return
+    reports = [name[:-len(".json")] for name in os.listdir(directory) if name.endswith(".json")]
+    reports.sort(key=lambda report_id: os.path.getmtime(progress_path(report_id, directory)), reverse=True)
+    for report_id in reports[keep:]:
+        for path in (report_path(report_id, directory), progress_path(report_id, directory)):
+            if os.path.exists(path):
+                os.remove(path)
+
+def comparator_folder(comparator_type, comparator):
+    """
+    Folder of a comparator's files in a report archive, e.g. country_United_Kingdom.
+    """
+    if comparator_type == "subject":
+        return "subject"
+    return re.sub(r"[^\w.-]+", "_", f"{comparator_type}_{comparator}").strip("_")
+
+def run_comparators(comparators, work, workers=REPORT_WORKERS, progress=None):
+    """
+    Runs work for every comparator on a thread pool, so the dataset loaded by the caller is shared rather than copied.
+
+    Parameters:
+    comparators (list): (comparator_type, comparator) tuples.
+    work (callable): Takes a comparator_type and comparator and returns that comparator's report entry (a dict).
+    workers (int): Comparators worked on at once, the model calls for their summaries are made concurrently.
+    progress (callable): Optionally called with the number of comparators done, the total and the entry after each one.
+
+    Returns:
+    list: The entries in the order of comparators. A comparator that failed has an entry with its error rather than
+    stopping the report.
+    """
+    entries = {}
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = {executor.submit(work, comparator_type, comparator): (comparator_type, comparator) for comparator_type, comparator in comparators}
+        for future in as_completed(futures):
+            comparator_type, comparator = futures[future]
+            try:
+                entry = future.result()
+            except Exception as e:
+                entry = {"comparator_type": comparator_type, "comparator": comparator, "error": str(e)}
+            entries[(comparator_type, comparator)] = entry
+            if progress:
+                progress(len(entries), len(comparators), entry)
+    return [entries[comparator] for comparator in comparators]
+
+def write_report(path, file_name, params, entries):
+    """
+    Writes a report archive.
+
+    Parameters:
+    path (str): Zip file to write, replaced if it exists.
+    file_name (str): Dataset the report covers.
+    params (dict): The dataset's clustering parameters.
+    entries (list): Report entries from run_comparators, each with comparator_type, comparator and optionally the
+                    summary (list of sentences), topic_table, exemplars and authors (DataFrames) and error.
+
+    Returns:
+    dict: The manifest.
+
+    Notes:
+    - Every comparator has a folder (see comparator_folder) with summary.txt, topic_table.csv, exemplars.csv and authors.csv.
+    - comparators.csv lists the comparators with their row counts and errors, manifest.json the parameters and files.
+    - The archive is written to a temporary file first, so a partly written report is never downloaded.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp = f"{path}.{os.getpid()}.tmp"
+    files = []
+    index = []
+    folders = set()
+    with zipfile.ZipFile(temp, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for entry in entries:
+            folder = comparator_folder(entry["comparator_type"], entry["comparator"])
+            # comparators that only differ in punctuation would share a folder
+            folder = next(name for name in [folder] + [f"{folder}_{n}" for n in range(2, len(entries) + 2)] if name not in folders)
+            folders.add(folder)
+            if entry.get("summary") is not None:
+                archive.writestr(f"{folder}/summary.txt", "\n\n".join(entry["summary"]) + "\n")
+                files.append(f"{folder}/summary.txt")
+            for name in ["topic_table", "exemplars", "authors"]:
+                if entry.get(name) is not None:
+                    archive.writestr(f"{folder}/{name}.csv", entry[name].to_csv(index=False))
+                    files.append(f"{folder}/{name}.csv")
+            index.append({
+                "comparator_type": entry["comparator_type"],
+                "comparator": entry["comparator"],
+                "folder": folder,
+                **{name: len(entry[name]) if entry.get(name) is not None else None for name in ["exemplars", "authors", "summary"]},
+                "error": entry.get("error"),
+            })
+        archive.writestr("comparators.csv", pd.DataFrame(index, columns=["comparator_type", "comparator", "folder", "exemplars", "authors", "summary", "error"]).to_csv(index=False))
+        manifest = {
+            "file_name": file_name,
+            "created_at": time.time(),
+            "params": params,
+            "comparators": len(entries),
+            "errors": sum(1 for entry in entries if entry.get("error")),
+            "files": files + ["comparators.csv"],
+        }
+        archive.writestr("manifest.json", json.dumps(manifest, indent=2, default=str))
+    os.replace(temp, path)
+    return manifest
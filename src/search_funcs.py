@@ -0,0 +1,86 @@
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+SEARCH_LIMIT = int(os.getenv("SEARCH_LIMIT", 500)) # most results returned by a search
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN = re.compile(r"[a-z0-9]+")
+STOPWORDS = {"a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "into", "is", "it", "its", "of", "on", "or", "that", "the", "their", "this", "to", "via", "was", "were", "with"}
+
+def tokenize(text):
+    """
+    Lower case words and numbers of a title or query, without stopwords. A trailing s is dropped from words longer
+    than three letters so singular and plural forms match.
+    """
+    tokens = []
+    if not isinstance(text, str):
+        return tokens
+    for token in TOKEN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+def build_index(titles):
+    """
+    Builds an inverted index over article titles for bm25_search.
+
+    Parameters:
+    titles (Series): The article titles, positions in the index are positions in this series.
+
+    Returns:
+    dict: postings (term to arrays of article positions and term frequencies), the length of every title in tokens
+    and the average title length.
+    """
+    tokens = pd.Series([tokenize(title) for title in titles], dtype=object)
+    lengths = tokens.str.len().to_numpy(dtype=np.float32)
+    terms = tokens.explode().dropna()
+    postings = {}
+    if len(terms):
+        # sort the (term, position) pairs so each term's postings are one contiguous run, repeated pairs are its frequency
+        codes, vocabulary = pd.factorize(terms.to_numpy())
+        positions = terms.index.to_numpy(dtype=np.int64)
+        order = np.lexsort((positions, codes))
+        codes, positions = codes[order], positions[order]
+        pair_starts = np.flatnonzero(np.r_[True, (codes[1:] != codes[:-1]) | (positions[1:] != positions[:-1])])
+        frequencies = np.diff(np.r_[pair_starts, len(codes)]).astype(np.float32)
+        codes, positions = codes[pair_starts], positions[pair_starts].astype(np.int32)
+        term_starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        postings = dict(zip(vocabulary[codes[term_starts]], zip(np.split(positions, term_starts[1:]), np.split(frequencies, term_starts[1:]))))
+    return {"postings": postings, "lengths": lengths, "average_length": float(lengths.mean()) if len(lengths) else 0.0}
+
+def bm25_search(index, query, allowed=None, limit=SEARCH_LIMIT):
+    """
+    Ranks titles against a query with BM25.
+
+    Parameters:
+    index (dict): Index from build_index.
+    query (str): Search terms, titles matching any of them are returned.
+    allowed (ndarray): Optional boolean mask of the positions that may be returned, e.g. a comparator's articles.
+    limit (int): Most results to return, nothing is returned for 0 or less.
+
+    Returns:
+    tuple: (1) positions of the best matching titles, best first, (2) their scores and (3) the number of matching titles.
+    """
+    lengths = index["lengths"]
+    scores = np.zeros(len(lengths), dtype=np.float32)
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / (index["average_length"] or 1))
+    for term in dict.fromkeys(tokenize(query)):
+        if term not in index["postings"]:
+            continue
+        positions, frequencies = index["postings"][term]
+        idf = np.log(1 + (len(lengths) - len(positions) + 0.5) / (len(positions) + 0.5))
+        scores[positions] += idf * frequencies * (BM25_K1 + 1) / (frequencies + norm[positions])
+    if allowed is not None:
+        scores[~allowed] = 0
+    matches = np.flatnonzero(scores > 0)
+    if len(matches) > limit:
+        matches = matches[np.argpartition(-scores[matches], limit - 1)[:limit]] if limit > 0 else matches[:0]
+    matches = matches[np.argsort(-scores[matches], kind="stable")]
+    return matches, scores[matches], int(np.count_nonzero(scores > 0))
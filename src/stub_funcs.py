@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+
+import boto3
+
+from botocore.exceptions import ClientError
+
+STUB_JOURNAL = os.getenv("STUB_JOURNAL", "stubs.sqlite") # shared by the workers on a host
+STUB_FLUSH_INTERVAL = int(os.getenv("STUB_FLUSH_INTERVAL", 60)) # seconds between flushes to S3
+STUB_WRITE_ATTEMPTS = int(os.getenv("STUB_WRITE_ATTEMPTS", 5)) # conditional writes retried after losing a race
+STUB_CLAIM_TIMEOUT = int(os.getenv("STUB_CLAIM_TIMEOUT", max(STUB_FLUSH_INTERVAL, 60))) # seconds before a batch claimed by a worker that died is flushed again
+STUB_BUCKET = "rootbucket"
+STUB_PREFIX = "topic_clustering/test_folder/stubs/"
+STUB_QUEUE_KEY = STUB_PREFIX + "queue.json"
+
+def connect(path=STUB_JOURNAL):
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("""CREATE TABLE IF NOT EXISTS stub_requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        file_name TEXT NOT NULL,
+        user TEXT NOT NULL,
+        requested_at REAL NOT NULL,
+        batch TEXT,
+        claimed_at REAL
+    )""")
+    if "claimed_at" not in [column[1] for column in connection.execute("PRAGMA table_info(stub_requests)")]:
+        try:
+            connection.execute("ALTER TABLE stub_requests ADD COLUMN claimed_at REAL") # journals created before claims expired
+        except sqlite3.OperationalError:
+            pass # added by another worker in between
+    return connection
+
+def record_stub(file_name, user, path=STUB_JOURNAL):
+    """
+    Records a request for a dataset that has not been clustered yet, user is the email to notify or "None".
+
+    The request is appended to the local journal and reaches S3 with the next flush_stubs, so a request costs no S3
+    round trips and concurrent requests for the same dataset cannot overwrite each other.
+    """
+    connection = connect(path)
+    try:
+        connection.execute("INSERT INTO stub_requests (file_name, user, requested_at) VALUES (?, ?, ?)", (file_name, user, time.time()))
+    finally:
+        connection.close()
+
+def claim_batch(connection, timeout=STUB_CLAIM_TIMEOUT):
+    """
+    Marks every unflushed request as part of a new batch, so a worker flushing at the same time cannot send them twice.
+
+    Requests in a batch claimed more than timeout seconds ago are claimed again, as the worker flushing it died (or was
+    killed) before releasing or deleting it. If that worker was only slow its requests are counted twice in the queue,
+    stub files are unaffected as users are only added once.
+
+    Returns:
+    tuple: The batch id and its (file_name, user, requested_at) rows.
+    """
+    batch = uuid.uuid4().hex
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        connection.execute("UPDATE stub_requests SET batch = ?, claimed_at = ? WHERE batch IS NULL OR claimed_at IS NULL OR claimed_at < ?", (batch, now, now - timeout))
+        rows = connection.execute("SELECT file_name, user, requested_at FROM stub_requests WHERE batch = ? ORDER BY id", (batch,)).fetchall()
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    return batch, rows
+
+def stub_key(file_name):
+    return STUB_PREFIX + file_name.replace("parquet", "txt")
+
+def conditional_update(client, key, update, attempts=STUB_WRITE_ATTEMPTS):
+    """
+    Read-modify-write of an S3 object that is only applied if nobody else wrote the object in between.
+
+    Parameters:
+    client: boto3 S3 client.
+    key (str): Object key in STUB_BUCKET.
+    update (callable): Takes the current body (None if the object does not exist) and returns the new body.
+    attempts (int): Tries before giving up when other writers keep winning.
+
+    Notes:
+    The put is conditional on the ETag that was read (IfMatch), or on the object still not existing (IfNoneMatch), and is
+    retried from a fresh read when S3 rejects it.
+    """
+    for attempt in range(attempts):
+        try:
+            response = client.get_object(Bucket=STUB_BUCKET, Key=key)
+            body, condition = response["Body"].read().decode("utf-8"), {"IfMatch": response["ETag"]}
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                raise
+            body, condition = None, {"IfNoneMatch": "*"}
+        try:
+            client.put_object(Bucket=STUB_BUCKET, Key=key, Body=update(body).encode("utf-8"), **condition)
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("PreconditionFailed", "ConditionalRequestConflict"):
+                raise
+    raise RuntimeError(f"Gave up writing s3://{STUB_BUCKET}/{key} after {attempts} conflicting writes")
+
+def add_users(body, users):
+    """
+    Adds users to a stub file's comma separated list, the format the offline pipeline reads.
+    """
+    contents = body.split(",") if body else []
+    for user in users:
+        if user not in contents:
+            contents.append(user)
+    return ",".join(contents)
+
+def merge_queue(body, rows):
+    """
+    Adds a batch of requests to the consolidated queue of requested datasets.
+
+    Returns:
+    str: The queue as JSON, a list of datasets with their number of requests, distinct users and first and last request
+    time, ordered by demand (most requests first, then earliest request).
+    """
+    queue = {entry["file_name"]: entry for entry in (json.loads(body) if body else [])}
+    for file_name, user, requested_at in rows:
+        entry = queue.setdefault(file_name, {"file_name": file_name, "requests": 0, "users": [], "first_requested": requested_at, "last_requested": requested_at})
+        entry["requests"] += 1
+        if user != "None" and user not in entry["users"]:
+            entry["users"].append(user)
+        entry["first_requested"] = min(entry["first_requested"], requested_at)
+        entry["last_requested"] = max(entry["last_requested"], requested_at)
+    return json.dumps(sorted(queue.values(), key=lambda entry: (-entry["requests"], entry["first_requested"])), indent=1)
+
+def flush_stubs(client=None, path=STUB_JOURNAL):
+    """
+    Sends the journal's unflushed requests to S3 in one batch: each requested dataset's stub file gets the new users and
+    the queue (STUB_QUEUE_KEY) gets the new request counts.
+
+    Returns:
+    int: Number of requests flushed.
+
+    Notes:
+    - Requests are only deleted from the journal once every write has succeeded, a failed batch is released and retried
+      by the next flush, and the batch of a worker that died mid flush by the first flush after STUB_CLAIM_TIMEOUT.
+    - A dataset requested many times between flushes costs one conditional write, however many requests it had.
+    """
+    connection = connect(path)
+    try:
+        batch, rows = claim_batch(connection)
+        if not rows:
+            return 0
+        try:
+            if client is None:
+                session = boto3.Session(aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"), aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"))
+                client = session.client("s3")
+            users = {}
+            for file_name, user, requested_at in rows:
+                users.setdefault(file_name, []).append(user)
+            for file_name, file_users in users.items():
+                conditional_update(client, stub_key(file_name), lambda body: add_users(body, file_users))
+            conditional_update(client, STUB_QUEUE_KEY, lambda body: merge_queue(body, rows))
+        except Exception:
+            connection.execute("UPDATE stub_requests SET batch = NULL, claimed_at = NULL WHERE batch = ?", (batch,))
+            raise
+        connection.execute("DELETE FROM stub_requests WHERE batch = ?", (batch,))
+        return len(rows)
+    finally:
+        connection.close()
+
+def read_queue(client=None):
+    """
+    Returns the consolidated queue of requested datasets, ordered by demand, as written by flush_stubs.
+    """
+    if client is None:
+        session = boto3.Session(aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"), aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"))
+        client = session.client("s3")
+    try:
+        return json.loads(client.get_object(Bucket=STUB_BUCKET, Key=STUB_QUEUE_KEY)["Body"].read())
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return []
+        raise
+
+def start_stub_flusher(interval=STUB_FLUSH_INTERVAL, logger=None):
+    """
+    Starts a daemon thread that flushes the stub journal to S3 every interval seconds.
+    """
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                flushed = flush_stubs()
+                if flushed and logger:
+                    logger.info('Flushed %s stub requests to S3', flushed)
+            except Exception as e:
+                if logger:
+                    logger.error('Unable to flush stub requests: %s', e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
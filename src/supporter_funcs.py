@@ -1,13 +1,14 @@
 import boto3
 import os
 import re
+import pickle
 import openai
 import backoff
-import hdbscan
 
 import numpy as np
 import pandas as pd
 
+from botocore.exceptions import ClientError
 from openai.error import RateLimitError
 
 def gen_file_name(cat, pub_years):
@@ -47,39 +48,24 @@ def search_s3(file_name):
     except:
         return False 
 
-def write_stub_s3(file_name, user):
+def shard_files(file_name):
     """
-    Writes or updates a stub file in the S3 bucket with the user's name.
-
-    Parameters:
-    file_name (str): Name of the file corresponding to the stub to be written.
-    user (str): User's name to be added to the stub file.
-
-    Returns:
-    bool: True if the stub file is updated or written successfully, False if a new file is created.
+    Returns the per year shard file names a dataset is composed from, e.g. Oncology_2019.parquet and Oncology_2020.parquet for Oncology_2019_2020.parquet.
+    """
+    return [gen_file_name(get_subject(file_name), [year]) for year in get_pub_years(file_name)]
 
-    Notes:
-    Checks and updates a .txt file replacing its .parquet extension in the same directory.
-    If the user's name is not present in the existing file, it is appended.
+def search_shards(file_name):
+    """
+    Checks whether every per year shard of a dataset exists in S3, under 'topic_clustering/test_folder/shards/umaps/'.
     """
     session = boto3.Session(aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"), aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"))
+    client = session.client('s3')
     try:
-        client = session.client('s3')
-        data = client.get_object(Bucket='rootbucket', Key=f'topic_clustering/test_folder/stubs/{file_name.replace("parquet", "txt")}')
-        contents = data["Body"].read().decode('utf-8').split(",")
-        if user not in contents:
-            contents.append(user)
-        contents = ",".join(contents)
-        s3 = session.resource('s3')
-        object = s3.Object("rootbucket", f"topic_clustering/test_folder/stubs/{file_name.replace('parquet', 'txt')}")
-        object.put(Body=contents)
+        for shard in shard_files(file_name):
+            client.head_object(Bucket='rootbucket', Key=f'topic_clustering/test_folder/shards/umaps/{shard}')
         return True
     except:
-        s3 = session.resource('s3')
-        object = s3.Object("rootbucket", f"topic_clustering/test_folder/stubs/{file_name.replace('parquet', 'txt')}")
-        object.put(Body=user)
         return False
-    
 
 def get_subject(file_name):
     subject = [x for x in re.findall(r'\D+', file_name) if x not in ['.txt', '_']]
@@ -119,12 +105,13 @@ def generate_label(article_titles):
     label = completion.choices[0].message.content.replace("\n", "")
     return label
 
-def create_gpt_label_dataframe(exemplars):
+def create_gpt_label_dataframe(exemplars, known_labels=None):
     """
     Creates a DataFrame with GPT-generated labels for clusters of articles.
 
     Parameters:
     exemplars (DataFrame): DataFrame with article titles and their cluster labels.
+    known_labels (dict): Optional labels to reuse, keyed by cluster label. These clusters are not sent to GPT.
 
     Returns:
     DataFrame: A DataFrame containing cluster labels and corresponding GPT-generated labels.
@@ -133,14 +120,107 @@ def create_gpt_label_dataframe(exemplars):
     For each unique cluster, a sample of 20 article titles is chosen to generate a label.
     The resulting DataFrame includes a 'cluster_label' and a 'gpt_label' for each cluster.
     """
+    known_labels = known_labels or {}
     gpt_labels = pd.DataFrame()
     for cluster in exemplars.cluster_label.unique().tolist():
-        cluster_exemplars = exemplars["article_title"][exemplars["cluster_label"]==cluster].sample(20).tolist()
-        label = generate_label(cluster_exemplars)
+        if cluster in known_labels:
+            label = known_labels[cluster]
+        else:
+            cluster_exemplars = exemplars["article_title"][exemplars["cluster_label"]==cluster].sample(20).tolist()
+            label = generate_label(cluster_exemplars)
         gpt_labels = pd.concat([gpt_labels, pd.DataFrame({"cluster_label":cluster, "gpt_label":label}, index=[0])])
     return gpt_labels
 
-def initalise_clusterer(df, min_cluster_size, min_samples, cluster_selection_method, cluster_selection_epsilon, metric):
+LABEL_REUSE_THRESHOLD = float(os.getenv("LABEL_REUSE_THRESHOLD", 0.7))
+
+def match_clusters(base, new, threshold=LABEL_REUSE_THRESHOLD, column="gpt_label"):
+    """
+    Matches the clusters of a new clustering run to those of a base run by the Jaccard similarity of their DOIs.
+
+    Parameters:
+    base (DataFrame): Base clustering data with doi, cluster_label and gpt_label columns.
+    new (DataFrame): New clustering data with doi and cluster_label columns.
+    threshold (float): Minimum Jaccard similarity for two clusters to be treated as the same topic.
+    column (str): Base column to return for each match, gpt_label or cluster_label.
+
+    Returns:
+    dict: The base gpt_label (or column) for each matched new cluster label.
+
+    Notes:
+    - Unclustered articles (-1) are ignored on both sides.
+    - Matching is one to one, the most similar pairs are taken first so a base label is never given to two new clusters.
+    """
+    base = base.loc[base["cluster_label"] != -1, ["doi", "cluster_label", "gpt_label"]].drop_duplicates("doi")
+    new = new.loc[new["cluster_label"] != -1, ["doi", "cluster_label"]].drop_duplicates("doi")
+    base_sizes = base["cluster_label"].value_counts()
+    new_sizes = new["cluster_label"].value_counts()
+
+    pairs = new.merge(base, on="doi", suffixes=("_new", "_base")).groupby(["cluster_label_new", "cluster_label_base"]).size().rename("overlap").reset_index()
+    union = pairs["cluster_label_new"].map(new_sizes).values + pairs["cluster_label_base"].map(base_sizes).values - pairs["overlap"]
+    pairs["jaccard"] = pairs["overlap"] / union
+    pairs = pairs[pairs["jaccard"] >= threshold].sort_values("jaccard", ascending=False, kind="stable")
+
+    base_labels = base.drop_duplicates("cluster_label").set_index("cluster_label")["gpt_label"]
+    matches = {}
+    used = set()
+    for new_cluster, base_cluster in zip(pairs["cluster_label_new"], pairs["cluster_label_base"]):
+        if new_cluster in matches or base_cluster in used or (column == "gpt_label" and pd.isna(base_labels[base_cluster])):
+            continue
+        matches[new_cluster] = base_labels[base_cluster] if column == "gpt_label" else base_cluster
+        used.add(base_cluster)
+    return matches
+
+def relabel_clusters(cluster_labels, base, threshold=LABEL_REUSE_THRESHOLD):
+    """
+    Labels the clusters of a reclustered dataset, reusing the base run's GPT labels for clusters that survived the parameter change.
+
+    Parameters:
+    cluster_labels (DataFrame): New clustering data, as returned by get_cluster_labels.
+    base (DataFrame): Base clustering data for the same dataset, or None to label every cluster.
+    threshold (float): Minimum DOI Jaccard similarity for a label to be reused.
+
+    Returns:
+    tuple: (1) a DataFrame of cluster_label and gpt_label as create_gpt_label_dataframe returns and
+           (2) the number of GPT calls saved.
+    """
+    exemplars = cluster_labels[cluster_labels["exemplar"]==True]
+    known_labels = match_clusters(base, cluster_labels, threshold) if base is not None else {}
+    calls_saved = len(set(known_labels) & set(exemplars["cluster_label"].unique().tolist()))
+    return create_gpt_label_dataframe(exemplars, known_labels), calls_saved
+
+CLUSTER_PARALLEL_MIN_ROWS = int(os.getenv("CLUSTER_PARALLEL_MIN_ROWS", 20000)) # below this, starting core distance workers costs more than it saves
+CLUSTER_LARGE_ROWS = int(os.getenv("CLUSTER_LARGE_ROWS", 50000))
+CLUSTER_CPUS = int(os.getenv("CLUSTER_CPUS", os.cpu_count() or 1))
+KDTREE_METRICS = ["euclidean", "l2", "minkowski", "p", "manhattan", "cityblock", "l1", "chebyshev", "infinity"]
+
+def clusterer_engine(n_rows, metric, algorithm=None, cpus=CLUSTER_CPUS):
+    """
+    Chooses how HDBSCAN builds its tree and minimum spanning tree for a dataset.
+
+    Parameters:
+    n_rows (int): Number of points to cluster.
+    metric (str): Distance metric for clustering.
+    algorithm (str): Optional HDBSCAN algorithm that overrides the choice, e.g. from the algorithm column of best_parameters.
+    cpus (int): CPUs available for computing core distances.
+
+    Returns:
+    dict: algorithm, leaf_size, approx_min_span_tree and core_dist_n_jobs keyword arguments for hdbscan.HDBSCAN.
+
+    Notes:
+    - The coordinates are 2D, so Boruvka on a KD tree is used for every metric a KD tree supports and on a ball tree otherwise.
+    - Larger leaves mean fewer tree nodes to visit, which pays off once the dataset is large.
+    - Core distances are only spread across CPUs from CLUSTER_PARALLEL_MIN_ROWS rows, below that the workers cost more than they save.
+    """
+    if algorithm is None:
+        algorithm = "boruvka_kdtree" if metric in KDTREE_METRICS else "boruvka_balltree"
+    return {
+        "algorithm": algorithm,
+        "leaf_size": 100 if n_rows >= CLUSTER_LARGE_ROWS else 40,
+        "approx_min_span_tree": True,
+        "core_dist_n_jobs": max(cpus, 1) if n_rows >= CLUSTER_PARALLEL_MIN_ROWS else 1,
+    }
+
+def initalise_clusterer(df, min_cluster_size, min_samples, cluster_selection_method, cluster_selection_epsilon, metric, prediction_data=False, algorithm=None):
     """
     Initializes an HDBSCAN clusterer with specified parameters.
 
@@ -151,30 +231,42 @@ def initalise_clusterer(df, min_cluster_size, min_samples, cluster_selection_met
     cluster_selection_method (str): Method used for cluster selection.
     cluster_selection_epsilon (float): Epsilon value for cluster selection.
     metric (str): Distance metric for clustering.
+    prediction_data (bool): Keep the data approximate_predict needs to assign new points to the fitted clusters.
+    algorithm (str): Optional HDBSCAN algorithm, chosen by clusterer_engine if not given.
 
     Returns:
     HDBSCAN: An HDBSCAN clustering object fitted to the data.
 
     Notes:
     The function takes UMAP coordinates from the input DataFrame for clustering.
+    hdbscan is imported here rather than at module level as it is only needed on a recompute.
     """
+    import hdbscan
+
     clusterer = hdbscan.HDBSCAN(
         min_cluster_size=min_cluster_size,
         min_samples=min_samples,
         cluster_selection_method=cluster_selection_method,
         cluster_selection_epsilon=cluster_selection_epsilon,
         metric=metric,
+        prediction_data=prediction_data,
+        **clusterer_engine(len(df), metric, algorithm),
     ).fit(df[["coord_x", "coord_y"]])
     return clusterer
 
-def get_cluster_labels(df, params):
+ARTICLE_COLUMNS = ["doi", "article_title", "full_source_title", "citations", "year_published", "art_oa_status", "publisher_group", "coord_x", "coord_y", "prid_country", "prid_region"]
+SCATTER_COLUMNS = ["doi", "coord_x", "coord_y", "citations", "year_published", "art_oa_status", "gpt_label"] # what the dashboard charts draw
+ARTICLE_DETAIL_COLUMNS = ["doi", "article_title", "full_source_title", "prid_country", "prid_region"] # fetched on hover
+
+def get_cluster_labels(df, params, clusterer=None):
     """
     Assigns HDBSCAN cluster labels to each document in the DataFrame.
 
     Parameters:
     df (DataFrame): The DataFrame containing UMAP coordinates.
     params (dict): Parameters for HDBSCAN clustering, including minimum cluster size, 
-                   minimum samples, cluster selection method, epsilon, and metric.
+                   minimum samples, cluster selection method, epsilon, metric and optionally algorithm.
+    clusterer (HDBSCAN): Optional clusterer already fitted to df, params are ignored if given.
 
     Returns:
     tuple: A tuple containing (1) the updated DataFrame with cluster labels and exemplar flags, 
@@ -186,7 +278,8 @@ def get_cluster_labels(df, params):
     - Exemplar points for each cluster are identified and merged into the DataFrame.
     - The function calculates and returns the percentage of points clustered and the total number of clusters.
     """
-    clusterer = initalise_clusterer(df, params["min_cluster_size"], params["min_samples"], params["cluster_selection_method"], params["cluster_selection_epsilon"], params["metric"])
+    if clusterer is None:
+        clusterer = initalise_clusterer(df, params["min_cluster_size"], params["min_samples"], params["cluster_selection_method"], params["cluster_selection_epsilon"], params["metric"], algorithm=params.get("algorithm"))
     df["cluster_label"] = clusterer.labels_
     pct_clustered = 1 - np.count_nonzero(clusterer.labels_ == -1) / len(clusterer.labels_)
     number_clusters = clusterer.labels_.max() + 1
@@ -202,6 +295,82 @@ def get_cluster_labels(df, params):
 
     return df, pct_clustered, number_clusters
 
+def fit_clusterer(df, params):
+    """
+    Fits an HDBSCAN clusterer that can assign new articles with approximate_predict.
+    """
+    return initalise_clusterer(df, params["min_cluster_size"], params["min_samples"], params["cluster_selection_method"], params["cluster_selection_epsilon"], params["metric"], prediction_data=True, algorithm=params.get("algorithm"))
+
+def clusterer_key(file_name):
+    return f"topic_clustering/test_folder/clusterers/{file_name.replace('parquet', 'pkl')}"
+
+def save_clusterer(file_name, clusterer):
+    """
+    Pickles a dataset's fitted clusterer to S3 next to its umaps and stubs.
+    """
+    session = boto3.Session(aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"), aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"))
+    session.client('s3').put_object(Bucket='rootbucket', Key=clusterer_key(file_name), Body=pickle.dumps(clusterer, protocol=5))
+
+def load_clusterer(file_name):
+    """
+    Returns the saved clusterer for a dataset, or None if one has not been saved.
+    """
+    session = boto3.Session(aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"), aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"))
+    try:
+        data = session.client('s3').get_object(Bucket='rootbucket', Key=clusterer_key(file_name))
+    except ClientError:
+        return None
+    return pickle.loads(data["Body"].read())
+
+def assign_clusters(clusterer, df):
+    """
+    Assigns new articles to the clusters of an already fitted clusterer.
+
+    Parameters:
+    clusterer (HDBSCAN): Clusterer fitted with prediction data, see fit_clusterer.
+    df (DataFrame): New articles with UMAP coordinates projected into the same space as the fitted data.
+
+    Returns:
+    tuple: A tuple containing (1) the DataFrame with cluster labels and exemplar set to False and
+           (2) the share of the new articles that could not be assigned to a cluster.
+    """
+    import hdbscan
+
+    labels, strengths = hdbscan.approximate_predict(clusterer, df[["coord_x", "coord_y"]].to_numpy())
+    df["cluster_label"] = labels
+    df["exemplar"] = False
+    outlier_rate = np.count_nonzero(labels == -1) / len(labels) if len(labels) else 0.0
+    return df, outlier_rate
+
+def collect_unique_strings(groups, values):
+    """
+    Builds the string form of the ordered unique list of values for each group, matching str(list(dict.fromkeys(group))).
+
+    Parameters:
+    groups (Series): Group number of each row, as returned by groupby.ngroup().
+    values (Series): Values to collect for each group.
+
+    Returns:
+    Series: The list string for each group, indexed by group number.
+
+    Notes:
+    - Duplicates are dropped per group keeping the first occurrence, so the original ordering is preserved. None and
+      nan are kept apart as they are by dict.fromkeys.
+    - repr is only called once per distinct value, the concatenation is done by a single groupby sum.
+    """
+    codes, uniques = pd.factorize(values)
+    missing = np.flatnonzero(codes == -1)
+    # factorize and drop_duplicates treat None and nan as one value, dict.fromkeys keeps both
+    codes[missing[np.array([x is None for x in values.values[missing]], dtype=bool)]] = -2
+    firsts = pd.DataFrame({"group": groups.values, "code": codes}, index=values.index).drop_duplicates()
+    reprs = np.array([repr(x) + ", " for x in uniques] + [None, None], dtype=object)[firsts["code"].values]
+    missing = firsts["code"].values < 0 # formatted as they are
+    reprs[missing] = [repr(x) + ", " for x in values.loc[firsts.index[missing]].values]
+    joined = pd.Series(reprs, index=firsts.index, dtype=object).groupby(firsts["group"]).sum()
+    return "[" + joined.str[:-2] + "]"
+
+AUTHOR_COLUMNS = ["doi", "author_full_name", "research_org", "prid_country", "prid_region", "full_source_title", "publisher_group"]
+
 def group_authors(articles, authors):
     """
     Groups authors based on GPT-generated labels, citations, and other metadata.
@@ -219,46 +388,209 @@ def group_authors(articles, authors):
     - Aggregates data to calculate total publications, citations, and lists of source titles and publishers per group.
     - Calculates the average citations per article for each author group.
     - Cleans special characters from specific columns and converts certain lists to string representations.
+    - Everything is done with vectorised pandas operations and a single sort (citations, then label and publications
+      to break ties), the output matches the original per group lambda implementation.
     """
     df_authors = authors.merge(articles[["doi", "gpt_label", "citations"]], on="doi", how="left").drop_duplicates()
     df_authors = df_authors[df_authors["gpt_label"].notna()]
 
-    def collect_group(group):       
-        return list(dict.fromkeys(group))
-
-    authors_grouped = (
-        df_authors.groupby(
-            [
-                "gpt_label",
-                "author_full_name",
-                "research_org",
-                "prid_country",
-                "prid_region",
-            ]
-        )
-        .agg(
-            sum_published=pd.NamedAgg(
-                column="author_full_name", aggfunc="count"
-            ),
-            sum_citations=pd.NamedAgg(column="citations", aggfunc="sum"),
-            full_source_title_list=pd.NamedAgg(column="full_source_title", aggfunc=collect_group),
-            publisher_group_list=pd.NamedAgg(column="publisher_group", aggfunc=collect_group)
-        )
-        .reset_index()
-        .sort_values(
-            by=["gpt_label", "sum_published", "sum_citations"],
-            ascending=[True, False, False],
-        )
-    ).sort_values("sum_citations", ascending=False)
-    
+    keys = ["gpt_label", "author_full_name", "research_org", "prid_country", "prid_region"]
+    grouped = df_authors.groupby(keys)
+
+    authors_grouped = grouped.agg(
+        sum_published=pd.NamedAgg(column="author_full_name", aggfunc="count"),
+        sum_citations=pd.NamedAgg(column="citations", aggfunc="sum"),
+    ).reset_index()
+
+    groups = grouped.ngroup()
+    in_group = groups >= 0 # rows with a missing key are dropped by the groupby and given -1 here
+    authors_grouped["full_source_title_list"] = collect_unique_strings(groups[in_group], df_authors["full_source_title"][in_group])
+    authors_grouped["publisher_group_list"] = collect_unique_strings(groups[in_group], df_authors["publisher_group"][in_group])
+
+    authors_grouped = authors_grouped.sort_values(
+        by=["sum_citations", "gpt_label", "sum_published"],
+        ascending=[False, True, False],
+        kind="stable",
+    )
+
     for col in ["author_full_name","research_org","prid_country","prid_region"]:
-        authors_grouped[col] = authors_grouped[col].apply(lambda x: re.sub(r'\W+', '', x))
+        codes, uniques = pd.factorize(authors_grouped[col]) # cleaned once per distinct value, countries and regions repeat heavily
+        authors_grouped[col] = pd.Series(uniques).str.replace(r'\W+', '', regex=True).values[codes]
 
     authors_grouped["avg_cites_per_article"] = (authors_grouped["sum_citations"] / authors_grouped["sum_published"]).astype(int) 
 
     authors_grouped = authors_grouped.reset_index(drop=False, names="index")
 
-    authors_grouped["full_source_title_list"] = authors_grouped["full_source_title_list"].apply(lambda x: str(x))
-    authors_grouped["publisher_group_list"] = authors_grouped["publisher_group_list"].apply(lambda x: str(x))
+    return authors_grouped
+
+TA7 = ["United Kingdom","Germany","Australia","New Zealand","Canada","France","Italy","Spain"]
+REGIONS = ["Africa & Middle East","Asia","Australasia","Central & South America","Europe","North America"]
+
+def filter_comparator(df, comparator_type, comparator, exact_journal=False):
+    """
+    Filters the clustering data down to the articles matching a comparator, as used by the comparator dashboards.
+
+    Parameters:
+    df (DataFrame): Clustering data for a dataset.
+    comparator_type (str): One of journal, publisher, region or country, anything else returns the frame unchanged.
+    comparator (str): The comparator value selected by the user.
+    exact_journal (bool): Match journals on the full title, as the exemplar lists and downloads do, rather than any title containing it.
 
-    return authors_grouped    
\ No newline at end of file
+    Returns:
+    DataFrame: The rows of df belonging to the comparator.
+    """
+    if comparator_type == "journal" and exact_journal:
+        return df[df["full_source_title"] == comparator]
+    elif comparator_type == "journal":
+        return df[df["full_source_title"].apply(lambda x: comparator in x)]
+    elif comparator_type == "publisher":
+        return df[df["publisher_group"] == comparator.upper()]
+    elif comparator_type == "region" and comparator == "TA7":
+        return df[df["prid_country"].apply(lambda x: any(country in x for country in TA7))]
+    elif comparator_type == "region":
+        return df[df["prid_region"].apply(lambda x: comparator in x)]
+    elif comparator_type == "country":
+        return df[df["prid_country"].apply(lambda x: comparator in x)]
+    return df
+
+def filter_authors(df, comparator_type=None, comparator=None):
+    """
+    Selects the grouped authors for a dashboard from an authors frame, matching the database query used for the authors table.
+
+    Returns:
+    list: Named tuples of the author rows, ordered by label and then average citations.
+    """
+    if comparator_type == "journal":
+        df = df[df["full_source_title_list"].str.contains("'"+str(comparator)+"'", regex=False)]
+    elif comparator_type == "publisher":
+        df = df[df["publisher_group_list"].str.contains("'"+str(comparator.upper())+"'", regex=False)]
+    elif comparator_type == "region" and comparator == "TA7":
+        df = df[df["prid_country"].apply(lambda x: any(country in x for country in TA7))]
+    elif comparator_type == "region":
+        df = df[df["prid_region"] == comparator]
+    elif comparator_type == "country":
+        df = df[df["prid_country"] == comparator]
+    df = df.sort_values(["gpt_label", "avg_cites_per_article"], ascending=[True, False], kind="stable")
+    return list(df.itertuples(index=False, name="Author"))
+
+def choropleth_counts(df, comparator_type=None, comparator=None):
+    """
+    Publications per label and country from an authors frame, matching the database query of the choropleth map.
+
+    Returns:
+    list: (gpt_label, prid_country, publications) tuples.
+    """
+    if comparator_type == "region" and comparator == "TA7":
+        df = df[df["prid_country"].isin(TA7)]
+    elif comparator_type == "region":
+        df = df[df["prid_region"] == comparator]
+    elif comparator_type == "country":
+        df = df[df["prid_country"] == comparator]
+    counts = df.groupby(["gpt_label", "prid_country"])["sum_published"].sum()
+    return [(gpt_label, prid_country, int(publications)) for (gpt_label, prid_country), publications in counts.items()]
+
+def comparator_matches(values, candidates, exact=False):
+    """
+    Pairs the distinct values of a column with every comparator they belong to.
+
+    Parameters:
+    values (Series): Column the comparator filters on.
+    candidates (list): Comparator values to test.
+    exact (bool): Match on equality rather than the substring test the dashboards use.
+
+    Returns:
+    DataFrame: value and comparator columns, one row per match.
+    """
+    distinct = [x for x in values.dropna().unique().tolist()]
+    pairs = [(value, candidate) for candidate in candidates for value in distinct if (candidate == value if exact else candidate in str(value))]
+    return pd.DataFrame(pairs, columns=["value", "comparator"])
+
+def build_summary_cube(df, countries=None):
+    """
+    Builds the article count and citation totals by gpt_label, year and comparator for every comparator in a dataset.
+
+    Parameters:
+    df (DataFrame): Clustering data for a dataset.
+    countries (list): Countries to include, defaults to the distinct prid_country values in df.
+
+    Returns:
+    DataFrame: comparator_type, comparator, gpt_label, year_published, count, citations_sum and citations_count columns.
+
+    Notes:
+    - The whole subject is stored with comparator_type "subject" and an empty comparator.
+    - Every journal, publisher, region (including TA7) and country is stored using the same matching rules as filter_comparator.
+    - Each comparator type needs a single groupby over the rows, matching is done on the distinct column values.
+    - Rows without a gpt_label are kept (with a null label) so the years present in each comparator are known.
+    """
+    df = df.assign(citations_count=df["citations"].notna().astype(int))
+    cell = ["gpt_label", "year_published"]
+    aggs = dict(count=pd.NamedAgg(column="year_published", aggfunc="size"), citations_sum=pd.NamedAgg(column="citations", aggfunc="sum"), citations_count=pd.NamedAgg(column="citations_count", aggfunc="sum"))
+
+    cubes = [df.groupby(cell, dropna=False).agg(**aggs).reset_index().assign(comparator_type="subject", comparator="")]
+
+    countries = [x for x in (countries if countries is not None else df["prid_country"].dropna().unique().tolist()) if x]
+    comparators = [
+        ("journal", "full_source_title", comparator_matches(df["full_source_title"], df["full_source_title"].dropna().unique().tolist())),
+        ("publisher", "publisher_group", comparator_matches(df["publisher_group"], df["publisher_group"].dropna().unique().tolist(), exact=True)),
+        ("region", "prid_region", comparator_matches(df["prid_region"], REGIONS)),
+        ("region", "prid_country", comparator_matches(df["prid_country"], TA7).assign(comparator="TA7").drop_duplicates()),
+        ("country", "prid_country", comparator_matches(df["prid_country"], countries)),
+    ]
+    for comparator_type, column, matches in comparators:
+        grouped = df.groupby([*cell, column], dropna=False).agg(**aggs).reset_index()
+        cube = grouped.merge(matches, left_on=column, right_on="value", how="inner")
+        cube = cube.groupby([*cell, "comparator"], dropna=False)[["count", "citations_sum", "citations_count"]].sum().reset_index()
+        cubes.append(cube.assign(comparator_type=comparator_type))
+
+    cube = pd.concat(cubes, ignore_index=True)
+    return cube[["comparator_type", "comparator", *cell, "count", "citations_sum", "citations_count"]]
+
+def cube_key(comparator_type, comparator):
+    """
+    Returns the comparator value the summary cube stores a comparator under.
+    """
+    return comparator.upper() if comparator_type == "publisher" else comparator
+
+def summary_from_cube(cube):
+    """
+    Rebuilds the generate_table_summary output from the summary cube rows of a single comparator.
+
+    Parameters:
+    cube (DataFrame): Summary cube rows for one comparator_type and comparator.
+
+    Returns:
+    DataFrame: gpt_label, growth (when more than one year is present) and avg_citations columns.
+    """
+    multi_year = len(cube.year_published.unique().tolist()) > 1
+    cube = cube[cube["gpt_label"].notna()]
+
+    df_summary = cube.pivot(index="gpt_label", columns="year_published", values="count").fillna(0).reset_index(drop=False)
+    if multi_year:
+        df_summary["growth"] = round(((df_summary.iloc[:, -1] / df_summary.iloc[:, -2]) * 100)-100,2)
+
+    cite_summary = cube.groupby("gpt_label")[["citations_sum", "citations_count"]].sum().reset_index(drop=False)
+    cite_summary["citations"] = cite_summary["citations_sum"] / cite_summary["citations_count"]
+    df_summary = df_summary.merge(cite_summary[["gpt_label", "citations"]], on="gpt_label", how="left")
+
+    if multi_year:
+        return df_summary[["gpt_label", "growth", "citations"]].rename(columns={"citations": "avg_citations"})
+    else:
+        return df_summary[["gpt_label", "citations"]].rename(columns={"citations": "avg_citations"})
+
+EXEMPLAR_COLUMNS = ["doi", "article_title", "full_source_title", "citations", "year_published", "art_oa_status", "publisher_group", "gpt_label"]
+
+def get_exemplars(df, comparator_type=None, comparator=None):
+    """
+    Selects the exemplar articles for a dashboard from the already loaded clustering data.
+
+    Parameters:
+    df (DataFrame): Clustering data for a dataset.
+    comparator_type (str): Optional comparator type to filter on.
+    comparator (str): Optional comparator value to filter on.
+
+    Returns:
+    list: Named tuples of the exemplar columns, ordered by cluster label.
+    """
+    exemplars = filter_comparator(df[df["exemplar"] == True], comparator_type, comparator, exact_journal=True)
+    exemplars = exemplars.sort_values("cluster_label", kind="stable")
+    return list(exemplars[EXEMPLAR_COLUMNS].itertuples(index=False, name="Exemplar"))
@@ -0,0 +1,136 @@
+import os
+import time
+import random
+import itertools
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
+
+SWEEP_WORKERS = int(os.getenv("SWEEP_WORKERS", os.cpu_count() or 1))
+SWEEP_TIME_BUDGET = int(os.getenv("SWEEP_TIME_BUDGET", 3600)) # seconds, candidates not finished by then are abandoned
+SWEEP_PATIENCE = int(os.getenv("SWEEP_PATIENCE", 40)) # finished candidates without an improvement before stopping, 0 never stops early
+SWEEP_MIN_DELTA = float(os.getenv("SWEEP_MIN_DELTA", 0.001))
+SWEEP_CLUSTERED_WEIGHT = float(os.getenv("SWEEP_CLUSTERED_WEIGHT", 0.5)) # weight of percent clustered against DBCV in the score
+
+SWEEP_GRID = {
+    "min_cluster_size": [25, 50, 100, 200, 400],
+    "min_samples": [1, 5, 10, 25, 50],
+    "cluster_selection_method": ["eom", "leaf"],
+    "cluster_selection_epsilon": [0.0, 0.1, 0.25, 0.5],
+    "metric": ["euclidean", "manhattan"],
+}
+SWEEP_OPTIONAL = ["algorithm"] # only searched when given in the grid, otherwise clusterer_engine picks it
+
+coords = [None]
+
+def sweep_candidates(grid=None, samples=None, seed=0):
+    """
+    Builds the parameter sets to evaluate.
+
+    Parameters:
+    grid (dict): Values to try for each HDBSCAN parameter, defaults to SWEEP_GRID. Missing parameters use the SWEEP_GRID
+                 values, SWEEP_OPTIONAL parameters are only searched if given.
+    samples (int): Number of candidates drawn at random from the grid, None evaluates the full grid.
+    seed (int): Seed for the random search.
+
+    Returns:
+    list: Parameter dicts in the order they will be evaluated.
+    """
+    grid = {**SWEEP_GRID, **(grid or {})}
+    names = list(SWEEP_GRID) + [name for name in SWEEP_OPTIONAL if name in grid]
+    candidates = [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+    if samples is not None and samples < len(candidates):
+        candidates = random.Random(seed).sample(candidates, samples)
+    return candidates
+
+def attach_coords(name, shape, dtype):
+    """
+    Process pool initializer, maps the coordinate array from shared memory so it is not pickled for every candidate.
+    """
+    memory = shared_memory.SharedMemory(name=name)
+    coords[0] = (memory, np.ndarray(shape, dtype=dtype, buffer=memory.buf))
+
+def score_candidate(params):
+    """
+    Clusters the shared coordinates with one parameter set.
+
+    Returns:
+    dict: The parameters, including the algorithm clusterer_engine chose, with the DBCV (relative_validity_), percent
+    clustered, number of clusters and combined score. Candidates HDBSCAN rejects, or that find no clusters, score -inf.
+    """
+    import hdbscan
+    from src.supporter_funcs import clusterer_engine
+
+    params = dict(params)
+    engine = clusterer_engine(len(coords[0][1]), params["metric"], algorithm=params.pop("algorithm", None), cpus=1) # the pool already keeps every CPU busy
+    result = {**params, "algorithm": engine["algorithm"], "dbcv": None, "pct_clustered": 0.0, "number_clusters": 0, "score": float("-inf")}
+    try:
+        clusterer = hdbscan.HDBSCAN(gen_min_span_tree=True, **params, **engine).fit(coords[0][1])
+        labels = clusterer.labels_
+        result["number_clusters"] = int(labels.max() + 1)
+        if result["number_clusters"] < 2:
+            return result
+        result["pct_clustered"] = 1 - np.count_nonzero(labels == -1) / len(labels)
+        result["dbcv"] = float(clusterer.relative_validity_)
+        result["score"] = (1 - SWEEP_CLUSTERED_WEIGHT) * result["dbcv"] + SWEEP_CLUSTERED_WEIGHT * result["pct_clustered"]
+    except (ValueError, ZeroDivisionError) as e:
+        result["error"] = str(e)
+    return result
+
+def run_sweep(df, candidates, workers=SWEEP_WORKERS, time_budget=SWEEP_TIME_BUDGET, patience=SWEEP_PATIENCE, logger=None):
+    """
+    Evaluates HDBSCAN parameter sets across a process pool and returns the best.
+
+    Parameters:
+    df (DataFrame): DataFrame containing the UMAP coordinates.
+    candidates (list): Parameter dicts, as returned by sweep_candidates.
+    workers (int): Candidates evaluated at the same time.
+    time_budget (int): Seconds the sweep may run for, candidates still running then are abandoned.
+    patience (int): Stop once this many candidates in a row have not improved the best score by SWEEP_MIN_DELTA, 0 disables.
+    logger (Logger): Optional logger for progress.
+
+    Returns:
+    tuple: (1) the best result dict, None if no candidate found clusters, and (2) every evaluated result.
+
+    Notes:
+    - The coordinates are copied once into shared memory and mapped by every worker.
+    - When the sweep stops early (time budget or patience) the queued candidates are cancelled and the worker processes
+      still running candidates are terminated, so a slow candidate can't overrun the budget.
+    """
+    array = np.ascontiguousarray(df[["coord_x", "coord_y"]].to_numpy(dtype=np.float64))
+    memory = shared_memory.SharedMemory(create=True, size=array.nbytes)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)[:] = array
+    deadline = time.time() + time_budget
+    best = None
+    results = []
+    since_improvement = 0
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=attach_coords, initargs=(memory.name, array.shape, array.dtype))
+    stopped = False
+    try:
+        pending = {executor.submit(score_candidate, params) for params in candidates}
+        while pending and not stopped:
+            done, pending = wait(pending, timeout=max(deadline - time.time(), 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                results.append(result)
+                if result["score"] > float("-inf") and (best is None or result["score"] > best["score"] + SWEEP_MIN_DELTA):
+                    best = result
+                    since_improvement = 0
+                    if logger:
+                        logger.info('Sweep candidate %s of %s is the new best: %s', len(results), len(candidates), best)
+                else:
+                    since_improvement += 1
+            stopped = bool(pending) and (time.time() >= deadline or bool(patience and since_improvement >= patience))
+        if stopped and logger:
+            logger.info('Sweep stopped after %s of %s candidates', len(results), len(candidates))
+    finally:
+        executor.shutdown(wait=not stopped, cancel_futures=True)
+        if stopped:
+            # running candidates can't be cancelled, the executor has no public way to stop its processes
+            for process in list((executor._processes or {}).values()):
+                process.terminate()
+        memory.close()
+        memory.unlink()
+    return best, results
@@ -0,0 +1,63 @@
+import os
+import json
+import time
+import tempfile
+
+import pytest
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# the app reads its configuration at import time, so the environment is set up before any test imports it
+TEST_DIR = tempfile.mkdtemp(prefix="topic_clustering_tests_")
+SCHEMAS = ["clustering_data", "authors", "summary_cube", "custom_clustering_data", "custom_authors", "custom_summary_cube", "cluster_assignments"]
+FORM_DATA = {
+    "subjects": ["Oncology"],
+    "countries": ["", "China", "United Kingdom", "USA"],
+    "publishers": ["", "Elsevier"],
+    "initalised_comparitors": ["", "Cell"],
+    "comparitors_by_subject": {"Oncology": ["CELL", "NATURE"]},
+    "loaded_at": time.time(),
+}
+
+os.environ.setdefault("SQLALCHEMY_DATABASE_URI", f"sqlite:///{TEST_DIR}/main.db")
+os.environ.setdefault("FORM_DATA_SNAPSHOT", os.path.join(TEST_DIR, "form_data.json"))
+os.environ.setdefault("CACHE_HITS_FILE", os.path.join(TEST_DIR, "cache_hits.json"))
+os.environ.setdefault("CACHE_DIR", os.path.join(TEST_DIR, "cache"))
+os.environ.setdefault("STUB_JOURNAL", os.path.join(TEST_DIR, "stubs.sqlite"))
+os.environ.setdefault("BUNDLE_DIR", os.path.join(TEST_DIR, "bundles"))
+os.environ.setdefault("REPORT_DIR", os.path.join(TEST_DIR, "reports"))
+os.environ.setdefault("PROFILE_DIR", os.path.join(TEST_DIR, "profiles"))
+os.environ.setdefault("CACHE_WARM", "false")
+os.environ.setdefault("STUB_FLUSH_INTERVAL", "0")
+
+with open(os.environ["FORM_DATA_SNAPSHOT"], "w") as f:
+    json.dump(FORM_DATA, f)
+
+@event.listens_for(Engine, "connect")
+def attach_schemas(connection, record):
+    # SQLite has no schemas, each one the app uses is an attached database
+    if "sqlite" in type(connection).__module__:
+        for schema in SCHEMAS:
+            connection.execute(f"ATTACH DATABASE '{TEST_DIR}/{schema}.db' AS {schema}")
+
+def begin_transaction(connection):
+    connection.exec_driver_sql("BEGIN")
+
+@pytest.fixture
+def transactional_ddl():
+    # pysqlite only opens a transaction before DML, so a CREATE TABLE that comes first is committed even if the
+    # transaction later rolls back. Not on for every test, reads would then hold locks in the app's global session
+    event.listen(Engine, "begin", begin_transaction)
+    yield
+    event.remove(Engine, "begin", begin_transaction)
+
+@pytest.fixture(scope="session")
+def app_module():
+    from src import app as app_module
+
+    return app_module
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
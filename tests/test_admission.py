@@ -0,0 +1,67 @@
+import time
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from sqlalchemy import create_engine
+
+BURST = 24
+
+@pytest.fixture
+def slow_routes(app_module, monkeypatch):
+    # recomputes and summaries generated while rendering stand in for HDBSCAN and the model with sleeps, the cheap route
+    # is served from the form data
+    def slow(*args, **kwargs):
+        time.sleep(1)
+        return "dashboard"
+
+    monkeypatch.setattr(app_module, "STREAM_SUMMARIES", False)
+    monkeypatch.setattr(app_module, "custom_params", lambda file_name, size: {})
+    monkeypatch.setattr(app_module, "ensure_custom_clusters", slow)
+    monkeypatch.setattr(app_module, "render_dashboard", slow)
+    app_module.clear_caches()
+    yield
+    app_module.clear_caches()
+
+def test_stored_custom_clusters_are_reads(app_module):
+    engine = create_engine(app_module.app.config["SQLALCHEMY_DATABASE_URI"])
+    pd.DataFrame({"doi": ["10.1/1"]}).to_sql("[30]admission_test", engine, schema="custom_clustering_data", if_exists="replace", index=False)
+    app_module.clear_caches()
+
+    with app_module.app.test_request_context("/custom_cluster_size/admission_test.parquet/30"):
+        assert app_module.request_class() == "reads"
+    with app_module.app.test_request_context("/custom_cluster_size/admission_test.parquet/40"):
+        assert app_module.request_class() == "recompute"
+    with app_module.app.test_request_context("/summary_stream/topic/admission_test.parquet/none/none/false/None"):
+        assert app_module.request_class() == "llm"
+
+def test_cheap_routes_stay_fast_under_a_recompute_and_llm_burst(app_module, slow_routes):
+    statuses = {"recompute": [], "llm": []}
+    lock = threading.Lock()
+
+    def burst(name, path):
+        status = app_module.app.test_client().get(path).status_code
+        with lock:
+            statuses[name].append(status)
+
+    threads = [threading.Thread(target=burst, args=("recompute", f"/custom_cluster_size/overload_test.parquet/{50 + i}")) for i in range(BURST)]
+    threads += [threading.Thread(target=burst, args=("llm", f"/dashboard/overload_test_{i}.parquet")) for i in range(BURST)]
+    for thread in threads:
+        thread.start()
+
+    client = app_module.app.test_client()
+    latencies = []
+    for _ in range(20):
+        start = time.perf_counter()
+        assert client.get("/comparitors/Oncology").status_code == 200
+        latencies.append(time.perf_counter() - start)
+    for thread in threads:
+        thread.join()
+
+    assert np.percentile(latencies, 95) < 0.25
+    for name in ["recompute", "llm"]:
+        admission = app_module.admission_classes[name]
+        assert set(statuses[name]) <= {200, 429}
+        assert statuses[name].count(429) >= BURST - admission.limit - admission.queue
@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from sqlalchemy import create_engine, inspect
+
+from src.supporter_funcs import ARTICLE_COLUMNS, fit_clusterer
+
+PARAMS = {"min_cluster_size": 20, "min_samples": 5, "cluster_selection_method": "eom", "cluster_selection_epsilon": 0.0, "metric": "euclidean"}
+CENTRES = [(0, 0), (10, 0), (0, 10)]
+LABELS = ["Immunotherapy", "Tumour imaging", "Gene expression"]
+
+def make_articles(n_per_cluster, seed, prefix):
+    rng = np.random.default_rng(seed)
+    frames = []
+    for i, (x, y) in enumerate(CENTRES):
+        frames.append(pd.DataFrame({"coord_x": rng.normal(x, 0.5, n_per_cluster), "coord_y": rng.normal(y, 0.5, n_per_cluster), "centre": i}))
+    articles = pd.concat(frames, ignore_index=True)
+    articles["doi"] = [f"10.1/{prefix}{i}" for i in range(len(articles))]
+    articles["article_title"] = "Title"
+    articles["full_source_title"] = "CELL"
+    articles["citations"] = rng.integers(0, 50, len(articles))
+    articles["year_published"] = 2023
+    articles["art_oa_status"] = "Gold"
+    articles["publisher_group"] = "Elsevier"
+    articles["prid_country"] = "United Kingdom"
+    articles["prid_region"] = "Europe"
+    return articles
+
+def make_authors(articles):
+    return pd.DataFrame({
+        "doi": articles["doi"],
+        "author_full_name": "Smith, J.",
+        "research_org": "Univ Oxford",
+        "prid_country": "United Kingdom",
+        "prid_region": "Europe",
+        "full_source_title": "CELL",
+        "publisher_group": "Elsevier",
+    })
+
+@pytest.fixture
+def dataset(app_module, monkeypatch):
+    # stored clusters are numbered by the offline pipeline, here in reverse order of the clusterer's
+    file_name = "append_test.parquet"
+    base = make_articles(60, 0, "base")
+    clusterer = fit_clusterer(base[["coord_x", "coord_y"]].copy(), PARAMS)
+    base["cluster_label"] = 10 + (2 - clusterer.labels_)
+    base["exemplar"] = False
+    base["gpt_label"] = base["centre"].map(dict(enumerate(LABELS)))
+    base = base[ARTICLE_COLUMNS + ["cluster_label", "exemplar", "gpt_label"]]
+    engine = create_engine(app_module.app.config["SQLALCHEMY_DATABASE_URI"])
+    with engine.begin() as connection:
+        for schema in ["clustering_data", "authors", "summary_cube"]:
+            connection.exec_driver_sql(f'DROP TABLE IF EXISTS {schema}."append_test"')
+        # keyed on doi like the ResultsTableName model
+        connection.exec_driver_sql(pd.io.sql.get_schema(base, "append_test", keys="doi").replace('CREATE TABLE "append_test"', 'CREATE TABLE clustering_data."append_test"'))
+    base.to_sql("append_test", engine, schema="clustering_data", if_exists="append", index=False)
+    base.head(1).to_sql("[5]append_test", engine, schema="custom_clustering_data", if_exists="replace", index=False)
+
+    new = make_articles(5, 1, "new")
+    umaps = {file_name: base[ARTICLE_COLUMNS], "new.parquet": new[ARTICLE_COLUMNS]}
+    saved = []
+    monkeypatch.setattr(app_module, "get_params", lambda file_name: dict(PARAMS))
+    monkeypatch.setattr(app_module, "read_umaps", lambda file_name: umaps[file_name].copy())
+    monkeypatch.setattr(app_module, "read_authors", lambda file_name: make_authors(umaps[file_name]))
+    monkeypatch.setattr(app_module, "load_clusterer", lambda file_name: clusterer)
+    monkeypatch.setattr(app_module, "save_clusterer", lambda file_name, clusterer: saved.append(file_name))
+    app_module.clear_caches()
+    yield file_name, new, engine, saved
+    app_module.clear_caches()
+
+def test_new_articles_take_matched_stored_clusters(app_module, dataset):
+    file_name, new, engine, saved = dataset
+    added, refit = app_module.append_articles(file_name, "new.parquet")
+
+    assert (added, refit) == (15, False)
+    stored = pd.read_sql_table("append_test", engine, schema="clustering_data")
+    assert len(stored) == 195
+    appended = stored[stored["doi"].isin(new["doi"])].merge(new[["doi", "centre"]], on="doi")
+    assert (appended["gpt_label"] == appended["centre"].map(dict(enumerate(LABELS)))).all()
+    base_clusters = stored[~stored["doi"].isin(new["doi"])].drop_duplicates("gpt_label").set_index("gpt_label")["cluster_label"]
+    assert (appended["cluster_label"] == appended["gpt_label"].map(base_clusters)).all()
+    assert "[5]append_test" not in inspect(engine).get_table_names(schema="custom_clustering_data")
+
+def test_unmatched_clusters_are_refused(app_module, dataset, monkeypatch):
+    file_name, new, engine, saved = dataset
+    monkeypatch.setattr(app_module, "match_clusters", lambda *args, **kwargs: {})
+
+    with pytest.raises(ValueError, match="don't clearly match"):
+        app_module.append_articles(file_name, "new.parquet")
+    assert len(pd.read_sql_table("append_test", engine, schema="clustering_data")) == 180
+
+def test_refit_keeps_the_table_keys(app_module, dataset, monkeypatch):
+    file_name, new, engine, saved = dataset
+    monkeypatch.setattr(app_module, "INCREMENTAL_REFIT_THRESHOLD", -1.0)
+    monkeypatch.setattr(app_module, "relabel_clusters", lambda cluster_labels, base: (pd.DataFrame({"cluster_label": sorted(cluster_labels["cluster_label"].unique()), "gpt_label": "Topic"}), 0))
+
+    added, refit = app_module.append_articles(file_name, "new.parquet")
+    assert (added, refit) == (15, True)
+    assert len(pd.read_sql_table("append_test", engine, schema="clustering_data")) == 195
+    assert inspect(engine).get_pk_constraint("append_test", schema="clustering_data")["constrained_columns"] == ["doi"]
+    assert saved == [file_name]
+
+def test_failed_write_changes_nothing(app_module, dataset, monkeypatch):
+    file_name, new, engine, saved = dataset
+    monkeypatch.setattr(app_module, "INCREMENTAL_REFIT_THRESHOLD", -1.0)
+    monkeypatch.setattr(app_module, "relabel_clusters", lambda cluster_labels, base: (pd.DataFrame({"cluster_label": sorted(cluster_labels["cluster_label"].unique()), "gpt_label": "Topic"}), 0))
+    monkeypatch.setattr(app_module, "build_summary_cube", lambda cluster_labels, countries=None: pd.DataFrame({"comparator_type": [{"not": "writable"}]}))
+
+    with pytest.raises(RuntimeError, match="summary_cube.append_test"):
+        app_module.append_articles(file_name, "new.parquet")
+    stored = pd.read_sql_table("append_test", engine, schema="clustering_data")
+    assert len(stored) == 180 and set(stored["gpt_label"]) == set(LABELS)
+    assert not inspect(engine).has_table("append_test", schema="authors")
+    assert saved == []
+    assert "[5]append_test" in inspect(engine).get_table_names(schema="custom_clustering_data")
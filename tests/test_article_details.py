@@ -0,0 +1,48 @@
+import pandas as pd
+import pytest
+
+from sqlalchemy import create_engine
+
+from src.cache_funcs import LRUCache
+
+@pytest.fixture
+def dataset(app_module, monkeypatch):
+    articles = pd.DataFrame({
+        "doi": [f"10.1/detail{i}" for i in range(3)],
+        "article_title": [f"Title {i}" for i in range(3)],
+        "full_source_title": "CELL",
+        "prid_country": "United Kingdom",
+        "prid_region": "Europe",
+    })
+    engine = create_engine(app_module.app.config["SQLALCHEMY_DATABASE_URI"])
+    with engine.begin() as connection:
+        connection.exec_driver_sql('DROP TABLE IF EXISTS clustering_data."detail_test"')
+        connection.exec_driver_sql(pd.io.sql.get_schema(articles, "detail_test", keys="doi").replace('CREATE TABLE "detail_test"', 'CREATE TABLE clustering_data."detail_test"'))
+    articles.to_sql("detail_test", engine, schema="clustering_data", if_exists="append", index=False)
+    monkeypatch.setattr(app_module, "dataset_source", lambda file_name: "database")
+    app_module.article_detail_cache.clear()
+    yield "detail_test.parquet", engine
+    app_module.article_detail_cache.clear()
+
+def test_details_are_looked_up_once(client, dataset):
+    file_name, engine = dataset
+    response = client.get(f"/article_details/{file_name}/false/None?doi=10.1/detail2&doi=10.1/missing&doi=10.1/detail0")
+    assert response.status_code == 200
+    assert [row["article_title"] for row in response.get_json()] == ["Title 2", "Title 0"]
+
+    with engine.begin() as connection:
+        connection.exec_driver_sql('DELETE FROM clustering_data."detail_test"')
+    response = client.get(f"/article_details/{file_name}/false/None?doi=10.1/detail0")
+    assert response.get_json() == [{"doi": "10.1/detail0", "article_title": "Title 0", "full_source_title": "CELL", "prid_country": "United Kingdom", "prid_region": "Europe"}]
+
+def test_unknown_dois_are_not_found(client, dataset):
+    file_name, engine = dataset
+    assert client.get(f"/article_details/{file_name}/false/None?doi=10.1/missing").status_code == 404
+    assert client.get(f"/article_details/{file_name}/false/None").status_code == 400
+
+def test_lru_drops_the_least_recently_used():
+    cache = LRUCache(2)
+    cache.set_many({"a": 1, "b": 2})
+    assert cache.get_many(["a"]) == {"a": 1}
+    cache.set_many({"c": 3})
+    assert cache.get_many(["a", "b", "c"]) == {"a": 1, "c": 3}
@@ -0,0 +1,143 @@
+import os
+import json
+
+import pandas as pd
+import pytest
+
+from sqlalchemy import create_engine
+
+from src.supporter_funcs import group_authors
+
+PARAMS = {"min_cluster_size": 20, "min_samples": 5, "cluster_selection_method": "eom", "cluster_selection_epsilon": 0.0, "metric": "euclidean", "algorithm": None}
+COUNTRIES = ["United Kingdom", "USA", "Germany", "China"]
+
+@pytest.fixture
+def dataset(app_module, monkeypatch):
+    file_name = "bundle_test.parquet"
+    n = 40
+    articles = pd.DataFrame({
+        "doi": [f"10.1/bundle{i}" for i in range(n)],
+        "article_title": "Title",
+        "full_source_title": "CELL",
+        "citations": range(n),
+        "year_published": 2023,
+        "art_oa_status": "Gold",
+        "publisher_group": "Elsevier",
+        "coord_x": [float(i) for i in range(n)],
+        "coord_y": 0.0,
+        "prid_country": [COUNTRIES[i % 4] for i in range(n)],
+        "prid_region": ["Europe" if i % 4 in (0, 2) else "Other" for i in range(n)],
+        "cluster_label": [i % 2 for i in range(n)],
+        "exemplar": False,
+        "gpt_label": ["Immunotherapy" if i % 2 else "Gene expression" for i in range(n)],
+    })
+    authors = pd.DataFrame({
+        "doi": articles["doi"],
+        "author_full_name": [f"Author {i % 5}" for i in range(n)],
+        "research_org": "Univ Oxford",
+        "prid_country": articles["prid_country"],
+        "prid_region": articles["prid_region"],
+        "full_source_title": "CELL",
+        "publisher_group": "Elsevier",
+    })
+    engine = create_engine(app_module.app.config["SQLALCHEMY_DATABASE_URI"])
+    articles.to_sql("bundle_test", engine, schema="clustering_data", if_exists="replace", index=False)
+    group_authors(articles, authors).to_sql("bundle_test", engine, schema="authors", if_exists="replace", index=False)
+    monkeypatch.setattr(app_module, "get_params", lambda file_name: dict(PARAMS))
+    for country in COUNTRIES:
+        monkeypatch.setitem(app_module.country_lookup, country, country.upper())
+    app_module.clear_caches()
+    yield file_name
+    path = app_module.bundle_path(file_name)
+    if os.path.isdir(path):
+        for name in os.listdir(path):
+            os.remove(os.path.join(path, name))
+        os.rmdir(path)
+    app_module.clear_caches()
+
+def test_export_needs_summaries(app_module, dataset, tmp_path):
+    runner = app_module.app.test_cli_runner()
+
+    result = runner.invoke(args=["export-bundle", dataset, "--directory", str(tmp_path)])
+    assert result.exit_code != 0
+    assert "--without-summaries" in result.output
+
+    result = runner.invoke(args=["export-bundle", dataset, "--directory", str(tmp_path), "--without-summaries"])
+    assert result.exit_code == 0, result.output
+
+def test_export_reads_summaries_from_the_cache(app_module, dataset, tmp_path):
+    app_module.store("summaries", app_module.summary_key(dataset), ["A summary."])
+    result = app_module.app.test_cli_runner().invoke(args=["export-bundle", dataset, "--directory", str(tmp_path)])
+    assert result.exit_code == 0, result.output
+    assert app_module.read_bundle(app_module.bundle_path(dataset, str(tmp_path)))["summaries"] == [{"comparator_type": "subject", "comparator": "", "sentences": ["A summary."]}]
+
+@pytest.mark.parametrize("comparator_type, comparator", [("subject", "none"), ("region", "Europe"), ("region", "TA7"), ("country", "USA"), ("journal", "CELL")])
+def test_bundle_choropleth_matches_database(app_module, dataset, client, comparator_type, comparator):
+    url = f"/choroplethData/{dataset}/{comparator_type}/{comparator}/false/None"
+    from_database = client.get(url)
+    assert from_database.status_code == 200
+
+    result = app_module.app.test_cli_runner().invoke(args=["export-bundle", dataset, "--without-summaries"])
+    assert result.exit_code == 0, result.output
+    engine = create_engine(app_module.app.config["SQLALCHEMY_DATABASE_URI"])
+    with engine.begin() as connection:
+        connection.exec_driver_sql("DROP TABLE authors.bundle_test")
+    app_module.clear_caches()
+
+    from_bundle = client.get(url)
+    assert from_bundle.status_code == 200
+    assert app_module.dataset_source(dataset) == "bundle"
+    normalise = lambda data: {label: sorted(rows, key=lambda row: row["country"]) for label, rows in data.items()}
+    assert normalise(from_bundle.get_json()) == normalise(from_database.get_json())
+
+@pytest.fixture
+def exported(app_module, dataset, monkeypatch, tmp_path):
+    monkeypatch.setattr(app_module, "get_params", lambda file_name: dict(PARAMS, id=file_name))
+    result = app_module.app.test_cli_runner().invoke(args=["export-bundle", dataset, "--directory", str(tmp_path), "--without-summaries"])
+    assert result.exit_code == 0, result.output
+    engine = create_engine(app_module.app.config["SQLALCHEMY_DATABASE_URI"])
+    app_module.Params.__table__.create(engine, checkfirst=True)
+    with engine.begin() as connection:
+        connection.exec_driver_sql("DELETE FROM best_parameters WHERE id = 'bundle_test.parquet'")
+        connection.exec_driver_sql("DELETE FROM clustering_data.bundle_test WHERE citations >= 10")
+    yield app_module.bundle_path(dataset, str(tmp_path)), engine
+    app_module.db.session.rollback()
+
+def test_import_writes_the_database(app_module, exported):
+    path, engine = exported
+    result = app_module.app.test_cli_runner().invoke(args=["import-bundle", path, "--database"])
+    assert result.exit_code == 0, result.output
+    assert len(pd.read_sql_table("bundle_test", engine, schema="clustering_data")) == 40
+    assert pd.read_sql_query("SELECT min_cluster_size FROM best_parameters WHERE id = 'bundle_test.parquet'", engine)["min_cluster_size"].tolist() == [20]
+
+def test_failed_database_import_is_reported(app_module, exported, monkeypatch):
+    path, engine = exported
+    read_bundle = app_module.read_bundle
+    def broken_cube(path, verify=True):
+        bundle = read_bundle(path, verify)
+        bundle["summary_cube"] = pd.DataFrame({"comparator_type": [{"not": "writable"}]})
+        return bundle
+    monkeypatch.setattr(app_module, "read_bundle", broken_cube)
+
+    result = app_module.app.test_cli_runner().invoke(args=["import-bundle", path, "--database"])
+    assert result.exit_code != 0
+    assert "summary_cube.bundle_test" in result.output and "Imported" not in result.output
+    assert len(pd.read_sql_table("bundle_test", engine, schema="clustering_data")) == 10
+    assert pd.read_sql_query("SELECT id FROM best_parameters WHERE id = 'bundle_test.parquet'", engine).empty
+
+@pytest.mark.parametrize("field, value", [("file_name", "../escaped.parquet"), ("file_name", "nested/escaped.parquet"), ("file_name", "..\\escaped.parquet"), ("file_name", "."), ("files", "../escaped.parquet")])
+def test_import_refuses_paths_outside_the_bundle(app_module, exported, tmp_path, field, value):
+    path, engine = exported
+    with open(os.path.join(path, "manifest.json")) as f:
+        manifest = json.load(f)
+    if field == "files":
+        manifest["files"][value] = manifest["files"]["articles.parquet"]
+    else:
+        manifest["file_name"] = value
+    with open(os.path.join(path, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+
+    with pytest.raises(ValueError):
+        app_module.import_bundle(path, str(tmp_path / "bundles"))
+    assert not os.path.exists(tmp_path / "escaped")
+    assert not os.path.exists(tmp_path / "bundles")
@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import fnmatch
+import threading
+import multiprocessing
+
+import pandas as pd
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+
+import src.cache_funcs as cache_funcs
+
+def save_hits_repeatedly(rounds):
+    for _ in range(rounds):
+        cache_funcs.record_hit("Oncology_2019_2020.parquet", "country", "China")
+        cache_funcs.record_hit("Oncology_2019_2020.parquet")
+        cache_funcs.save_hits()
+
+@pytest.fixture
+def hits_file(tmp_path, monkeypatch):
+    path = tmp_path / "cache_hits.json"
+    monkeypatch.setattr(cache_funcs, "CACHE_HITS_FILE", str(path))
+    cache_funcs.hits.clear()
+    cache_funcs.unsaved_hits.clear()
+    yield path
+    cache_funcs.hits.clear()
+    cache_funcs.unsaved_hits.clear()
+
+def test_concurrent_save_hits_keeps_every_hit(hits_file):
+    # forked workers inherit the patched CACHE_HITS_FILE
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=save_hits_repeatedly, args=(50,)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=60)
+        assert worker.exitcode == 0
+    with open(hits_file) as f:
+        saved = json.load(f)
+    assert saved == {
+        json.dumps(["Oncology_2019_2020.parquet", "country", "China"]): 200,
+        json.dumps(["Oncology_2019_2020.parquet", None, None]): 200,
+    }
+
+def test_unsaved_hits_are_kept_when_the_save_fails(hits_file, monkeypatch):
+    cache_funcs.record_hit("Oncology_2019_2020.parquet")
+    monkeypatch.setattr(cache_funcs, "CACHE_HITS_FILE", str(hits_file.parent / "missing" / "cache_hits.json"))
+    with pytest.raises(OSError):
+        cache_funcs.save_hits()
+    assert sum(cache_funcs.unsaved_hits.values()) == 1
+
+class FakeRedis:
+    """
+    In memory stand-in for the parts of the redis client RedisCache uses.
+    """
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value, expires = self.values.get(key, (None, None))
+            if expires is not None and expires < time.time():
+                del self.values[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None, nx=False):
+        if isinstance(value, str):
+            value = value.encode()
+        with self.lock:
+            current = self.values.get(key)
+            if nx and current is not None and (current[1] is None or current[1] >= time.time()):
+                return None
+            self.values[key] = (value, time.time() + ex if ex else None)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            return int(self.values.pop(key, None) is not None)
+
+    def eval(self, script, numkeys, key, token):
+        assert script == cache_funcs.RedisCache.UNLOCK_SCRIPT
+        with self.lock:
+            if self.values.get(key, (None, None))[0] == token.encode():
+                del self.values[key]
+                return 1
+            return 0
+
+    def scan_iter(self, match="*"):
+        with self.lock:
+            keys = list(self.values)
+        return [key for key in keys if fnmatch.fnmatch(key, match)]
+
+@pytest.fixture(params=["local", "disk", "redis"])
+def cache_backend(request, tmp_path):
+    if request.param == "disk":
+        cache = cache_funcs.DiskCache(str(tmp_path / "cache"))
+    elif request.param == "redis":
+        cache = cache_funcs.RedisCache(client=FakeRedis())
+    else:
+        cache = cache_funcs.LocalCache()
+    previous = cache_funcs.backend[0]
+    cache_funcs.set_backend(cache)
+    yield cache
+    cache_funcs.set_backend(previous)
+
+def test_values_round_trip(cache_backend):
+    frame = pd.DataFrame({"doi": ["10.1/1", "10.1/2"], "citations": [3, None], "gpt_label": ["Immunotherapy", None]})
+    cache_funcs.store("labels", ("Oncology_2019_2020.parquet", None), frame)
+    cache_funcs.store("summaries", ("Oncology_2019_2020.parquet", None, "subject", ""), ["One.", "Two."])
+    pd.testing.assert_frame_equal(cache_funcs.get_cached("labels", ("Oncology_2019_2020.parquet", None)), frame)
+    assert cache_funcs.get_cached("summaries", ("Oncology_2019_2020.parquet", None, "subject", "")) == ["One.", "Two."]
+    assert cache_funcs.get_cached("summaries", ("Other.parquet", None, "subject", "")) is None
+
+def test_expired_values_are_misses(cache_backend):
+    cache_funcs.store("aggregates", ("Oncology_2019_2020.parquet",), {"rows": 1}, ttl=1)
+    assert cache_funcs.is_cached("aggregates", ("Oncology_2019_2020.parquet",))
+    time.sleep(1.1)
+    assert not cache_funcs.is_cached("aggregates", ("Oncology_2019_2020.parquet",))
+
+def test_misses_are_single_flight(cache_backend):
+    calls = []
+
+    def compute():
+        calls.append(threading.get_ident())
+        time.sleep(0.2)
+        return "summary"
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: cache_funcs.cached("summaries", ("Oncology_2019_2020.parquet",), compute), range(8)))
+    assert results == ["summary"] * 8
+    assert len(calls) == 1
+    if isinstance(cache_backend, cache_funcs.LocalCache):
+        assert cache_backend.locks == {}
+
+def test_failed_computation_releases_the_lock(cache_backend):
+    def fail():
+        raise RuntimeError("model unavailable")
+
+    with pytest.raises(RuntimeError):
+        cache_funcs.cached("summaries", ("Oncology_2019_2020.parquet",), fail)
+    assert cache_funcs.cached("summaries", ("Oncology_2019_2020.parquet",), lambda: "summary") == "summary"
+
+def test_clear(cache_backend):
+    cache_funcs.store("labels", ("Oncology_2019_2020.parquet", None), [1, 2])
+    cache_funcs.clear_caches()
+    assert not cache_funcs.is_cached("labels", ("Oncology_2019_2020.parquet", None))
+
+def test_disk_clear_skips_directories(tmp_path):
+    cache = cache_funcs.DiskCache(directory=str(tmp_path))
+    cache.set("key", "value", 60)
+    (tmp_path / "parquet").mkdir()
+    (tmp_path / "parquet" / "umaps.parquet").write_bytes(b"kept")
+    cache.clear()
+    assert cache.get("key") is None
+    assert (tmp_path / "parquet" / "umaps.parquet").read_bytes() == b"kept"
+
+def test_parquet_cache_is_outside_the_disk_cache():
+    assert os.path.commonpath([os.path.abspath(cache_funcs.PARQUET_CACHE_DIR), os.path.abspath(cache_funcs.CACHE_DIR)]) != os.path.abspath(cache_funcs.CACHE_DIR)
+
+def test_redis_clear_only_removes_its_prefix():
+    client = FakeRedis()
+    client.set("other_app:key", b"kept")
+    cache = cache_funcs.RedisCache(client=client)
+    cache.set("key", "value", 60)
+    cache.clear()
+    assert cache.get("key") is None
+    assert client.get("other_app:key") == b"kept"
+
+def test_redis_clear_keeps_running_locks():
+    client = FakeRedis()
+    cache = cache_funcs.RedisCache(client=client)
+    cache.set("key", "value", 60)
+    with cache.locked("key"):
+        cache.clear()
+        assert client.get("topic_clustering:lock:key") is not None
+    assert cache.get("key") is None
+
+def test_redis_unlock_leaves_a_lock_taken_by_another_worker():
+    client = FakeRedis()
+    cache = cache_funcs.RedisCache(client=client)
+    with cache.locked("key"):
+        # our lock expired and another worker took it
+        client.set("topic_clustering:lock:key", "other")
+    assert client.get("topic_clustering:lock:key") == b"other"
+
+def test_redis_lock_is_released_and_expires(monkeypatch):
+    client = FakeRedis()
+    cache = cache_funcs.RedisCache(client=client)
+    with cache.locked("key"):
+        assert client.get("topic_clustering:lock:key") is not None
+    assert client.get("topic_clustering:lock:key") is None
+    # a lock left by a crashed worker expires after CACHE_LOCK_TIMEOUT
+    client.set("topic_clustering:lock:key", "crashed", ex=1)
+    start = time.time()
+    with cache.locked("key"):
+        assert time.time() - start >= 0.9
+
+def test_local_locks_are_dropped_once_released():
+    cache = cache_funcs.LocalCache()
+    for n in range(100):
+        with cache.locked(f"key-{n}"):
+            assert len(cache.locks) == 1
+    assert cache.locks == {}
+
+def test_local_cache_is_bounded():
+    cache = cache_funcs.LocalCache(max_entries=3)
+    for n in range(3):
+        cache.set(f"key-{n}", n, 60)
+    assert cache.get("key-0") == 0 # key-1 is now the least recently used
+    cache.set("key-3", 3, 60)
+    assert list(cache.values) == ["key-2", "key-0", "key-3"]
+
+def test_local_cache_drops_expired_values(monkeypatch):
+    cache = cache_funcs.LocalCache()
+    cache.set("old", "value", 1)
+    now = time.time()
+    monkeypatch.setattr(cache_funcs.time, "time", lambda: now + 2)
+    cache.set("new", "value", 60)
+    assert list(cache.values) == ["new"]
@@ -0,0 +1,22 @@
+import pytest
+
+from src.supporter_funcs import clusterer_engine, CLUSTER_LARGE_ROWS, CLUSTER_PARALLEL_MIN_ROWS
+
+@pytest.mark.parametrize("metric, algorithm", [("euclidean", "boruvka_kdtree"), ("manhattan", "boruvka_kdtree"), ("chebyshev", "boruvka_kdtree"), ("cosine", "boruvka_balltree"), ("haversine", "boruvka_balltree")])
+def test_tree_follows_the_metric(metric, algorithm):
+    assert clusterer_engine(1000, metric)["algorithm"] == algorithm
+
+@pytest.mark.parametrize("n_rows, leaf_size, jobs", [
+    (CLUSTER_PARALLEL_MIN_ROWS - 1, 40, 1),
+    (CLUSTER_PARALLEL_MIN_ROWS, 40, 8),
+    (CLUSTER_LARGE_ROWS - 1, 40, 8),
+    (CLUSTER_LARGE_ROWS, 100, 8),
+])
+def test_size_thresholds(n_rows, leaf_size, jobs):
+    engine = clusterer_engine(n_rows, "euclidean", cpus=8)
+    assert (engine["leaf_size"], engine["core_dist_n_jobs"], engine["approx_min_span_tree"]) == (leaf_size, jobs, True)
+
+def test_override_and_cpus():
+    assert clusterer_engine(1000, "cosine", algorithm="prims_balltree")["algorithm"] == "prims_balltree"
+    assert clusterer_engine(1000, "euclidean", algorithm="generic")["algorithm"] == "generic"
+    assert clusterer_engine(CLUSTER_LARGE_ROWS, "euclidean", cpus=0)["core_dist_n_jobs"] == 1
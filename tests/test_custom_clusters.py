@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.exc import OperationalError
+
+from src.supporter_funcs import ARTICLE_COLUMNS
+
+PARAMS = {"min_cluster_size": 20, "min_samples": 5, "cluster_selection_method": "eom", "cluster_selection_epsilon": 0.0, "metric": "euclidean"}
+SCHEMAS = ["custom_clustering_data", "custom_authors", "custom_summary_cube"]
+
+def make_articles(n_per_cluster, seed):
+    rng = np.random.default_rng(seed)
+    frames = [pd.DataFrame({"coord_x": rng.normal(x, 0.5, n_per_cluster), "coord_y": rng.normal(y, 0.5, n_per_cluster)}) for x, y in [(0, 0), (10, 0)]]
+    articles = pd.concat(frames, ignore_index=True)
+    articles["doi"] = [f"10.1/custom{i}" for i in range(len(articles))]
+    articles["article_title"] = "Title"
+    articles["full_source_title"] = "CELL"
+    articles["citations"] = rng.integers(0, 50, len(articles))
+    articles["year_published"] = 2023
+    articles["art_oa_status"] = "Gold"
+    articles["publisher_group"] = "Elsevier"
+    articles["prid_country"] = "United Kingdom"
+    articles["prid_region"] = "Europe"
+    return articles[ARTICLE_COLUMNS]
+
+@pytest.fixture
+def dataset(app_module, monkeypatch):
+    file_name = "custom_test.parquet"
+    articles = make_articles(40, 0)
+    engine = create_engine(app_module.app.config["SQLALCHEMY_DATABASE_URI"])
+    with engine.begin() as connection:
+        for schema in SCHEMAS:
+            connection.exec_driver_sql(f'DROP TABLE IF EXISTS {schema}."[25]custom_test"')
+    monkeypatch.setattr(app_module, "dataset_source", lambda file_name: "database")
+    monkeypatch.setattr(app_module, "read_umaps", lambda file_name: articles.copy())
+    monkeypatch.setattr(app_module, "read_authors", lambda file_name: pd.DataFrame({
+        "doi": articles["doi"],
+        "author_full_name": "Smith, J.",
+        "research_org": "Univ Oxford",
+        "prid_country": "United Kingdom",
+        "prid_region": "Europe",
+        "full_source_title": "CELL",
+        "publisher_group": "Elsevier",
+    }))
+    monkeypatch.setattr(app_module, "load_cluster_labels", lambda file_name, custom=False, custom_size=None: None)
+    monkeypatch.setattr(app_module, "relabel_clusters", lambda cluster_labels, base: (pd.DataFrame({"cluster_label": sorted(cluster_labels["cluster_label"].unique()), "gpt_label": "Topic"}), 0))
+    app_module.clear_caches()
+    yield file_name, engine
+    app_module.clear_caches()
+
+def test_recompute_writes_every_table(app_module, dataset):
+    file_name, engine = dataset
+    app_module.ensure_custom_clusters(file_name, 25, dict(PARAMS, min_cluster_size=25))
+
+    assert all(inspect(engine).has_table("[25]custom_test", schema=schema) for schema in SCHEMAS)
+    assert app_module.has_custom_clusters(file_name, 25)
+
+def test_failed_cube_write_leaves_the_size_unstored(app_module, dataset, transactional_ddl, monkeypatch):
+    file_name, engine = dataset
+    monkeypatch.setattr(app_module, "build_summary_cube", lambda cluster_labels, countries=None: pd.DataFrame({"comparator_type": [{"not": "writable"}]}))
+
+    with pytest.raises(RuntimeError, match="custom_summary_cube"):
+        app_module.ensure_custom_clusters(file_name, 25, dict(PARAMS, min_cluster_size=25))
+    assert not any(inspect(engine).has_table("[25]custom_test", schema=schema) for schema in SCHEMAS)
+    assert not app_module.has_custom_clusters(file_name, 25)
+
+def test_database_errors_are_not_recomputed(app_module, dataset, monkeypatch):
+    file_name, engine = dataset
+    recomputed = []
+    def unavailable(file_name, custom_size):
+        raise OperationalError("SELECT", {}, Exception("connection refused"))
+    monkeypatch.setattr(app_module, "has_custom_clusters", unavailable)
+    monkeypatch.setattr(app_module, "recompute_custom_clusters", lambda *args: recomputed.append(args))
+
+    with pytest.raises(OperationalError):
+        app_module.ensure_custom_clusters(file_name, 25, dict(PARAMS, min_cluster_size=25))
+    assert recomputed == []
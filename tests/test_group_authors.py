@@ -0,0 +1,112 @@
+import os
+import re
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.supporter_funcs import group_authors
+
+BENCHMARK_ROWS = int(os.getenv("BENCHMARK_ROWS", 1_000_000))
+
+def baseline_group_authors(articles, authors):
+    """
+    group_authors before it was vectorised, kept as the golden implementation the current one must match.
+    """
+    df_authors = authors.merge(articles[["doi", "gpt_label", "citations"]], on="doi", how="left").drop_duplicates()
+    df_authors = df_authors[df_authors["gpt_label"].notna()]
+
+    def collect_group(group):
+        return list(dict.fromkeys(group))
+
+    authors_grouped = (
+        df_authors.groupby(["gpt_label", "author_full_name", "research_org", "prid_country", "prid_region"])
+        .agg(
+            sum_published=pd.NamedAgg(column="author_full_name", aggfunc="count"),
+            sum_citations=pd.NamedAgg(column="citations", aggfunc="sum"),
+            full_source_title_list=pd.NamedAgg(column="full_source_title", aggfunc=collect_group),
+            publisher_group_list=pd.NamedAgg(column="publisher_group", aggfunc=collect_group)
+        )
+        .reset_index()
+        .sort_values(by=["gpt_label", "sum_published", "sum_citations"], ascending=[True, False, False])
+    ).sort_values("sum_citations", ascending=False)
+
+    for col in ["author_full_name", "research_org", "prid_country", "prid_region"]:
+        authors_grouped[col] = authors_grouped[col].apply(lambda x: re.sub(r'\W+', '', x))
+
+    authors_grouped["avg_cites_per_article"] = (authors_grouped["sum_citations"] / authors_grouped["sum_published"]).astype(int)
+    authors_grouped = authors_grouped.reset_index(drop=False, names="index")
+    authors_grouped["full_source_title_list"] = authors_grouped["full_source_title_list"].apply(lambda x: str(x))
+    authors_grouped["publisher_group_list"] = authors_grouped["publisher_group_list"].apply(lambda x: str(x))
+    return authors_grouped
+
+def make_frames(n_authors, seed=0, n_names=None):
+    # a few names give groups with many rows, n_names distinct names give the many small groups of a real subject
+    rng = np.random.default_rng(seed)
+    names = ["Smith, J.", "O'Brien, K.", "Müller, A.-B.", "Li, X", "d'Arc, J (Jr.)"]
+    if n_names:
+        names = names + [f"Author-{i}, {chr(65 + i % 26)}." for i in range(n_names)]
+    n_articles = max(n_authors // 4, 10)
+    articles = pd.DataFrame({
+        "doi": [f"10.1/{i}" for i in range(n_articles)],
+        "gpt_label": rng.choice(["Immunotherapy", "Tumour imaging", "Gene expression", None], n_articles),
+        "citations": rng.integers(0, 200, n_articles),
+    })
+    authors = pd.DataFrame({
+        "doi": rng.choice(articles["doi"], n_authors),
+        "author_full_name": rng.choice(names, n_authors),
+        "research_org": rng.choice(["Univ Oxford", "MIT - CSAIL", "Inst. Pasteur"], n_authors),
+        "prid_country": rng.choice(["United Kingdom", "USA", "France", "China"], n_authors),
+        "prid_region": rng.choice(["Europe", "North America", "Asia"], n_authors),
+        "full_source_title": rng.choice(["CELL", "NATURE", "Lancet's Oncology", 'The "Journal"', None, np.nan], n_authors),
+        "publisher_group": rng.choice(["ELSEVIER", "SPRINGER NATURE", None], n_authors),
+    })
+    return articles, authors
+
+def assert_same_authors(result, expected):
+    # the baseline's chained quicksorts leave rows with equal citations in no particular order, the index column
+    # records the order the groups had before sorting and so identifies each row in both frames
+    assert list(result.columns) == list(expected.columns)
+    assert result["sum_citations"].tolist() == expected["sum_citations"].tolist()
+    pd.testing.assert_frame_equal(
+        result.sort_values("index").reset_index(drop=True),
+        expected.sort_values("index").reset_index(drop=True),
+    )
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_group_authors_matches_baseline(seed):
+    articles, authors = make_frames(2000, seed)
+    assert_same_authors(group_authors(articles, authors), baseline_group_authors(articles, authors))
+    articles, authors = make_frames(2000, seed, n_names=300)
+    assert_same_authors(group_authors(articles, authors), baseline_group_authors(articles, authors))
+
+def test_group_authors_list_strings():
+    articles = pd.DataFrame({"doi": ["a", "b", "c"], "gpt_label": ["Topic", "Topic", "Topic"], "citations": [3, 4, 5]})
+    authors = pd.DataFrame({
+        "doi": ["a", "b", "c"],
+        "author_full_name": ["O'Brien, K."] * 3,
+        "research_org": ["MIT"] * 3,
+        "prid_country": ["USA"] * 3,
+        "prid_region": ["North America"] * 3,
+        "full_source_title": ["Lancet's Oncology", "CELL", "Lancet's Oncology"],
+        "publisher_group": ["ELSEVIER", None, "ELSEVIER"],
+    })
+    row = group_authors(articles, authors).iloc[0]
+    assert row["author_full_name"] == "OBrienK"
+    assert row["full_source_title_list"] == str(["Lancet's Oncology", "CELL"])
+    assert row["publisher_group_list"] == str(["ELSEVIER", None])
+    assert (row["sum_published"], row["sum_citations"], row["avg_cites_per_article"]) == (3, 12, 4)
+
+@pytest.mark.skipif(not os.getenv("BENCHMARK"), reason="set BENCHMARK=1 to run the group_authors benchmark")
+def test_group_authors_benchmark():
+    articles, authors = make_frames(BENCHMARK_ROWS, n_names=BENCHMARK_ROWS // 4)
+    start = time.perf_counter()
+    baseline = baseline_group_authors(articles, authors)
+    baseline_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    result = group_authors(articles, authors)
+    seconds = time.perf_counter() - start
+    print(f"\ngroup_authors at {BENCHMARK_ROWS} author rows: baseline {baseline_seconds:.2f}s, vectorised {seconds:.2f}s")
+    assert_same_authors(result, baseline)
+    assert seconds < baseline_seconds
@@ -0,0 +1,79 @@
+import pandas as pd
+import pytest
+
+from src import openai_funcs
+from src.openai_funcs import estimate_tokens, pack, topic_chunks, comparator_chunks, summary_mode, summarise_topics, summarise_comparator, get_df_string
+
+def summary_table(labels, growth=True):
+    table = pd.DataFrame({"gpt_label": labels, "avg_citations": [10.0 + i for i in range(len(labels))]})
+    if growth:
+        table.insert(1, "growth", [5.0 * i for i in range(len(labels))])
+    return table
+
+@pytest.fixture
+def stubbed_complete(monkeypatch):
+    prompts = []
+    def complete(prompt):
+        prompts.append(prompt)
+        return " Topics grew by 2.5%. Citations fell.", {"prompt_tokens": estimate_tokens(prompt), "completion_tokens": 10}
+    monkeypatch.setattr(openai_funcs, "complete", complete)
+    return prompts
+
+@pytest.mark.parametrize("text, tokens", [("", 0), ("abc", 1), ("abcd", 2), ("a" * 300, 100)])
+def test_estimate_tokens_rounds_up(text, tokens):
+    assert estimate_tokens(text) == tokens
+
+def test_pack_keeps_order_and_limits_groups():
+    assert pack(["aa", "bb", "cc", "d"], 4, size=len) == [["aa", "bb"], ["cc", "d"]]
+    assert pack(["aaaaaa", "b", "cc"], 4, size=len) == [["aaaaaa"], ["b", "cc"]]
+    assert pack([], 4, size=len) == []
+
+def test_topic_chunks_split_the_table(monkeypatch):
+    monkeypatch.setattr(openai_funcs, "SUMMARY_CHUNK_TOKENS", 30)
+    table = summary_table([f"Topic {i}" for i in range(10)])
+    chunks = topic_chunks(table)
+
+    assert len(chunks) > 1
+    assert "".join(chunks) == get_df_string(table)
+    assert all(estimate_tokens(chunk) <= 30 or chunk.count("\n") == 1 for chunk in chunks)
+
+def test_comparator_chunks_keep_a_topic_together(monkeypatch):
+    monkeypatch.setattr(openai_funcs, "SUMMARY_CHUNK_TOKENS", 60)
+    topics = summary_table([f"Topic {i}" for i in range(10)])
+    comparator = summary_table([f"Topic {i}" for i in range(0, 10, 2)] + ["Only in the comparator"])
+    chunks = comparator_chunks(topics, comparator)
+
+    assert len(chunks) > 1 and all(chunk.count("//") == 1 for chunk in chunks)
+    for label in comparator["gpt_label"]:
+        together = [chunk for chunk in chunks if f"Cluster: {label}," in chunk.split("//")[1]]
+        assert len(together) == 1
+        if label in set(topics["gpt_label"]):
+            assert f"Cluster: {label}," in together[0].split("//")[0]
+
+def test_summary_mode(monkeypatch):
+    monkeypatch.setattr(openai_funcs, "SUMMARY_STUFF_TOKENS", 100)
+    monkeypatch.setattr(openai_funcs, "SUMMARY_CONTEXT_TOKENS", 400)
+    monkeypatch.setattr(openai_funcs, "SUMMARY_MAX_TOKENS", 100)
+    assert summary_mode("a" * 300, "auto") == "stuff"
+    assert summary_mode("a" * 301, "auto") == "map_reduce"
+    assert summary_mode("a" * 301, "stuff") == "stuff"
+    assert summary_mode("a" * 901, "stuff") == "map_reduce" # no room left for the completion
+    assert summary_mode("a", "map_reduce") == "map_reduce"
+
+def test_map_reduce_topic_summary(monkeypatch, stubbed_complete):
+    monkeypatch.setattr(openai_funcs, "SUMMARY_CHUNK_TOKENS", 30)
+    table = summary_table([f"Topic {i}" for i in range(10)])
+    summary, usage = summarise_topics(table, mode="map_reduce")
+
+    chunks = topic_chunks(table)
+    assert summary == ["Topics grew by 2.5%", "Citations fell."]
+    assert usage["mode"] == "map_reduce" and usage["calls"] == len(chunks) + 1 == len(stubbed_complete)
+    assert usage["completion_tokens"] == 10 * usage["calls"]
+    assert usage["prompt_tokens"] == sum(estimate_tokens(prompt) for prompt in stubbed_complete)
+
+def test_map_reduce_comparator_summary(monkeypatch, stubbed_complete):
+    monkeypatch.setattr(openai_funcs, "SUMMARY_STUFF_TOKENS", 0)
+    summary, usage = summarise_comparator(summary_table(["Topic A", "Topic B"]), summary_table(["Topic A"], growth=False))
+
+    assert usage["mode"] == "map_reduce" and usage["calls"] == 2
+    assert "//" in stubbed_complete[0] and stubbed_complete[-1].startswith(openai_funcs.COMPARATOR_REDUCE_TEMPLATE.split("{text}")[0])
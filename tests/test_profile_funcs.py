@@ -0,0 +1,32 @@
+from collections import Counter
+
+import pytest
+
+from src.profile_funcs import profile_token, valid_token, save_profile, list_profiles, load_profile
+
+@pytest.mark.parametrize("token, path, secret, valid", [
+    (profile_token("/get_data", "secret"), "/get_data", "secret", True),
+    (profile_token("/get_data", "secret"), "/profiles", "secret", False),
+    (profile_token("/get_data", "other"), "/get_data", "secret", False),
+    ("", "/get_data", "secret", False),
+    (None, "/get_data", "secret", False),
+    (profile_token("/get_data", ""), "/get_data", "", False),
+])
+def test_valid_token(token, path, secret, valid):
+    assert valid_token(token, path, secret) == valid
+
+def test_save_profile_keeps_the_newest(tmp_path):
+    stacks = Counter({("main (app.py:1)", "get_data (app.py:10)"): 3})
+    ids = [save_profile({"route": "get_data", "file_name": "Oncology/2019.parquet", "path": "/get_data", "started": 1700000000 + i, "duration": 0.1}, stacks, str(tmp_path), keep=3) for i in range(5)]
+
+    assert [profile["id"] for profile in list_profiles(str(tmp_path))] == ids[:1:-1]
+    assert all("/" not in profile_id for profile_id in ids)
+    assert load_profile(ids[0], str(tmp_path)) is None
+    profile = load_profile(ids[-1], str(tmp_path))
+    assert profile["samples"] == 3 and profile["stacks"] == stacks
+
+def test_profiles_need_the_token(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, "valid_token", lambda token, path: valid_token(token, path, "secret"))
+    assert client.get("/profiles").status_code == 403
+    assert client.get("/profiles", headers={"X-Profile": profile_token("/get_data", "secret")}).status_code == 403
+    assert client.get("/profiles", headers={"X-Profile": profile_token("/profiles", "secret")}).status_code == 200
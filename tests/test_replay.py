@@ -0,0 +1,45 @@
+from src.replay_funcs import parse_log, traffic_model, split_model
+
+LOG = [
+    "2026-10-19 09:00:00,000 INFO Request: GET /comparitors/Oncology",
+    "2026-10-19 09:00:01,000 INFO Request: GET /comparitors/Oncology",
+    "2026-10-19 09:00:02,000 INFO Request: GET /check_s3/Oncology_2019_2020.parquet",
+    "2026-10-19 09:00:03,000 INFO Request: GET /summary_stream/topic/Oncology_2019_2020.parquet/none/none/false/None",
+    "2026-10-19 09:00:04,000 INFO Request: GET /get_data/Oncology_2019_2020.parquet/none/none/false/None",
+]
+
+def test_split_model_rescales_the_remaining_paths():
+    model = traffic_model(parse_log(LOG), lambda path: path.split("/")[1])
+    kept, refused = split_model(model, lambda path: "S3" if path.startswith("/check_s3") else None)
+    assert kept["path"].tolist() == ["/comparitors/Oncology", "/summary_stream/topic/Oncology_2019_2020.parquet/none/none/false/None", "/get_data/Oncology_2019_2020.parquet/none/none/false/None"]
+    assert kept["share"].tolist() == [0.5, 0.25, 0.25]
+    assert refused.to_dict("records") == [{"path": "/check_s3/Oncology_2019_2020.parquet", "route": "check_s3", "count": 1, "reason": "S3"}]
+
+def test_replay_services(app_module):
+    app_module.clear_caches()
+    assert app_module.replay_services("/comparitors/Oncology") == set()
+    assert app_module.replay_services("/check_s3/Oncology_2019_2020.parquet") == {"S3"}
+    assert app_module.replay_services("/get_data/Oncology_2019_2020.parquet/none/none/false/None") == {"database"}
+    assert app_module.replay_services("/summary_stream/topic/Oncology_2019_2020.parquet/none/none/false/None") == {"database", "OpenAI"}
+    app_module.store("summaries", app_module.summary_key("Oncology_2019_2020.parquet"), ["A summary."])
+    assert app_module.replay_services("/summary_stream/topic/Oncology_2019_2020.parquet/none/none/false/None") == {"database"}
+    assert app_module.replay_services("/custom_cluster_size/Oncology_2019_2020.parquet/50") == {"database", "S3", "OpenAI"}
+    app_module.clear_caches()
+
+def test_replay_leaves_out_requests_without_stand_ins(app_module, monkeypatch, tmp_path):
+    log_file = tmp_path / "application.log"
+    log_file.write_text("\n".join(LOG) + "\n")
+    served = []
+    monkeypatch.setattr(app_module, "search_s3", lambda file_name: served.append(file_name))
+    monkeypatch.setattr(app_module, "stream_topic_summary", lambda topic_table: served.append("summary"))
+    runner = app_module.app.test_cli_runner()
+    app_module.clear_caches()
+
+    result = runner.invoke(args=["replay", str(log_file), "--total", "20", "--concurrency", "2"])
+    assert result.exit_code == 0, result.output
+    assert "Leaving out 2 requests to 2 paths" in result.output
+    assert served == []
+
+    result = runner.invoke(args=["replay", str(log_file), "--total", "20", "--concurrency", "2", "--offline"])
+    assert result.exit_code == 0, result.output
+    assert "Leaving out 3 requests to 3 paths" in result.output
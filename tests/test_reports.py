@@ -0,0 +1,108 @@
+import io
+import json
+import time
+import zipfile
+import threading
+
+import pandas as pd
+import pytest
+
+from sqlalchemy import create_engine
+
+from src import report_funcs
+from src.report_funcs import parse_comparators, comparator_folder, write_report
+
+def entry(comparator_type, comparator, error=None):
+    if error:
+        return {"comparator_type": comparator_type, "comparator": comparator, "error": error}
+    return {
+        "comparator_type": comparator_type,
+        "comparator": comparator,
+        "summary": ["First sentence.", "Second sentence."],
+        "topic_table": pd.DataFrame({"gpt_label": ["Immunotherapy"], "avg_citations": [4.0]}),
+        "exemplars": pd.DataFrame({"doi": ["10.1/1", "10.1/2"]}),
+        "authors": pd.DataFrame({"author_full_name": ["Smith, J."]}),
+    }
+
+def test_parse_comparators(monkeypatch):
+    assert parse_comparators([" country:Germany ", "journal:Nature: Medicine", "country:Germany", "region: Europe"]) == [("country", "Germany"), ("journal", "Nature: Medicine"), ("region", "Europe")]
+    assert parse_comparators([]) == []
+    for value in ["planet:Mars", "country:", "country: ", "Germany", "subject:"]:
+        with pytest.raises(ValueError, match="is not a comparator"):
+            parse_comparators([value])
+    monkeypatch.setattr(report_funcs, "REPORT_MAX_COMPARATORS", 2)
+    with pytest.raises(ValueError, match="At most 2"):
+        parse_comparators(["country:Germany", "country:France", "country:Spain"])
+
+def test_comparator_folder():
+    assert comparator_folder("subject", "") == "subject"
+    assert comparator_folder("country", "United Kingdom") == "country_United_Kingdom"
+    assert comparator_folder("journal", "../Cell/Reports") == "journal_.._Cell_Reports"
+    assert comparator_folder("journal", "Cell Reports") == comparator_folder("journal", "Cell/Reports")
+
+def test_report_archive_layout(tmp_path):
+    path = str(tmp_path / "report.zip")
+    entries = [entry("subject", ""), entry("journal", "Cell Reports"), entry("journal", "Cell/Reports"), entry("country", "Atlantis", error="Summary failed: timeout")]
+    manifest = write_report(path, "report_test.parquet", {"min_cluster_size": 20}, entries)
+
+    with zipfile.ZipFile(path) as archive:
+        names = archive.namelist()
+        index = pd.read_csv(io.BytesIO(archive.read("comparators.csv")))
+        assert json.loads(archive.read("manifest.json")) == manifest
+        assert archive.read("subject/summary.txt").decode() == "First sentence.\n\nSecond sentence.\n"
+    folders = ["subject", "journal_Cell_Reports", "journal_Cell_Reports_2"]
+    assert sorted(names) == sorted([f"{folder}/{name}" for folder in folders for name in ["summary.txt", "topic_table.csv", "exemplars.csv", "authors.csv"]] + ["comparators.csv", "manifest.json"])
+    assert index["folder"].tolist() == folders + ["country_Atlantis"]
+    assert index["exemplars"].tolist()[:3] == [2, 2, 2] and index["error"].tolist()[3] == "Summary failed: timeout"
+    assert (manifest["comparators"], manifest["errors"], manifest["params"]) == (4, 1, {"min_cluster_size": 20})
+    assert not [name for name in tmp_path.iterdir() if name.name.endswith(".tmp")]
+
+@pytest.fixture
+def dataset(app_module, monkeypatch):
+    engine = create_engine(app_module.app.config["SQLALCHEMY_DATABASE_URI"])
+    pd.DataFrame({"doi": ["10.1/1"], "gpt_label": ["Immunotherapy"]}).to_sql("report_test", engine, schema="clustering_data", if_exists="replace", index=False)
+    monkeypatch.setattr(app_module, "search_shards", lambda file_name: False)
+    app_module.clear_caches()
+    yield "report_test.parquet"
+    app_module.clear_caches()
+
+def wait_for(client, status_url, timeout=10):
+    deadline = time.time() + timeout
+    while client.get(status_url).get_json()["status"] == "running" and time.time() < deadline:
+        time.sleep(0.05)
+    return client.get(status_url).get_json()
+
+def test_report_flow(app_module, client, dataset, monkeypatch):
+    release = threading.Event()
+    def build_report(file_name, comparators, custom=False, custom_size=None, report_id=None, progress=None, workers=None):
+        release.wait(10)
+        entries = [entry("subject", "")] + [entry(*comparator) for comparator in comparators]
+        progress(len(entries), len(entries), entries[-1])
+        return report_funcs.report_path(report_id), write_report(report_funcs.report_path(report_id), file_name, {}, entries)
+    monkeypatch.setattr(app_module, "build_report", build_report)
+
+    assert client.post(f"/report/{dataset}", json={}).status_code == 400
+    assert client.post(f"/report/{dataset}", json={"comparators": ["planet:Mars"]}).status_code == 400
+    assert client.post("/report/missing_report_test.parquet", json={"comparators": ["country:Germany"]}).status_code == 404
+    assert client.post(f"/report/{dataset}", json={"comparators": ["country:Germany"], "custom_size": 35}).status_code == 404
+
+    started = client.post(f"/report/{dataset}", json={"comparators": ["country:Germany", "journal:Cell"]})
+    assert started.status_code == 202
+    urls = started.get_json()
+    busy = client.post(f"/report/{dataset}", json={"comparators": ["country:Germany"]})
+    assert busy.status_code == 429 and busy.headers["Retry-After"]
+    assert client.get(urls["status_url"]).get_json()["status"] == "running"
+    assert client.get(urls["download_url"]).status_code == 409
+
+    release.set()
+    status = wait_for(client, urls["status_url"])
+    assert (status["status"], status["done"], status["total"], status["errors"]) == ("done", 3, 3, 0)
+    download = client.get(urls["download_url"])
+    assert download.status_code == 200
+    assert "country_Germany/summary.txt" in zipfile.ZipFile(io.BytesIO(download.data)).namelist()
+    assert client.get("/report/not_a_report").status_code == 404
+
+    # the slot is free again once the report is done
+    again = client.post(f"/report/{dataset}", json={"comparators": ["country:Germany"]})
+    assert again.status_code == 202
+    assert wait_for(client, again.get_json()["status_url"])["status"] == "done"
@@ -0,0 +1,33 @@
+import pandas as pd
+import pytest
+
+from src.search_funcs import build_index, bm25_search
+
+TITLES = ["Tumour immunotherapy in melanoma", "Immunotherapy response markers", "Gene expression of tumour cells", "Imaging of tumour margins"]
+
+@pytest.fixture
+def dataset(app_module, monkeypatch):
+    articles = pd.DataFrame({
+        "doi": [f"10.1/search{i}" for i in range(len(TITLES))],
+        "article_title": TITLES,
+        "coord_x": [0.0, 1.0, 2.0, 3.0],
+        "coord_y": 0.0,
+        "gpt_label": ["Immunotherapy", "Immunotherapy", "Gene expression", None],
+    })
+    monkeypatch.setattr(app_module, "load_cluster_labels", lambda file_name, custom=False, custom_size=None: articles)
+    app_module.clear_caches()
+    yield "search_test.parquet"
+    app_module.clear_caches()
+
+@pytest.mark.parametrize("limit, expected", [(0, 0), (-3, 0), (2, 2), (10, 3)])
+def test_bm25_limit(limit, expected):
+    index = build_index(pd.Series(TITLES))
+    positions, scores, total = bm25_search(index, "tumour", limit=limit)
+    assert len(positions) == expected and total == 3
+
+@pytest.mark.parametrize("limit, status, results", [("", 200, 3), ("2", 200, 2), ("0", 200, 1), ("-5", 200, 1), ("100000", 200, 3), ("abc", 400, None), ("1.5", 400, None)])
+def test_search_limit(client, dataset, limit, status, results):
+    response = client.get(f"/search/{dataset}/none/none/false/None?q=tumour" + (f"&limit={limit}" if limit else ""))
+    assert response.status_code == status
+    if results is not None:
+        assert len(response.get_json()["results"]) == results
@@ -0,0 +1,62 @@
+import time
+import threading
+
+import pandas as pd
+import pytest
+
+from sqlalchemy import create_engine, inspect
+
+from src.supporter_funcs import ARTICLE_COLUMNS
+
+def make_labels(n, label):
+    return pd.DataFrame({"doi": [f"10.1/shard{i}" for i in range(n)], "cluster_label": [i % 2 for i in range(n)], "exemplar": False, "gpt_label": label})
+
+def read_rows(app_module, file_name):
+    return app_module.read_assignments(file_name).sort_values("doi", ignore_index=True)
+
+def test_write_assignments_replaces_a_combination(app_module):
+    app_module.write_assignments("Oncology_2019_2020.parquet", make_labels(10, "Immunotherapy"))
+    app_module.write_assignments("Oncology_2020_2021.parquet", make_labels(4, "Gene expression"))
+    app_module.write_assignments("Oncology_2019_2020.parquet", make_labels(6, "Tumour imaging"))
+
+    rows = read_rows(app_module, "Oncology_2019_2020.parquet")
+    assert len(rows) == 6 and set(rows["gpt_label"]) == {"Tumour imaging"}
+    assert len(read_rows(app_module, "Oncology_2020_2021.parquet")) == 4
+    engine = create_engine(app_module.app.config["SQLALCHEMY_DATABASE_URI"])
+    assert [index["column_names"] for index in inspect(engine).get_indexes("assignments", schema="cluster_assignments") if index["unique"]] == [["dataset", "doi"]]
+
+def test_failed_write_keeps_the_old_assignments(app_module):
+    app_module.write_assignments("Oncology_2018_2019.parquet", make_labels(4, "Immunotherapy"))
+    duplicated = pd.concat([make_labels(3, "Tumour imaging")] * 2, ignore_index=True)
+
+    with pytest.raises(Exception):
+        app_module.write_assignments("Oncology_2018_2019.parquet", duplicated)
+    rows = read_rows(app_module, "Oncology_2018_2019.parquet")
+    assert len(rows) == 4 and set(rows["gpt_label"]) == {"Immunotherapy"}
+
+def test_new_combinations_are_clustered_once(app_module, monkeypatch):
+    file_name = "Oncology_2016_2017.parquet"
+    articles = pd.DataFrame({column: range(20) for column in ARTICLE_COLUMNS}).assign(doi=[f"10.1/shard{i}" for i in range(20)])
+    calls = []
+
+    def cluster(df, params):
+        calls.append(file_name)
+        time.sleep(0.5)
+        return df.assign(cluster_label=[i % 2 for i in range(len(df))], exemplar=False), None, None
+
+    monkeypatch.setattr(app_module, "read_shards", lambda folder, file_name, columns: articles.copy())
+    monkeypatch.setattr(app_module, "shard_files", lambda file_name: ["Oncology_2016.parquet", "Oncology_2017.parquet"])
+    monkeypatch.setattr(app_module, "composed_params", lambda file_name: {})
+    monkeypatch.setattr(app_module, "get_cluster_labels", cluster)
+    monkeypatch.setattr(app_module, "relabel_clusters", lambda cluster_labels, base: (pd.DataFrame({"cluster_label": [0, 1], "gpt_label": ["Immunotherapy", "Gene expression"]}), 0))
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(app_module.compose_cluster_labels(file_name))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [file_name]
+    assert len(results) == 4 and all(len(result) == 20 for result in results)
+    assert len(read_rows(app_module, file_name)) == 20
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from sqlalchemy import create_engine
+
+from src.openai_funcs import generate_table_summary
+from src.supporter_funcs import filter_comparator
+
+JOURNALS = ["Cell", "Cell Reports", "Nature", "Nature Medicine", "100% Open_Access"]
+PUBLISHERS = ["ELSEVIER", "SPRINGER NATURE", "WILEY"]
+COUNTRIES = ["United Kingdom", "USA", "Germany", "China", "United Kingdom; USA", "France; Spain"]
+REGIONS = ["Europe", "North America", "Asia Pacific", "Europe; North America"]
+LABELS = ["Immunotherapy", "Tumour imaging", "Gene expression", None]
+
+COMPARATORS = [
+    ("subject", ""),
+    ("journal", "Cell"),
+    ("journal", "Nature Medicine"),
+    ("journal", "100% Open_Access"),
+    ("publisher", "Elsevier"),
+    ("region", "Europe"),
+    ("region", "North America"),
+    ("region", "TA7"),
+    ("country", "United Kingdom"),
+    ("country", "China"),
+    ("country", "Atlantis"),
+]
+
+@pytest.fixture(scope="module", params=[[2021], [2019, 2020, 2021]], ids=["one_year", "three_years"])
+def dataset(app_module, request):
+    rng = np.random.default_rng(len(request.param))
+    n = 600
+    articles = pd.DataFrame({
+        "doi": [f"10.1/summary{i}" for i in range(n)],
+        "full_source_title": rng.choice(JOURNALS, n),
+        "publisher_group": rng.choice(PUBLISHERS, n),
+        "prid_country": rng.choice(COUNTRIES, n),
+        "prid_region": rng.choice(REGIONS, n),
+        "year_published": rng.choice(request.param, n),
+        "citations": rng.integers(0, 300, n).astype(float),
+        "gpt_label": rng.choice(LABELS, n),
+    })
+    articles.loc[rng.choice(n, 20, replace=False), "citations"] = np.nan
+    file_name = f"sql_summary_{len(request.param)}.parquet"
+    engine = create_engine(app_module.app.config["SQLALCHEMY_DATABASE_URI"])
+    articles.to_sql(file_name.replace(".parquet", ""), engine, schema="clustering_data", if_exists="replace", index=False)
+    return file_name, articles
+
+@pytest.mark.parametrize("comparator_type, comparator", COMPARATORS)
+def test_sql_summary_matches_pandas(app_module, dataset, comparator_type, comparator):
+    file_name, articles = dataset
+    expected = generate_table_summary(filter_comparator(articles, comparator_type, comparator))
+    summary = app_module.sql_table_summary(file_name, comparator_type, comparator)
+
+    assert list(summary.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(
+        summary.sort_values("gpt_label", ignore_index=True),
+        expected.sort_values("gpt_label", ignore_index=True),
+        check_dtype=False,
+        check_names=False,
+    )
@@ -0,0 +1,42 @@
+import time
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
+import pytest
+
+def test_stages_run_concurrently(app_module):
+    def stage(value):
+        time.sleep(0.3)
+        return value
+
+    start = time.time()
+    results = app_module.run_stages({"authors": (lambda: stage("authors"), 5, None), "summary": (lambda: stage("summary"), 5, None)})
+    assert results == {"authors": "authors", "summary": "summary"}
+    assert time.time() - start < 0.55
+
+def test_slow_stage_returns_its_fallback(app_module):
+    start = time.time()
+    results = app_module.run_stages({
+        "authors": (lambda: "authors", 5, None),
+        "summary": (lambda: time.sleep(2) or "summary", 0.3, ["Summary unavailable."]),
+    })
+    assert results == {"authors": "authors", "summary": ["Summary unavailable."]}
+    assert time.time() - start < 1
+
+def test_slow_stage_without_a_fallback_raises(app_module):
+    with pytest.raises(FuturesTimeoutError):
+        app_module.run_stages({"authors": (lambda: time.sleep(2), 0.3, None)})
+
+def test_stages_share_one_deadline(app_module):
+    # the second stage's timeout counts from when the stages started, not from when the first one finished
+    start = time.time()
+    results = app_module.run_stages({
+        "authors": (lambda: time.sleep(0.4) or "authors", 1, None),
+        "summary": (lambda: time.sleep(2) or "summary", 0.5, "fallback"),
+    })
+    assert results == {"authors": "authors", "summary": "fallback"}
+    assert time.time() - start < 0.9
+
+def test_stages_run_in_an_app_context(app_module):
+    from flask import current_app
+
+    assert app_module.run_stages({"name": (lambda: current_app.name, 5, None)}) == {"name": app_module.app.name}
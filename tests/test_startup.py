@@ -0,0 +1,80 @@
+import gc
+import os
+import sys
+import json
+import subprocess
+
+from sqlalchemy import create_engine
+
+IMPORT_TIME_BUDGET = float(os.getenv("IMPORT_TIME_BUDGET", 3.0)) # seconds to import src.app in a fresh interpreter
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["awswrangler", "hdbscan", "langchain", "sklearn", "pyarrow.parquet"]
+
+IMPORT_SCRIPT = """
+import sys, time, json
+start = time.perf_counter()
+import src.app
+print(json.dumps({"seconds": time.perf_counter() - start, "modules": [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+def import_app(tmp_path):
+    # S3 is made unreachable, importing the app must not need it
+    env = {**os.environ, "AWS_ACCESS_KEY_ID": "", "AWS_SECRET_ACCESS_KEY": "", "AWS_ENDPOINT_URL": "http://127.0.0.1:9"}
+    result = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], cwd=tmp_path, env={**env, "PYTHONPATH": REPO_ROOT}, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def test_import_time_budget(tmp_path):
+    # best of three, so a slow first read of the interpreter's files doesn't fail the budget
+    seconds = min(import_app(tmp_path)["seconds"] for _ in range(3))
+    assert seconds < IMPORT_TIME_BUDGET, f"importing src.app took {seconds:.2f}s, the budget is {IMPORT_TIME_BUDGET}s"
+
+def test_heavy_modules_are_imported_lazily(tmp_path):
+    assert import_app(tmp_path)["modules"] == []
+
+def test_home_is_503_without_form_data(app_module, client, monkeypatch, tmp_path):
+    def unreachable():
+        raise ConnectionError("S3 is unreachable")
+
+    saved = dict(app_module.form_data)
+    monkeypatch.setattr(app_module, "FORM_DATA_SNAPSHOT", str(tmp_path / "missing.json"))
+    monkeypatch.setattr(app_module, "create_form_data", unreachable)
+    app_module.form_data.clear()
+    try:
+        response = client.get("/")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "60"
+        assert client.get("/comparitors/Oncology").status_code == 503
+    finally:
+        app_module.form_data.update(saved)
+
+def test_home_renders_from_snapshot(client):
+    assert client.get("/").status_code == 200
+
+def test_create_app_skips_missing_preload_modules(app_module, monkeypatch):
+    warnings = []
+    monkeypatch.setattr(app_module, "PRELOAD_MODULES", ["json", "not_an_installed_module"])
+    monkeypatch.setattr(app_module, "reference_data_preloaded", [])
+    monkeypatch.setattr(app_module, "get_country_lookup", lambda: {})
+    monkeypatch.setattr(app_module.app.logger, "warning", lambda message, *args: warnings.append(message % args))
+    try:
+        assert app_module.create_app(preload=True) is app_module.app
+    finally:
+        gc.unfreeze()
+    assert app_module.reference_data_preloaded
+    assert len(warnings) == 1 and warnings[0].startswith("Not preloading not_an_installed_module")
+
+def test_create_app_adds_the_algorithm_column(app_module):
+    engine = create_engine(app_module.app.config["SQLALCHEMY_DATABASE_URI"])
+    with engine.begin() as connection:
+        connection.exec_driver_sql("DROP TABLE IF EXISTS best_parameters")
+        connection.exec_driver_sql("CREATE TABLE best_parameters (id VARCHAR(100) PRIMARY KEY, min_cluster_size INTEGER, min_samples INTEGER, cluster_selection_method VARCHAR(25), cluster_selection_epsilon FLOAT, metric VARCHAR(25), score FLOAT)")
+        connection.exec_driver_sql("INSERT INTO best_parameters VALUES ('upgrade_test.parquet', 20, 5, 'eom', 0.0, 'euclidean', 0.5)")
+    try:
+        app_module.create_app(preload=False)
+        assert app_module.get_params("upgrade_test.parquet")["algorithm"] is None
+        assert not app_module.upgrade_params_table()
+    finally:
+        app_module.db.session.rollback()
+        with engine.begin() as connection:
+            connection.exec_driver_sql("DROP TABLE best_parameters")
@@ -0,0 +1,83 @@
+import io
+import json
+import sqlite3
+
+import pytest
+
+from botocore.exceptions import ClientError
+
+from src import stub_funcs
+
+class FakeS3:
+    """
+    The get_object and conditional put_object calls flush_stubs makes, against a dict.
+    """
+    def __init__(self, fail=False):
+        self.objects = {}
+        self.fail = fail
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        body, etag = self.objects[Key]
+        return {"Body": io.BytesIO(body), "ETag": etag}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None):
+        if self.fail:
+            raise ClientError({"Error": {"Code": "InternalError"}}, "PutObject")
+        current = self.objects.get(Key)
+        if (IfNoneMatch and current) or (IfMatch and (current is None or current[1] != IfMatch)):
+            raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+        self.objects[Key] = (Body, str(len(self.objects) + 1) + (current[1] if current else ""))
+
+@pytest.fixture
+def journal(tmp_path):
+    return str(tmp_path / "stubs.sqlite")
+
+def unflushed(journal):
+    connection = stub_funcs.connect(journal)
+    try:
+        return connection.execute("SELECT file_name, batch, claimed_at FROM stub_requests ORDER BY id").fetchall()
+    finally:
+        connection.close()
+
+def test_flush_sends_each_request_once(journal):
+    for user in ["a@example.com", "b@example.com", "a@example.com"]:
+        stub_funcs.record_stub("Oncology_2019.parquet", user, path=journal)
+    client = FakeS3()
+
+    assert stub_funcs.flush_stubs(client, path=journal) == 3
+    assert stub_funcs.flush_stubs(client, path=journal) == 0
+    assert client.objects[stub_funcs.stub_key("Oncology_2019.parquet")][0] == b"a@example.com,b@example.com"
+    assert json.loads(client.objects[stub_funcs.STUB_QUEUE_KEY][0])[0]["requests"] == 3
+    assert unflushed(journal) == []
+
+def test_failed_flush_releases_the_batch(journal):
+    stub_funcs.record_stub("Oncology_2019.parquet", "None", path=journal)
+    with pytest.raises(ClientError):
+        stub_funcs.flush_stubs(FakeS3(fail=True), path=journal)
+    assert unflushed(journal) == [("Oncology_2019.parquet", None, None)]
+
+def test_abandoned_batches_are_reclaimed(journal, monkeypatch):
+    stub_funcs.record_stub("Oncology_2019.parquet", "None", path=journal)
+    connection = stub_funcs.connect(journal)
+    try:
+        batch, rows = stub_funcs.claim_batch(connection) # claimed by a worker that then dies
+        assert len(rows) == 1
+        assert stub_funcs.claim_batch(connection)[1] == []
+
+        claimed_at = unflushed(journal)[0][2]
+        monkeypatch.setattr(stub_funcs.time, "time", lambda: claimed_at + stub_funcs.STUB_CLAIM_TIMEOUT + 1)
+        reclaimed, rows = stub_funcs.claim_batch(connection)
+    finally:
+        connection.close()
+    assert reclaimed != batch and len(rows) == 1
+
+def test_old_journals_gain_claimed_at(journal):
+    connection = sqlite3.connect(journal, isolation_level=None)
+    connection.execute("CREATE TABLE stub_requests (id INTEGER PRIMARY KEY AUTOINCREMENT, file_name TEXT NOT NULL, user TEXT NOT NULL, requested_at REAL NOT NULL, batch TEXT)")
+    connection.execute("INSERT INTO stub_requests (file_name, user, requested_at, batch) VALUES ('Oncology_2019.parquet', 'None', 0, 'lost')")
+    connection.close()
+
+    assert stub_funcs.flush_stubs(FakeS3(), path=journal) == 1
+    assert unflushed(journal) == []
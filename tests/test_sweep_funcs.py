@@ -0,0 +1,45 @@
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import src.sweep_funcs as sweep_funcs
+
+from src.supporter_funcs import clusterer_engine
+
+pytest.importorskip("hdbscan")
+
+def blobs(n=600, seed=0):
+    rng = np.random.default_rng(seed)
+    centres = np.array([[0, 0], [10, 10], [0, 10]])
+    points = centres[rng.integers(0, len(centres), n)] + rng.normal(0, 0.5, (n, 2))
+    return pd.DataFrame({"coord_x": points[:, 0], "coord_y": points[:, 1]})
+
+def slow_candidate(params):
+    if params["min_cluster_size"] == 400:
+        time.sleep(60)
+    return {**params, "algorithm": "boruvka_kdtree", "dbcv": 0.5, "pct_clustered": 0.9, "number_clusters": 3, "score": params["min_samples"] / 100}
+
+def test_sweep_returns_the_best_candidate_with_its_algorithm():
+    candidates = sweep_funcs.sweep_candidates({"min_cluster_size": [25, 50], "min_samples": [5], "cluster_selection_epsilon": [0.0], "cluster_selection_method": ["eom"]})
+    best, results = sweep_funcs.run_sweep(blobs(), candidates, workers=2, time_budget=120, patience=0)
+    assert len(results) == 4
+    assert best["number_clusters"] == 3
+    assert best["algorithm"] == clusterer_engine(600, best["metric"])["algorithm"]
+    assert best["score"] == max(result["score"] for result in results)
+
+def test_swept_algorithm_is_used():
+    candidates = sweep_funcs.sweep_candidates({"min_cluster_size": [25], "min_samples": [5], "cluster_selection_epsilon": [0.0], "cluster_selection_method": ["eom"], "metric": ["euclidean"], "algorithm": ["prims_kdtree", "boruvka_kdtree"]})
+    best, results = sweep_funcs.run_sweep(blobs(), candidates, workers=1, time_budget=120, patience=0)
+    assert sorted(result["algorithm"] for result in results) == ["boruvka_kdtree", "prims_kdtree"]
+
+def test_time_budget_stops_running_candidates(monkeypatch):
+    # forked workers look score_candidate up on the patched module
+    monkeypatch.setattr(sweep_funcs, "score_candidate", slow_candidate)
+    candidates = sweep_funcs.sweep_candidates({"min_cluster_size": [25, 400], "min_samples": [1, 5], "cluster_selection_epsilon": [0.0], "cluster_selection_method": ["eom"], "metric": ["euclidean"]})
+    start = time.time()
+    best, results = sweep_funcs.run_sweep(blobs(), candidates, workers=2, time_budget=3, patience=0)
+    assert time.time() - start < 10
+    assert best["min_cluster_size"] == 25 and best["min_samples"] == 5
+    assert all(result["min_cluster_size"] == 25 for result in results)